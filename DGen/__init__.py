@@ -2,4 +2,4 @@
 
 Athanasios Anastasiou April 2017
 """
-__all__ = ["datagenerator", "dataperturbator", "epi"]
+__all__ = ["datagenerator", "dataperturbator", "perturbationplan", "keyedrandom", "uniquevalues", "perturbfile", "records", "relational", "enumeration", "generatorprofile", "telemetry", "prefetch", "loadgen", "epi"]
@@ -28,8 +28,324 @@ Athanasios Anastasiou Sept 2016
 import uuid
 import random
 import rstr
+import string
 import datetime
+import threading
+import sre_parse
+import numpy
 from bunch import Bunch
+from .records import recordType, recordTable, childTable, _objectColumn as _toColumn
+from .uniquevalues import uniqueSequence
+
+#Holds the stack of row contexts that are active in each thread (please see rowContext)
+_activeContexts = threading.local()
+
+def _activeContext():
+    """Returns the innermost rowContext that is active in the calling thread or None"""
+    try:
+        return _activeContexts.stack[-1]
+    except (AttributeError, IndexError):
+        return None
+
+def _groupIndices(values):
+    """Groups the positions of a column by the value they hold
+    
+    Args:
+        values: A one dimensional sequence of hashable (and sortable) values
+        
+    Returns:
+        A list of (value, indices) pairs, where indices is a numpy array of 
+        the positions of value in values
+    """
+    uniqueValues, inverse = numpy.unique(numpy.asarray(values), return_inverse=True)
+    order = numpy.argsort(inverse, kind="mergesort")
+    bounds = numpy.cumsum(numpy.bincount(inverse, minlength=len(uniqueValues)))[:-1]
+    return zip(uniqueValues, numpy.split(order, bounds))
+    
+def _generateSubset(aGenerator, indices):
+    """Evaluates aGenerator in batch mode for a subset of the rows of the current batch
+    
+    If a rowContext is active, the subset is selected on it for the duration of 
+    the evaluation so that any varRefGenerator within aGenerator returns the 
+    values of the rows in the subset only.
+    """
+    context = _activeContext()
+    if context is None:
+        return aGenerator.generateBatch(len(indices))
+    context.pushSelection(indices)
+    try:
+        return aGenerator.generateBatch(len(indices))
+    finally:
+        context.popSelection()
+        
+def _seedStreams(aSeed, streamIndex, seedNumpy = True):
+    """Seeds the random (and numpy.random) module to a substream of aSeed
+    
+    Every (aSeed, streamIndex) pair seeds the generators to a different, 
+    reproducible, state.
+    
+    Args:
+        aSeed: A 64 bit integer
+        streamIndex: A (small) non negative integer identifying the substream
+        seedNumpy: Whether numpy.random should be seeded as well
+    """
+    random.seed((aSeed << 16) | streamIndex)
+    if seedNumpy:
+        numpy.random.seed([aSeed & 0xFFFFFFFF, aSeed >> 32, streamIndex])
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+def _mix64(z):
+    """The finaliser of SplitMix64, a bijective hash of a 64 bit integer"""
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+class _substream(object):
+    """A source of random numbers with the interface of random.Random, whose state is a SplitMix64 counter
+
+    Unlike a random.Random, it is seeded in constant time, so that a
+    substream can be derived for every field of every record.
+    """
+    def __init__(self, aSeed):
+        self._state = aSeed & _MASK64
+
+    def _next(self):
+        self._state = (self._state + 0x9E3779B97F4A7C15) & _MASK64
+        return _mix64(self._state)
+
+    def random(self):
+        return (self._next() >> 11) * (1.0 / 9007199254740992)
+
+    def getrandbits(self, k):
+        bits, n = 0, 0
+        while n < k:
+            bits |= self._next() << n
+            n += 64
+        return bits & ((1 << k) - 1)
+
+#The methods of random.Random that only rely on random() and getrandbits()
+for _aMethod in ("_randbelow", "randrange", "randint", "choice", "shuffle", "sample", "uniform", "triangular",
+                 "normalvariate", "lognormvariate", "expovariate", "gammavariate", "betavariate"):
+    setattr(_substream, _aMethod, random.Random.__dict__[_aMethod])
+del _aMethod
+
+#Holds the streams of the field that is being evaluated in each thread (please see _fieldStreams)
+_activeStreams = threading.local()
+
+class _fieldStreams(object):
+    """The random number streams of a field of a record, derived from the seed of the record (or batch)
+
+    While a _fieldStreams is active, generators draw from its streams (please
+    see _random and _numpyRandom) rather than from the random and numpy.random
+    modules, so generating a record neither depends on nor changes their state.
+    The numpy stream is only created if a generator of the field asks for it.
+    """
+    def __init__(self, aSeed, streamIndex):
+        self._seed = aSeed
+        self._streamIndex = streamIndex
+        self.scalar = _substream(_mix64(aSeed ^ _mix64(streamIndex + 1)))
+        self._batch = None
+        self._rstr = None
+        self._previous = None
+
+    @property
+    def batch(self):
+        if self._batch is None:
+            self._batch = numpy.random.RandomState([self._seed & 0xFFFFFFFF, self._seed >> 32, self._streamIndex])
+        return self._batch
+
+    @property
+    def rstr(self):
+        if self._rstr is None:
+            self._rstr = rstr.Rstr(self.scalar)
+        return self._rstr
+
+    def __enter__(self):
+        self._previous = getattr(_activeStreams, "current", None)
+        _activeStreams.current = self
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        _activeStreams.current = self._previous
+        return False
+
+def _random():
+    """Returns the source of random numbers of scalar generation: the stream of the field being evaluated or, outside of records, the random module"""
+    current = getattr(_activeStreams, "current", None)
+    return random if current is None else current.scalar
+
+def _numpyRandom():
+    """Returns the source of random numbers of batch generation: the stream of the field being evaluated or, outside of records, numpy.random"""
+    current = getattr(_activeStreams, "current", None)
+    return numpy.random if current is None else current.batch
+
+def _rstr():
+    """Returns the rstr module or, within a record, an rstr.Rstr that draws from the stream of the field being evaluated"""
+    current = getattr(_activeStreams, "current", None)
+    return rstr if current is None else current.rstr
+
+#Upper bound of repetitions for * and + in reverse regular expressions (as in rstr)
+_STAR_PLUS_LIMIT = 100
+
+#Character categories of reverse regular expressions that can be evaluated in batch mode (as in rstr)
+_categories = {"category_digit":string.digits, 
+               "category_space":string.whitespace, 
+               "category_word":string.ascii_letters + string.digits + "_"}
+
+def _isBatchXegerable(parsed):
+    """Returns True if a parsed regular expression only uses constructs that _batchXeger can evaluate"""
+    for opcode, value in parsed:
+        opcode = str(opcode).lower()
+        if opcode == "literal":
+            continue
+        elif opcode == "in":
+            for anOpcode, aValue in value:
+                anOpcode = str(anOpcode).lower()
+                if anOpcode == "category":
+                    if str(aValue).lower() not in _categories:
+                        return False
+                elif anOpcode not in ("literal", "range"):
+                    return False
+        elif opcode == "subpattern":
+            #Back references to groups would have to be resolved row by row
+            if not _isBatchXegerable(value[-1]):
+                return False
+        elif opcode == "branch":
+            if not all([_isBatchXegerable(anAlternative) for anAlternative in value[1]]):
+                return False
+        elif opcode in ("max_repeat", "min_repeat"):
+            if not _isBatchXegerable(value[2]):
+                return False
+        else:
+            return False
+    return True
+    
+def _fixedAlphabets(parsed):
+    """Returns the alphabet of each character of the strings matching a parsed regular expression of fixed structure
+    
+    A regular expression has a fixed structure if it only consists of literals, character sets, 
+    groups and repetitions of a fixed count, so that each of its strings is a distinct choice of 
+    one character per position.
+    
+    Returns:
+        A list of lists of characters (or None if the expression does not have a fixed structure)
+    """
+    alphabets = []
+    for opcode, value in parsed:
+        opcode = str(opcode).lower()
+        if opcode == "literal":
+            alphabets.append([unichr(value)])
+        elif opcode == "in":
+            candidates = []
+            for anOpcode, aValue in value:
+                anOpcode = str(anOpcode).lower()
+                if anOpcode == "literal":
+                    candidates.append(unichr(aValue))
+                elif anOpcode == "range":
+                    candidates.extend([unichr(k) for k in xrange(aValue[0], aValue[1] + 1)])
+                elif anOpcode == "category" and str(aValue).lower() in _categories:
+                    candidates.extend(_categories[str(aValue).lower()])
+                else:
+                    return None
+            alphabets.append(candidates)
+        elif opcode == "subpattern":
+            inner = _fixedAlphabets(value[-1])
+            if inner is None:
+                return None
+            alphabets.extend(inner)
+        elif opcode in ("max_repeat", "min_repeat") and value[0] == value[1]:
+            inner = _fixedAlphabets(value[2])
+            if inner is None:
+                return None
+            alphabets.extend(inner * value[0])
+        else:
+            return None
+    return alphabets
+    
+def _batchXeger(parsed, N):
+    """Generates N strings matching a parsed regular expression, with numpy
+    
+    Every construct is evaluated once for all N strings. The strings are 
+    distributed as those produced by rstr.xeger.
+    
+    Args:
+        parsed: A parsed regular expression (please see sre_parse) for which _isBatchXegerable is True
+        N: An integer, the number of strings to generate
+        
+    Returns:
+        A numpy array (of dtype object) of N strings
+    """
+    result = numpy.empty(N, dtype=object)
+    result.fill(u"")
+    for opcode, value in parsed:
+        opcode = str(opcode).lower()
+        if opcode == "literal":
+            result += unichr(value)
+        elif opcode == "in":
+            candidates = []
+            for anOpcode, aValue in value:
+                anOpcode = str(anOpcode).lower()
+                if anOpcode == "literal":
+                    candidates.append(unichr(aValue))
+                elif anOpcode == "range":
+                    candidates.extend([unichr(k) for k in xrange(aValue[0], aValue[1] + 1)])
+                else:
+                    candidates.extend(_categories[str(aValue).lower()])
+            result += numpy.array(candidates, dtype=object)[_numpyRandom().randint(0, len(candidates), N)]
+        elif opcode == "subpattern":
+            result += _batchXeger(value[-1], N)
+        elif opcode == "branch":
+            choices = _numpyRandom().randint(0, len(value[1]), N)
+            for aChoice, indices in _groupIndices(choices):
+                result[indices] += _batchXeger(value[1][aChoice], len(indices))
+        else:
+            startRange, endRange, repeated = value
+            times = _numpyRandom().randint(startRange, min(endRange, _STAR_PLUS_LIMIT) + 1, N)
+            for k in xrange(1, times.max() + 1 if N else 0):
+                indices = numpy.flatnonzero(times >= k)
+                result[indices] += _batchXeger(repeated, len(indices))
+    return result
+    
+def _charMatrixToStrings(charMatrix):
+    """Joins the rows of a two dimensional array of single characters into a numpy array (of dtype object) of strings"""
+    charMatrix = numpy.ascontiguousarray(charMatrix, dtype="U1")
+    N, width = charMatrix.shape
+    if not width:
+        return _toColumn([u""] * N)
+    return charMatrix.view("U%d" % width).ravel().astype(object)
+    
+def _datesToStrings(dates):
+    """Formats a numpy array of datetime64 values as the strings that the equivalent datetime objects would be converted to"""
+    dates = dates.astype("datetime64[us]")
+    unit = "us" if (dates.astype(numpy.int64) % 1000000).any() else "s"
+    strings = numpy.datetime_as_string(dates, unit = unit)
+    #The date and time are separated by a space rather than a "T"
+    chars = strings.view(strings.dtype.kind + "1").reshape(len(strings), strings.dtype.itemsize // numpy.dtype(strings.dtype.kind + "1").itemsize)
+    chars[:, 10] = " "
+    return strings.astype(object)
+    
+def _toDatetime64(values):
+    """Converts a sequence of datetime objects or date strings to a numpy array of datetime64[us] values"""
+    return numpy.asarray(values, dtype=object).astype("datetime64[us]")
+    
+def _referencedNames(aGenerator):
+    """Returns the set of variable names referenced (via varRefGenerator) anywhere in the tree of aGenerator
+    
+    Nested recordGenerators are not descended into as they resolve their own references.
+    """
+    names = set()
+    visited = set()
+    pending = [aGenerator]
+    while pending:
+        current = pending.pop()
+        if id(current) in visited:
+            continue
+        visited.add(id(current))
+        if isinstance(current, varRefGenerator):
+            names.add(current.refName)
+        pending.extend([aChild for aChild in current.children if not isinstance(aChild, recordGenerator)])
+    return names
 
 class randomDataGenerator(object):
     """Base class for data generators
@@ -108,6 +424,51 @@ class randomDataGenerator(object):
         self._name = theName
         return self
         
+    def pooled(self, poolSize, replace = True, refreshEvery = None, refreshFraction = 0.1):
+        """Returns a pooledGenerator that samples the values of this generator from a pool (please see pooledGenerator)"""
+        return pooledGenerator(self, poolSize, replace, refreshEvery, refreshFraction)
+        
+    @property
+    def children(self):
+        """Returns the randomDataGenerators that this generator evaluates directly
+        
+        The default implementation discovers them from the attributes of the 
+        instance (including lists, tuples and dicts of generators), which 
+        covers all standard generators as well as most derived ones.
+        
+        Returns:
+            A list of randomDataGenerators
+        """
+        found = []
+        seen = set()
+        pending = [getattr(self, anAttribute) for anAttribute in sorted(vars(self))]
+        while pending:
+            aValue = pending.pop(0)
+            if isinstance(aValue, randomDataGenerator):
+                if id(aValue) not in seen and aValue is not self:
+                    seen.add(id(aValue))
+                    found.append(aValue)
+            elif isinstance(aValue, (list, tuple)):
+                pending.extend(aValue)
+            elif isinstance(aValue, dict):
+                pending.extend([aValue[aKey] for aKey in sorted(aValue)])
+        return found
+        
+    def generateBatch(self, N):
+        """Evaluates the generator N times
+        
+        This is the batch counterpart of calling the generator. Derived 
+        generators are expected to override it if they can produce a 
+        whole column of values faster than N successive calls.
+        
+        Args:
+            N: An integer, the number of values to generate
+            
+        Returns:
+            A numpy array (of dtype object) with N values
+        """
+        return _toColumn([self() for k in xrange(N)])
+        
     def __mul__(self, other):        
         """Instantiates a composite generator as the cartesian product of two others
         
@@ -224,6 +585,10 @@ class compositeORGenerator(compositeGenerator):
             String
         """
         return self._left() + self._right()
+        
+    def generateBatch(self, N):
+        """Produces the cartesian product of two columns of N values each"""
+        return self._left.generateBatch(N) + self._right.generateBatch(N)
             
 class compositeConditionalGenerator(compositeGenerator):
     """Defines a composite generator that implements conditional evaluation
@@ -259,6 +624,10 @@ class compositeConditionalGenerator(compositeGenerator):
         
     def __call__(self):
         return self._left(self._right())
+        
+    def generateBatch(self, N):
+        """Evaluates the left generator for N values GIVEN a column of N values of the right generator"""
+        return self._left.generateBatchGiven(self._right.generateBatch(N))
     
 class constantGenerator(randomDataGenerator):
     """Defines a generator that simply returns a literal
@@ -281,6 +650,11 @@ class constantGenerator(randomDataGenerator):
     def __call__(self):
         return self._theConstant
         
+    def generateBatch(self, N):
+        column = numpy.empty(N, dtype=object)
+        column.fill(self._theConstant)
+        return column
+        
 class optionGenerator(randomDataGenerator):
     """Defines a random generator that produces "events" from a list of possible events
     
@@ -314,6 +688,8 @@ class optionGenerator(randomDataGenerator):
         #TODO: Instead of basestring, check for number literals as well (or rather, anything that is NOT a randomDataGenerator needs to be wraped in one
         #TODO: Sum the probabilities to make sure they add up to 1 or throw an exception if they don't
         super(optionGenerator,self).__init__()
+        #Cumulative probabilities (and literal values) of the options, for batch mode
+        self._batchTables = None
         self._Noptions = len(theOptions)        
         if not self._Noptions:
             self._options = []
@@ -330,12 +706,34 @@ class optionGenerator(randomDataGenerator):
         
         Picks an event from the list of events proportional to its probability of appearance.
         """
-        v = random.random()
+        v = _random().random()
         k=0
         while v>=self._options[k][0]:
             v-=self._options[k][0]
             k+=1
         return self._options[k][1]()
+        
+    def generateBatch(self, N):
+        """Evaluates the optionGenerator N times
+        
+        The events of all N values are picked at once and each event is then 
+        evaluated once, in batch mode, for all the values that picked it.
+        """
+        if self._batchTables is None or self._batchTables[0] is not self._options:
+            constants = None
+            if all([isinstance(anOption[1], constantGenerator) for anOption in self._options]):
+                constants = _toColumn([anOption[1]() for anOption in self._options])
+            self._batchTables = (self._options, numpy.cumsum([anOption[0] for anOption in self._options]), constants)
+        choices = numpy.searchsorted(self._batchTables[1], _numpyRandom().random_sample(N), side="right")
+        #Probabilities that add up to less than one are resolved in favour of the last event
+        numpy.minimum(choices, self._Noptions - 1, out = choices)
+        if self._batchTables[2] is not None:
+            #Options that are literals are simply looked up
+            return self._batchTables[2][choices]
+        column = numpy.empty(N, dtype=object)
+        for aChoice, indices in _groupIndices(choices):
+            column[indices] = _generateSubset(self._options[aChoice][1], indices)
+        return column
           
 class condProbOptionGenerator(compositeConditionalGenerator):
     """Defines a conditional probability generator
@@ -385,6 +783,23 @@ class condProbOptionGenerator(compositeConditionalGenerator):
             requires a parameter.
         """
         return self._options[givenEvent]()
+        
+    def generateBatchGiven(self, givenEvents):
+        """Evaluates this randomDataGenerator GIVEN a column of events
+        
+        The rows are grouped by event and the generator of each event is 
+        evaluated once, in batch mode, for all the rows of its group.
+        
+        Args:
+            givenEvents: A sequence of events that drive the generation of instances from this generator.
+            
+        Returns:
+            A numpy array (of dtype object) with one value per given event
+        """
+        column = numpy.empty(len(givenEvents), dtype=object)
+        for anEvent, indices in _groupIndices(givenEvents):
+            column[indices] = _generateSubset(self._options[anEvent], indices)
+        return column
             
 
 class archivedOptionGenerator(optionGenerator):
@@ -420,6 +835,65 @@ class archivedOptionGenerator(optionGenerator):
         else:
             self._options = map(lambda x:(1.0 / self._Noptions, constantGenerator(x.replace("\n",""))),self._options)
             
+class aliasGenerator(randomDataGenerator):
+    """Defines a generator that draws values from a discrete distribution via an alias table
+    
+    Every value is drawn with a single uniform random number, in constant time, 
+    regardless of the number of values (Vose's alias method).
+    
+    Example:
+        P = aliasGenerator(["Male", "Female"], [0.2, 0.8])
+        
+    aliasGenerators are usually built by enumeration.tabulateDistributions, 
+    which replaces whole (finite) generator trees by the table of their outputs.
+    """
+    def __init__(self, theValues, theProbabilities):
+        """Instantiates the aliasGenerator
+        
+        Args:
+            theValues: A list of values (literals)
+            theProbabilities: A list of the probabilities of the values (they are normalised to add up to one)
+            
+        Returns:
+            Nothing
+        """
+        super(aliasGenerator,self).__init__()
+        if not len(theValues) or len(theValues) != len(theProbabilities):
+            raise ValueError("An aliasGenerator requires one probability per value and at least one value")
+        probabilities = numpy.asarray(theProbabilities, dtype=numpy.float64)
+        if (probabilities < 0).any() or probabilities.sum() <= 0:
+            raise ValueError("The probabilities of an aliasGenerator must be non negative and not all zero")
+        self._values = _toColumn(list(theValues))
+        self._probabilities = probabilities / probabilities.sum()
+        N = len(self._values)
+        #Each column k of the table holds value k with probability _accept[k] and value _alias[k] otherwise
+        scaled = self._probabilities * N
+        self._accept = numpy.ones(N)
+        self._alias = numpy.arange(N)
+        small = [k for k in xrange(N) if scaled[k] < 1.0]
+        large = [k for k in xrange(N) if scaled[k] >= 1.0]
+        while small and large:
+            aSmall, aLarge = small.pop(), large.pop()
+            self._accept[aSmall] = scaled[aSmall]
+            self._alias[aSmall] = aLarge
+            scaled[aLarge] -= 1.0 - scaled[aSmall]
+            (small if scaled[aLarge] < 1.0 else large).append(aLarge)
+        
+    @property
+    def distribution(self):
+        """Returns the list of (value, probability) pairs of the generator"""
+        return zip(self._values.tolist(), self._probabilities.tolist())
+        
+    def __call__(self):
+        u = _random().random() * len(self._values)
+        k = min(int(u), len(self._values) - 1)
+        return self._values[k] if u - k < self._accept[k] else self._values[self._alias[k]]
+        
+    def generateBatch(self, N):
+        u = _numpyRandom().random_sample(N) * len(self._values)
+        k = numpy.minimum(u.astype(numpy.int64), len(self._values) - 1)
+        return self._values[numpy.where(u - k < self._accept[k], k, self._alias[k])]
+        
 class revRegexGenerator(randomDataGenerator):
     """Defines a reverse regular expression generator
     
@@ -437,21 +911,59 @@ class revRegexGenerator(randomDataGenerator):
     WARNING!!!
         If you P = revRegexGenerator("[0-9]*"), you are on your own.
     """
-    def __init__(self,revRegex):
+    def __init__(self,revRegex, unique = False, key = None):
         """Instantiates the generator with a regex that is used to generate the string
         
         Args:
             revRegex: A string with the regular expression definition
+            unique: A boolean, whether the generator never returns the same string twice (please see uniquevalues.uniqueSequence).
+                    This requires an expression of fixed structure (literals, character sets, groups and repetitions of a fixed count).
+            key: An integer, the key of the order of the unique strings (or None to draw one from the random module)
         
         Returns:
             Nothing
         """
         super(revRegexGenerator,self).__init__()
         self._xeger = revRegex
+        self._parsed = sre_parse.parse(revRegex)
+        self._batchXegerable = _isBatchXegerable(self._parsed)
+        self._alphabets = _fixedAlphabets(self._parsed)
+        self._unique = None
+        if unique:
+            if self._alphabets is None:
+                raise ValueError("Unique strings require a regular expression of fixed structure, %s is not" % revRegex)
+            self._unique = uniqueSequence(self._alphabets, key if key is not None else random.getrandbits(62))
+        
+    @property
+    def cardinality(self):
+        """Returns the number of distinct strings that the expression matches (or None if it does not have a fixed structure)"""
+        if self._alphabets is None:
+            return None
+        return reduce(lambda x, y:x * y, [len(set(anAlphabet)) for anAlphabet in self._alphabets], 1)
+        
+    @property
+    def unique(self):
+        """Returns whether the generator never returns the same string twice"""
+        return self._unique is not None
         
     def __call__(self):
         """Evaluates the output of the generator"""
-        return rstr.xeger(self._xeger)
+        if self._unique is not None:
+            return self._unique.take(1)[0]
+        return _rstr().xeger(self._xeger)
+        
+    def generateBatch(self, N):
+        """Evaluates the generator N times
+        
+        Expressions made up of literals, character sets, groups, alternatives 
+        and repetitions are evaluated with numpy, one construct at a time for 
+        all N strings. Any other expression is evaluated via rstr, string by string.
+        """
+        if self._unique is not None:
+            return self._unique.take(N)
+        if not self._batchXegerable:
+            return super(revRegexGenerator, self).generateBatch(N)
+        return _batchXeger(self._parsed, N)
         
 class uidGenerator(randomDataGenerator):
     """Defines a randomDataGenerator that returns Universal Unique IDentifiers (UUID)
@@ -468,7 +980,19 @@ class uidGenerator(randomDataGenerator):
         super(uidGenerator,self).__init__()
         
     def __call__(self):
-        return str(uuid.uuid4())
+        #The identifier is drawn from the random module so that it can be reproduced by seeding it
+        return str(uuid.UUID(int = _random().getrandbits(128), version = 4))
+        
+    def generateBatch(self, N):
+        """Generates N UUIDs at once, from numpy.random"""
+        hexDigits = _numpyRandom().randint(0, 16, (N, 32))
+        #Version 4, variant RFC 4122
+        hexDigits[:, 12] = 4
+        hexDigits[:, 16] = 8 + (hexDigits[:, 16] & 3)
+        chars = numpy.empty((N, 36), dtype="U1")
+        chars.fill(u"-")
+        chars[:, [k for k in xrange(36) if k not in (8, 13, 18, 23)]] = numpy.array(list(u"0123456789abcdef"))[hexDigits]
+        return _charMatrixToStrings(chars)
         
 class seqGenerator(randomDataGenerator):
     """Defines a randomDataGenerator to generate sequences of characters
@@ -481,12 +1005,14 @@ class seqGenerator(randomDataGenerator):
         
         This will generate sequences of A-T characters which are 12 characters long.
     """
-    def __init__(self, setOfChars, maxNum=1):
+    def __init__(self, setOfChars, maxNum=1, unique=False, key=None):
         """Instantiates the seqGenerator
         
         Args:
             setOfChars: A string with all the possible characters in the sequence
             maxNum: An integer describing the number of chars in the sequence
+            unique: A boolean, whether the generator never returns the same sequence twice (please see uniquevalues.uniqueSequence)
+            key: An integer, the key of the order of the unique sequences (or None to draw one from the random module)
             
         Returns:
             Nothing
@@ -494,9 +1020,29 @@ class seqGenerator(randomDataGenerator):
         super(seqGenerator,self).__init__()
         self._theSetOfChars = setOfChars
         self._maxNum = maxNum
+        self._unique = uniqueSequence([unicode(setOfChars)] * maxNum, key if key is not None else random.getrandbits(62)) if unique else None
+        
+    @property
+    def cardinality(self):
+        """Returns the number of distinct sequences"""
+        return len(set(self._theSetOfChars)) ** self._maxNum
+        
+    @property
+    def unique(self):
+        """Returns whether the generator never returns the same sequence twice"""
+        return self._unique is not None
         
     def __call__(self):
-        return rstr.rstr(self._theSetOfChars,self._maxNum)
+        if self._unique is not None:
+            return self._unique.take(1)[0]
+        return _rstr().rstr(self._theSetOfChars,self._maxNum)
+        
+    def generateBatch(self, N):
+        """Generates N sequences at once, as an N x maxNum matrix of characters"""
+        if self._unique is not None:
+            return self._unique.take(N)
+        chars = numpy.array(list(self._theSetOfChars), dtype="U1")
+        return _charMatrixToStrings(chars[_numpyRandom().randint(0, len(chars), (N, self._maxNum))])
         
         
 class dateGenerator(randomDataGenerator):
@@ -528,4 +1074,513 @@ class dateGenerator(randomDataGenerator):
         self._dateDiffSeconds = d.days * 86400 + d.seconds        
                 
     def __call__(self):
-        return str(self._startDate + datetime.timedelta(seconds = random.randrange(self._dateDiffSeconds)))
+        return str(self._startDate + datetime.timedelta(seconds = _random().randrange(self._dateDiffSeconds)))
+        
+    def generateBatch(self, N):
+        """Generates N dates at once, with numpy
+        
+        Dates are returned as strings, formatted as the dates produced by calling the generator.
+        """
+        return _datesToStrings(numpy.datetime64(self._startDate, "us") + _numpyRandom().randint(0, self._dateDiffSeconds, N).astype("timedelta64[s]"))
+        
+class dateTimelineGenerator(randomDataGenerator):
+    """Defines a generator of timelines of dates, sorted in ascending order, between two dates
+    
+    A timeline is a list of dates of events (e.g. the dates of the 
+    primary care events of a person). Its start date, end date and number 
+    of events can be fixed or be given by other generators, for example 
+    varRefGenerators of fields of the same record (e.g. the DOB of a 
+    person), in which case every record has a timeline of its own.
+    
+    Examples:
+        P = dateTimelineGenerator(varRefGenerator("DOB"), datetime.datetime.now(), 20)
+        
+        This will generate 20 dates between the date of birth (in the 
+        same record) of a person and today, in ascending order.
+        
+    Dates are produced already sorted, as the cumulative sums of 
+    exponentially distributed spacings (the order statistics of uniformly 
+    distributed dates), rather than by sorting each timeline. In batch mode 
+    (please see generateTimelines), the timelines of all records are 
+    generated at once and returned as a flat table of events with offsets.
+    """
+    def __init__(self, dateStart, dateEnd, numEvents):
+        """Instantiates the timeline generator
+        
+        Args:
+            dateStart, dateEnd: datetime objects, date strings or randomDataGenerators of either, describing the date interval of each timeline
+            numEvents: An integer or a randomDataGenerator of integers, describing the number of events of each timeline
+            
+        Returns:
+            Nothing
+        """
+        super(dateTimelineGenerator, self).__init__()
+        self._dateStart = dateStart if isinstance(dateStart, randomDataGenerator) else constantGenerator(dateStart)
+        self._dateEnd = dateEnd if isinstance(dateEnd, randomDataGenerator) else constantGenerator(dateEnd)
+        self._numEvents = numEvents if isinstance(numEvents, randomDataGenerator) else constantGenerator(numEvents)
+        
+    def __call__(self):
+        """Generates a timeline as a list of date strings"""
+        dateStart, dateEnd = _toDatetime64([self._dateStart(), self._dateEnd()])
+        K = self._numEvents()
+        spacings = numpy.cumsum([_random().expovariate(1.0) for k in xrange(K + 1)])
+        offsets = numpy.floor(spacings[:-1] / spacings[-1] * ((dateEnd - dateStart) / numpy.timedelta64(1, "s")))
+        return list(_datesToStrings(dateStart + offsets.astype("timedelta64[s]")))
+        
+    def generateTimelines(self, N, typed = False):
+        """Generates N timelines at once, as a flat table of events
+        
+        Args:
+            N: An integer, the number of timelines to generate
+            typed: A boolean, whether dates are returned as numpy datetime64 values rather than strings
+            
+        Returns:
+            A records.childTable with one group of rows per timeline and 
+            a single column, EVENT_DATE. The dates of timeline k are the 
+            rows offsets[k]:offsets[k+1] of the table.
+        """
+        dateStart = _toDatetime64(self._dateStart.generateBatch(N))
+        spanSeconds = (_toDatetime64(self._dateEnd.generateBatch(N)) - dateStart) / numpy.timedelta64(1, "s")
+        K = numpy.asarray(self._numEvents.generateBatch(N), dtype = numpy.int64)
+        #Each timeline draws K+1 spacings. The last one closes the timeline and is not a date.
+        groupEnds = numpy.cumsum(K + 1)
+        spacings = numpy.cumsum(_numpyRandom().standard_exponential(groupEnds[-1] if N else 0))
+        totals = spacings[groupEnds - 1]
+        bases = numpy.concatenate([[0.0], totals])[:-1]
+        isDate = numpy.ones(len(spacings), dtype=bool)
+        isDate[groupEnds - 1] = False
+        fractions = (spacings[isDate] - numpy.repeat(bases, K)) / numpy.repeat(totals - bases, K)
+        dates = numpy.repeat(dateStart, K) + numpy.floor(fractions * numpy.repeat(spanSeconds, K)).astype("timedelta64[s]")
+        return childTable(recordTable({"EVENT_DATE":dates if typed else _datesToStrings(dates)}), numpy.concatenate([[0], numpy.cumsum(K)]))
+        
+    def generateBatch(self, N):
+        """Generates N timelines, each as a numpy array of date strings (please see generateTimelines)"""
+        timelines = self.generateTimelines(N)
+        dates, offsets = timelines.rows.columns["EVENT_DATE"], timelines.offsets
+        return _toColumn([dates[offsets[k]:offsets[k + 1]] for k in xrange(N)])
+
+class pooledGenerator(randomDataGenerator):
+    """Defines a generator that samples the values of another generator from a pool
+    
+    The pool is filled once, in batch mode, upon first use and values are 
+    then looked up from it, which is as fast as an optionGenerator of 
+    literals no matter how expensive the pooled generator is. Values are 
+    therefore reused and the level of reuse is controlled by the size of the 
+    pool, the sampling (with replacement or by shuffled passes over the pool) 
+    and the refresh of the pool, which regenerates a fraction of its values 
+    every so many values drawn.
+    
+    Example:
+        P = revRegexGenerator("(Mr|Mrs|Ms|Dr) [A-Z][a-z]{3,8}").pooled(10000, refreshEvery = 100000)
+        
+    Please note:
+        The pooled generator is evaluated for the pool, not for each record, 
+        so it cannot refer to other fields (via varRefGenerator).
+    """
+    def __init__(self, theGenerator, poolSize, replace = True, refreshEvery = None, refreshFraction = 0.1):
+        """Instantiates the pooledGenerator
+        
+        Args:
+            theGenerator: The randomDataGenerator whose values are pooled
+            poolSize: An integer, the number of values in the pool
+            replace: A boolean, whether values are drawn with replacement. Otherwise, values 
+                     are drawn in shuffled passes over the pool, each value once per pass.
+            refreshEvery: An integer, the number of values drawn between refreshes of the pool (or None to never refresh)
+            refreshFraction: A real number, the fraction of the values of the pool that are evicted and regenerated at every refresh
+            
+        Returns:
+            Nothing
+        """
+        super(pooledGenerator,self).__init__()
+        if _referencedNames(theGenerator):
+            raise ValueError("A pooled generator cannot refer to other fields")
+        if poolSize < 1:
+            raise ValueError("A pool must hold at least one value")
+        self._generator = theGenerator
+        self._poolSize = poolSize
+        self._replace = replace
+        self._refreshEvery = refreshEvery
+        self._refreshSize = max(int(round(refreshFraction * poolSize)), 1) if refreshEvery else 0
+        self._pool = None
+        self._order = None
+        self._cursor = 0
+        self._untilRefresh = refreshEvery
+        self.setVarName(theGenerator.name)
+        
+    @property
+    def pool(self):
+        """Returns the pool of values (a numpy array of dtype object), filling it if it is empty"""
+        if self._pool is None:
+            self._pool = self._generator.generateBatch(self._poolSize)
+        return self._pool
+        
+    def refresh(self, N = None):
+        """Evicts N values (by default, the refresh fraction of the pool) at random and regenerates them"""
+        N = min(N if N is not None else self._refreshSize, self._poolSize)
+        self.pool[_numpyRandom().choice(self._poolSize, N, replace = False)] = self._generator.generateBatch(N)
+        
+    def _indices(self, N):
+        """Returns the indices of the next N values of the pool (that are drawn before the next refresh)"""
+        if self._replace:
+            return _numpyRandom().randint(0, self._poolSize, N)
+        indices = []
+        while N:
+            if self._order is None or self._cursor == self._poolSize:
+                self._order = _numpyRandom().permutation(self._poolSize)
+                self._cursor = 0
+            taken = min(N, self._poolSize - self._cursor)
+            indices.append(self._order[self._cursor:self._cursor + taken])
+            self._cursor += taken
+            N -= taken
+        return numpy.concatenate(indices) if len(indices) != 1 else indices[0]
+        
+    def _scalarStreams(self):
+        """Returns the streams that the pool is filled and refreshed from in scalar mode, seeded by _random()"""
+        return _fieldStreams(_random().getrandbits(64), 0)
+        
+    def __call__(self):
+        """Looks up a value from the pool
+        
+        Like every other scalar generator, this draws from _random() (and fills or refreshes the 
+        pool within streams seeded by it), so seeding the random module reproduces its values.
+        """
+        if self._pool is None:
+            with self._scalarStreams():
+                self.pool
+        if self._replace:
+            k = _random().randrange(self._poolSize)
+        else:
+            if self._order is None or self._cursor == self._poolSize:
+                order = range(self._poolSize)
+                _random().shuffle(order)
+                self._order = numpy.array(order)
+                self._cursor = 0
+            k = self._order[self._cursor]
+            self._cursor += 1
+        aValue = self._pool[k]
+        if self._refreshEvery:
+            self._untilRefresh -= 1
+            if not self._untilRefresh:
+                with self._scalarStreams():
+                    self.refresh()
+                self._untilRefresh = self._refreshEvery
+        return aValue
+        
+    def generateBatch(self, N):
+        """Looks up N values from the pool, refreshing it on the way as required"""
+        pool = self.pool
+        if not self._refreshEvery:
+            return pool[self._indices(N)]
+        column = numpy.empty(N, dtype=object)
+        done = 0
+        while done < N:
+            taken = min(N - done, self._untilRefresh)
+            column[done:done + taken] = pool[self._indices(taken)]
+            done += taken
+            self._untilRefresh -= taken
+            if not self._untilRefresh:
+                self.refresh()
+                self._untilRefresh = self._refreshEvery
+        return column
+        
+class rowContext(object):
+    """Defines the context within which the named generators of a record are evaluated
+    
+    A rowContext holds the values of the named generators of the row that is 
+    currently being generated, so that other generators of the same row can 
+    refer to them (please see varRefGenerator) rather than having them passed 
+    around by hand.
+    
+    In batch mode, a rowContext holds whole columns of values instead and, 
+    while a subset of the rows of a batch is being generated (e.g. the rows 
+    that picked a specific event of an optionGenerator), references 
+    return the values of that subset only.
+    
+    rowContexts are activated with the "with" statement and are specific to 
+    the thread that activated them. They are managed by recordGenerator 
+    and are not expected to be instantiated directly.
+    """
+    def __init__(self):
+        """Instantiates an empty rowContext"""
+        self._values = {}
+        self._selections = []
+        
+    def __enter__(self):
+        try:
+            _activeContexts.stack.append(self)
+        except AttributeError:
+            _activeContexts.stack = [self]
+        return self
+        
+    def __exit__(self, excType, excValue, traceback):
+        _activeContexts.stack.pop()
+        
+    def setValue(self, theName, theValue):
+        """Records the value (or column of values in batch mode) of a named generator"""
+        self._values[theName] = theValue
+        
+    def valueOf(self, theName):
+        """Returns the value (or column of values of the current selection in batch mode) of a named generator
+        
+        Args:
+            theName: A string, the name of a generator that has been evaluated within this context
+            
+        Returns:
+            The value of the generator
+        """
+        try:
+            theValue = self._values[theName]
+        except KeyError:
+            raise KeyError("Variable %s has not been evaluated in this row" % theName)
+        if self._selections:
+            return theValue[self._selections[-1]]
+        return theValue
+        
+    def pushSelection(self, indices):
+        """Restricts the context to a subset of the rows of the current selection
+        
+        Args:
+            indices: A numpy array of row positions, relative to the current selection.
+        """
+        if self._selections:
+            indices = self._selections[-1][indices]
+        self._selections.append(indices)
+        
+    def popSelection(self):
+        """Restores the selection that was active before the last call to pushSelection"""
+        self._selections.pop()
+        
+class varRefGenerator(randomDataGenerator):
+    """Defines a generator that returns the value of another named generator of the same row
+    
+    A varRefGenerator makes the value of a named generator (please see 
+    setVarName) available to any other generator of a record, without 
+    evaluating it again.
+    
+    Example:
+        G = optionGenerator(["male", "female"]).setVarName("Gender")
+        N = (condProbOptionGenerator({"male":optionGenerator(maleNames), "female":optionGenerator(femaleNames)}) | varRefGenerator("Gender")).setVarName("Name")
+        R = recordGenerator([N, G])
+        
+        Upon successive calls, R will be returning records with a Gender 
+        and a Name that is conditioned on that (same) Gender.
+        
+    Please note:
+        A varRefGenerator can only be evaluated as part of a recordGenerator
+    """
+    def __init__(self, theName):
+        """Instantiates the varRefGenerator
+        
+        Args:
+            theName: A string, the name of the generator whose value is returned
+            
+        Returns:
+            Nothing
+        """
+        super(varRefGenerator, self).__init__()
+        self._refName = theName
+        
+    @property
+    def refName(self):
+        """Returns the name of the generator that this generator refers to"""
+        return self._refName
+        
+    def __call__(self):
+        context = _activeContext()
+        if context is None:
+            raise RuntimeError("Variable %s can only be referenced within a recordGenerator" % self._refName)
+        return context.valueOf(self._refName)
+        
+    def generateBatch(self, N):
+        return self()
+        
+class recordGenerator(randomDataGenerator):
+    """Defines a generator of records whose fields are named generators
+    
+    A recordGenerator evaluates each of its fields exactly once per record 
+    and returns them as a Bunch keyed by the name of each field. Fields can 
+    refer to the values of other fields of the same record through 
+    varRefGenerators. The order of evaluation is resolved from these 
+    references, so that every field is evaluated after the fields it refers to.
+    
+    Example:
+        G = optionGenerator(["male", "female"]).setVarName("Gender")
+        N = (condProbOptionGenerator({"male":optionGenerator(maleNames), "female":optionGenerator(femaleNames)}) | varRefGenerator("Gender")).setVarName("Name")
+        R = recordGenerator([N, G])
+        
+        R() returns a Bunch with fields Name and Gender, where Gender is 
+        evaluated first and exactly once.
+        
+    In batch mode (please see generateColumns), each field is evaluated once 
+    for the whole batch and referenced columns are shared by all the 
+    fields that refer to them.
+    
+    A recordGenerator can be restricted to a subset of its fields (please see 
+    project). Fields that are not requested, and are not referred to by 
+    requested fields, are not evaluated at all. Each field draws its random 
+    numbers from its own substream of a seed that is drawn once per record 
+    (or batch), so that the values of the requested fields are identical 
+    to those of a generation of all fields with the same seed.
+    
+    Fields can also refer to inputs, columns that are provided by the caller 
+    of generateColumns rather than generated by the record itself (e.g. the 
+    columns of a parent table, please see relational.dependentTable).
+    
+    Records are returned as Bunches by default or, if compact is set, as 
+    slot based compactRecords with the same attribute access (please see 
+    records.recordType). generateTable returns a batch of records as a 
+    columnar records.recordTable.
+    
+    Please note:
+        The seed of a record (or batch) is drawn from the random module, so 
+        the sequence of records is reproducible via random.seed. The fields 
+        draw from their own streams, so generating a record neither reseeds 
+        the random and numpy.random modules nor draws from them otherwise.
+    """
+    def __init__(self, theFields, theFieldNames = None, compact = False, theInputNames = ()):
+        """Instantiates the recordGenerator
+        
+        Args:
+            theFields: A list of named randomDataGenerators
+            theFieldNames: A list of the names of the fields to generate (or None for all fields)
+            compact: A boolean, whether records are returned as compactRecords rather than Bunches
+            theInputNames: A list of the names of the inputs that fields can refer to (please see generateColumns)
+            
+        Returns:
+            Nothing
+        """
+        super(recordGenerator, self).__init__()
+        self._fields = list(theFields)
+        self._inputNames = frozenset(theInputNames)
+        self._streamIndex = dict([(aField.name, k) for k, aField in enumerate(self._fields)])
+        self._fieldsByName = {}
+        for aField in self._fields:
+            if aField.name is None:
+                raise ValueError("All fields of a record must be named (please see setVarName)")
+            if aField.name in self._fieldsByName:
+                raise ValueError("Field %s appears more than once in the record" % aField.name)
+            self._fieldsByName[aField.name] = aField
+        self._order = self._resolveOrder()
+        if theFieldNames is None:
+            self._output = list(self._fields)
+        else:
+            unknownNames = set(theFieldNames) - set(self._fieldsByName)
+            if unknownNames:
+                raise ValueError("Unknown field(s) %s" % ", ".join(sorted(unknownNames)))
+            self._output = [aField for aField in self._fields if aField.name in theFieldNames]
+            #Only the requested fields and the fields they refer to (directly or not) are evaluated
+            required = set()
+            pending = list(theFieldNames)
+            while pending:
+                aName = pending.pop()
+                if aName not in required:
+                    required.add(aName)
+                    pending.extend(self._dependencies[aName])
+            self._order = [aField for aField in self._order if aField.name in required]
+        self._compact = compact
+        self._recordClass = recordType(self.fieldNames) if compact else None
+        
+    @property
+    def fieldNames(self):
+        """Returns the names of the fields that the record is made up of, in order of declaration"""
+        return [aField.name for aField in self._output]
+        
+    @property
+    def fields(self):
+        """Returns the named generators that the record is made up of, in order of declaration"""
+        return list(self._output)
+        
+    @property
+    def inputNames(self):
+        """Returns the names of the inputs that the fields of the record can refer to"""
+        return self._inputNames
+        
+    def project(self, theFieldNames):
+        """Returns a recordGenerator that generates only some of the fields of this one
+        
+        Args:
+            theFieldNames: A list of the names of the fields to generate
+            
+        Returns:
+            A recordGenerator whose records agree with those of this 
+            recordGenerator, for the same seed, on the requested fields.
+        """
+        return recordGenerator(self._fields, theFieldNames, self._compact, self._inputNames)
+        
+    def _resolveOrder(self):
+        """Returns the fields in an order in which every field follows the fields it refers to
+        
+        The references between fields are treated as a directed acyclic graph 
+        which is sorted topologically. Ties are resolved by order of declaration.
+        """
+        dependencies = {}
+        for aField in self._fields:
+            dependencies[aField.name] = _referencedNames(aField) - self._inputNames
+            unknownNames = dependencies[aField.name] - set(self._fieldsByName)
+            if unknownNames:
+                raise ValueError("Field %s refers to unknown field(s) %s" % (aField.name, ", ".join(sorted(unknownNames))))
+        order = []
+        resolved = set()
+        while len(order) < len(self._fields):
+            ready = [aField for aField in self._fields if aField.name not in resolved and dependencies[aField.name] <= resolved]
+            if not ready:
+                raise ValueError("Circular references between fields %s" % ", ".join(sorted(set(self._fieldsByName) - resolved)))
+            order.extend(ready)
+            resolved.update([aField.name for aField in ready])
+        self._dependencies = dependencies
+        return order
+        
+    def __call__(self):
+        """Generates a record"""
+        recordSeed = _random().getrandbits(64)
+        with rowContext() as context:
+            for aField in self._order:
+                with _fieldStreams(recordSeed, self._streamIndex[aField.name]):
+                    context.setValue(aField.name, aField())
+            if self._compact:
+                return self._recordClass(*[context.valueOf(aField.name) for aField in self._output])
+            return Bunch([(aField.name, context.valueOf(aField.name)) for aField in self._output])
+            
+    def generateColumns(self, N, theInputs = None):
+        """Generates N records in columnar form
+        
+        Args:
+            N: An integer, the number of records to generate
+            theInputs: A dict of input name:numpy array of N values, for each of the inputs of the record
+            
+        Returns:
+            A Bunch of numpy arrays, one for each field, keyed by the name of the field
+        """
+        missingInputs = self._inputNames - set(theInputs or {})
+        if missingInputs:
+            raise ValueError("Missing input(s) %s" % ", ".join(sorted(missingInputs)))
+        batchSeed = _random().getrandbits(64)
+        with rowContext() as context:
+            for anInputName, anInput in (theInputs or {}).items():
+                context.setValue(anInputName, anInput)
+            for aField in self._order:
+                with _fieldStreams(batchSeed, self._streamIndex[aField.name]):
+                    context.setValue(aField.name, aField.generateBatch(N))
+            return Bunch([(aField.name, context.valueOf(aField.name)) for aField in self._output])
+            
+    def generateTable(self, N):
+        """Generates N records as a columnar recordTable
+        
+        Fields whose values are lists of records (e.g. events) are stored 
+        as child tables (please see records.childTable).
+        
+        Args:
+            N: An integer, the number of records to generate
+            
+        Returns:
+            A records.recordTable
+        """
+        return recordTable.fromColumns(self.generateColumns(N), self.fieldNames)
+        
+    def generateBatch(self, N):
+        """Generates N records, via generateColumns"""
+        columns = self.generateColumns(N)
+        names = self.fieldNames
+        if self._compact:
+            return _toColumn([self._recordClass(*someValues) for someValues in zip(*[columns[aName] for aName in names])])
+        return _toColumn([Bunch(zip(names, someValues)) for someValues in zip(*[columns[aName] for aName in names])])
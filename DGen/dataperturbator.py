@@ -8,7 +8,12 @@ https://www.ncbi.nlm.nih.gov/books/NBK253313/
 
 Athanasios Anastasiou Sept 2016
 """
-import random
+import re
+import json
+import numpy
+from .records import _objectColumn
+from .keyedrandom import keyedRandom
+from .datagenerator import _datesToStrings, _fieldStreams, _random
 
 class dataPerturbator(object):
     """Defines the base class for all data perturbators
@@ -27,16 +32,28 @@ class dataPerturbator(object):
     So, a perturbator with a probability of 0.7 is expected to apply its
     perturbation 70% of the times it is called.
     
+    Derived perturbators implement the perturbation itself in perturb and 
+    inherit the triggering code. 
+    
+    Perturbators can also be applied to whole columns of values at once (please 
+    see perturbBatch), in which case the trigger decisions of all values are 
+    drawn at once and the perturbation is only applied to the values that 
+    triggered it. Derived perturbators can override perturbSubset to perturb 
+    these values with array operations rather than one by one.
+    
+    Perturbators can be pieced together into more complex ones (please see 
+    compositePerturbator):
+    
+        P * Q #Applies P and then Q, each with its own probability
+        P ^ Q #Applies either P or Q with equal probabilities
     """
-    #TODO: Add operator support to perturbators so that they can be pieced together into more complex ones.
-    #TODO: Add a function to the perturbator that actually performs the perturbation and call it from within __call__ to reduce having to write the triger code.
     def __init__(self, prob = 1.0):
         """Standard constructor for all data perturbators"""
         self._prob = prob
         
     @property
     def prob(self):
-        return prob
+        return self._prob
         
     @prob.setter
     def prob(self, aValue):
@@ -49,34 +66,628 @@ class dataPerturbator(object):
         """
         self._prob = aValue
         
+    @property
+    def leaves(self):
+        """Returns the elementary perturbators that this perturbator applies, in order"""
+        return [self]
+        
+    def __mul__(self, other):
+        """Instantiates a sequencePerturbator that applies this perturbator and then other"""
+        return sequencePerturbator([self, other])
+        
+    def __xor__(self, other):
+        """Instantiates an optionPerturbator that applies either this perturbator or other, with equal probabilities"""
+        return optionPerturbator([(0.5, self), (0.5, other)])
+        
+    def _fire(self):
+        """Draws whether each of the leaves of this perturbator is triggered for a single value
+        
+        Returns:
+            A list of booleans, one per leaf
+        """
+        return [_random().random() <= self._prob]
+        
+    def _fireBatch(self, N, randomState):
+        """Draws whether each of the leaves of this perturbator is triggered for N values
+        
+        Returns:
+            An N x len(leaves) boolean numpy array
+        """
+        return (randomState.random_sample(N) <= self._prob)[:, None]
+        
+    def __call__(self, aString):
+        """Applies the perturbation to aString with probability prob"""
+        if _random().random()>self._prob:
+            return aString
+        return self.perturb(aString)
+        
+    def perturb(self, aString):
+        """Applies the perturbation to aString (unconditionally)
+        
+        Perturbations draw their random numbers from _random() (rather than the random module), 
+        so that the default perturbSubset can derive them from the random state of a column.
+        
+        Args:
+            aString: The value to perturb
+            
+        Returns:
+            The perturbed value
+        """
+        raise NotImplementedError("Perturbators must define the perturbation they apply")
+        
+    @property
+    def operationNames(self):
+        """Returns the names of the operations (i.e. of the leaves) of this perturbator, as recorded by a perturbationLog"""
+        return [aLeaf.__class__.__name__ for aLeaf in self.leaves]
+        
+    @property
+    def editNames(self):
+        """Returns the names of the edits that this (elementary) perturbator tells apart in a perturbationLog (please see perturbSubset)
+        
+        The edit code of a value is its index in this list. Perturbators that apply a single kind of edit return an empty list.
+        """
+        return []
+        
+    def _perturbEdit(self, aString):
+        """Applies the perturbation to aString (unconditionally) and returns the perturbed value and the code of its edit (or -1)"""
+        return self.perturb(aString), -1
+        
+    def perturbBatch(self, theValues, randomState = None, log = False):
+        """Applies the perturbation to each of a column of values with probability prob
+        
+        The trigger decisions of all values are drawn at once and only the 
+        values that triggered the perturbation are perturbed (please see perturbSubset).
+        
+        Args:
+            theValues: A sequence (e.g. a list, numpy array or pandas Series) of values
+            randomState: A numpy.random.RandomState (or a keyedRandom) to draw random numbers from (defaults to the numpy.random module)
+            log: A boolean, whether to also return a perturbationLog of the values that were perturbed
+            
+        Returns:
+            A numpy array (of dtype object) with the (possibly) perturbed values. theValues is not modified.
+            If log is True, a tuple of the array and its perturbationLog.
+        """
+        randomState = randomState if randomState is not None else numpy.random
+        result = _valueColumn(theValues)
+        fired = numpy.flatnonzero(randomState.random_sample(len(result)) <= self._prob)
+        originals = result[fired]
+        if not log:
+            if len(fired):
+                result[fired] = self.perturbSubset(originals, _subsetState(randomState, fired, _applyLabel(0)))
+            return result
+        edits = _noEdits(0)
+        if len(fired):
+            result[fired], edits = self.perturbSubset(originals, _subsetState(randomState, fired, _applyLabel(0)), True)
+        return result, perturbationLog(len(result), fired, numpy.ones(len(fired), dtype = numpy.uint8), originals, self.operationNames,
+                                       edits[:, None], [self.editNames])
+        
+    def perturbSubset(self, theValues, randomState, withEdits = False):
+        """Applies the perturbation to every value of a column of values (unconditionally)
+        
+        The default implementation calls perturb for each value, with the random numbers of each 
+        value drawn from a stream that is seeded by a (single) draw of randomState for that value. 
+        The result therefore depends on randomState alone, just like that of the vectorised perturbators.
+        
+        Args:
+            theValues: A numpy array (of dtype object) of values that triggered the perturbation
+            randomState: A numpy.random.RandomState (or the numpy.random module) to draw random numbers from.
+                         If it is a keyedRandom, every draw must be of one random number (or one row of random numbers) per value.
+            withEdits: A boolean, whether to also return the code of the edit applied to each value (please see editNames)
+            
+        Returns:
+            A numpy array (of dtype object) with the perturbed values.
+            If withEdits is True, a tuple of the array and an integer numpy array of edit codes (-1 for perturbators without editNames).
+        """
+        seeds = (randomState.random_sample(len(theValues)) * 2**53).astype(numpy.int64)
+        perturbed = []
+        for aValue, aSeed in zip(theValues, seeds):
+            with _fieldStreams(int(aSeed), 0):
+                perturbed.append(self._perturbEdit(aValue))
+        result = _objectColumn([aValue for aValue, anEdit in perturbed])
+        if withEdits:
+            return result, numpy.array([anEdit for aValue, anEdit in perturbed], dtype = numpy.int16).reshape(len(perturbed))
+        return result
+        
+    
+class compositePerturbator(dataPerturbator):
+    """Defines the base class of perturbators that are pieced together from others
+    
+    A compositePerturbator is compiled, once, into the flat list of the elementary 
+    perturbators (its leaves) that it applies in order. When it is evaluated, the 
+    trigger decisions of all of its leaves are drawn first and only the leaves 
+    that were triggered are then applied, without going through the trigger code 
+    of each of the member perturbators. In batch mode, each leaf perturbs the 
+    values it was triggered for, at once (please see dataPerturbator.perturbSubset), 
+    so that values that are not perturbed are never copied.
+    
+    Derived classes define how the trigger decisions of their members are drawn.
+    
+    Please note, this class is not supposed to be initialised directly.
+    """
+    def __init__(self, thePerturbators, prob = 1.0):
+        """Instantiates the compositePerturbator
+        
+        Args:
+            thePerturbators: A list of dataPerturbators
+            prob           : A Real number representing the probability of triggering this perturbator
+        Returns:
+            Nothing
+        """
+        super(compositePerturbator, self).__init__(prob)
+        if not thePerturbators:
+            raise ValueError("A compositePerturbator requires at least one perturbator")
+        self._perturbators = list(thePerturbators)
+        self._leaves = [aLeaf for aPerturbator in self._perturbators for aLeaf in aPerturbator.leaves]
+        
+    @property
+    def perturbators(self):
+        return self._perturbators
+        
+    @property
+    def leaves(self):
+        return self._leaves
+        
+    def _fireMembers(self):
+        """Draws whether each of the leaves is triggered for a single value, given that this perturbator is triggered"""
+        raise NotImplementedError("compositePerturbators must define how their members are triggered")
+        
+    def _fireMembersBatch(self, N, randomState):
+        """Draws whether each of the leaves is triggered for N values, given that this perturbator is triggered"""
+        raise NotImplementedError("compositePerturbators must define how their members are triggered")
+        
+    def _fire(self):
+        if _random().random() > self._prob:
+            return [False] * len(self._leaves)
+        return self._fireMembers()
+        
+    def _fireBatch(self, N, randomState):
+        fired = self._fireMembersBatch(N, randomState)
+        fired &= (randomState.random_sample(N) <= self._prob)[:, None]
+        return fired
+        
+    def _apply(self, aString, theFired):
+        """Applies the leaves that were triggered to aString"""
+        for aLeaf, isFired in zip(self._leaves, theFired):
+            if isFired:
+                aString = aLeaf.perturb(aString)
+        return aString
+        
+    def _applyBatch(self, theValues, theFired, randomState, theEdits = None):
+        """Applies each leaf to the values it was triggered for (theValues, and theEdits if given, are modified in place)
+        
+        theEdits is an N x len(leaves) integer numpy array that receives the edit code of each leaf that is applied to each value.
+        """
+        for k, aLeaf in enumerate(self._leaves):
+            rows = numpy.flatnonzero(theFired[:, k])
+            if len(rows):
+                if theEdits is None:
+                    theValues[rows] = aLeaf.perturbSubset(theValues[rows], _subsetState(randomState, rows, _applyLabel(k)))
+                else:
+                    theValues[rows], theEdits[rows, k] = aLeaf.perturbSubset(theValues[rows], _subsetState(randomState, rows, _applyLabel(k)), True)
+        return theValues
+        
+    def __call__(self, aString):
+        return self._apply(aString, self._fire())
+        
+    def perturb(self, aString):
+        return self._apply(aString, self._fireMembers())
+        
+    def perturbBatch(self, theValues, randomState = None, log = False):
+        randomState = randomState if randomState is not None else numpy.random
+        result = _valueColumn(theValues)
+        fired = self._fireBatch(len(result), randomState)
+        if not log:
+            return self._applyBatch(result, fired, randomState)
+        rows = numpy.flatnonzero(fired.any(axis = 1))
+        originals = result[rows]
+        edits = numpy.full(fired.shape, -1, dtype = numpy.int16)
+        result = self._applyBatch(result, fired, randomState, edits)
+        return result, perturbationLog(len(result), rows, _operationCodes(fired[rows]), originals, self.operationNames,
+                                       edits[rows], [aLeaf.editNames for aLeaf in self._leaves])
+        
+    def perturbSubset(self, theValues, randomState, withEdits = False):
+        result = self._applyBatch(theValues.copy(), self._fireMembersBatch(len(theValues), randomState), randomState)
+        if withEdits:
+            #The edits of a composite are only told apart per leaf (please see perturbBatch)
+            return result, _noEdits(len(result))
+        return result
+        
+class sequencePerturbator(compositePerturbator):
+    """Defines a perturbator that applies a sequence of perturbators, one after the other
+    
+    Each perturbator of the sequence is triggered independently, with its own probability.
+    
+    Example:
+        P = missingDataPerturbator("-", prob = 0.1) * punctuationPerturbator(prob = 0.2)
+        P = sequencePerturbator([subsPerturbator([("Street", "St.")]), punctuationPerturbator(), missingDataPerturbator("-", prob = 0.1)])
+    """
+    def __init__(self, thePerturbators, prob = 1.0):
+        """Instantiates the sequencePerturbator
+        
+        Args:
+            thePerturbators: A list of dataPerturbators, in the order they are applied
+            prob           : A Real number representing the probability of triggering this perturbator
+        Returns:
+            Nothing
+        """
+        super(sequencePerturbator, self).__init__(thePerturbators, prob)
+        #A sequence of elementary perturbators is applied by a single loop over its leaves
+        self._isFlat = not any([isinstance(aPerturbator, compositePerturbator) for aPerturbator in self._perturbators])
+        
+    def __mul__(self, other):
+        """Extends the sequence with one more perturbator"""
+        if self._prob < 1.0:
+            return sequencePerturbator([self, other])
+        return sequencePerturbator(self._perturbators + [other])
+        
+    def __call__(self, aString):
+        if not self._isFlat:
+            return super(sequencePerturbator, self).__call__(aString)
+        if _random().random() > self._prob:
+            return aString
+        return self.perturb(aString)
+        
+    def perturb(self, aString):
+        if not self._isFlat:
+            return super(sequencePerturbator, self).perturb(aString)
+        for aLeaf in self._leaves:
+            if _random().random() <= aLeaf._prob:
+                aString = aLeaf.perturb(aString)
+        return aString
+        
+    def _fireMembers(self):
+        return [isFired for aPerturbator in self._perturbators for isFired in aPerturbator._fire()]
+        
+    def _fireMembersBatch(self, N, randomState):
+        return numpy.hstack([aPerturbator._fireBatch(N, randomState) for aPerturbator in self._perturbators])
+        
+class optionPerturbator(compositePerturbator):
+    """Defines a perturbator that applies one of a list of perturbators, picked at random
+    
+    Similarly to optionGenerator, the perturbators can be picked with equal or varying probabilities. 
+    The perturbator that is picked is then triggered with its own probability.
+    
+    Example:
+        P = punctuationPerturbator(prob = 1.0) ^ missingDataPerturbator("-", prob = 1.0)
+        P = optionPerturbator([(0.9, punctuationPerturbator(prob = 1.0)), (0.1, missingDataPerturbator("-", prob = 1.0))], prob = 0.3)
+    """
+    def __init__(self, theOptions, prob = 1.0):
+        """Instantiates the optionPerturbator
+        
+        Args:
+            theOptions: A list of dataPerturbators or a list of (prob, dataPerturbator) tuples
+            prob      : A Real number representing the probability of triggering this perturbator
+        Returns:
+            Nothing
+        """
+        if theOptions and not isinstance(theOptions[0], tuple):
+            theOptions = [(1.0 / len(theOptions), x) for x in theOptions]
+        super(optionPerturbator, self).__init__([anOption[1] for anOption in theOptions], prob)
+        self._cumulativeProbs = numpy.cumsum([anOption[0] for anOption in theOptions])
+        #The columns of the leaves of each option
+        self._leafOffsets = numpy.cumsum([0] + [len(aPerturbator.leaves) for aPerturbator in self._perturbators])
+        
+    def _pick(self, v):
+        return numpy.minimum(numpy.searchsorted(self._cumulativeProbs, v, side = "right"), len(self._perturbators) - 1)
+        
+    def _fireMembers(self):
+        k = int(self._pick(_random().random()))
+        return [False] * self._leafOffsets[k] + self._perturbators[k]._fire() + [False] * (self._leafOffsets[-1] - self._leafOffsets[k + 1])
+        
+    def _fireMembersBatch(self, N, randomState):
+        choices = self._pick(randomState.random_sample(N))
+        fired = numpy.zeros((N, self._leafOffsets[-1]), dtype = bool)
+        for k, aPerturbator in enumerate(self._perturbators):
+            rows = numpy.flatnonzero(choices == k)
+            if len(rows):
+                fired[rows, self._leafOffsets[k]:self._leafOffsets[k + 1]] = aPerturbator._fireBatch(len(rows), _subsetState(randomState, rows, _fireLabel(k)))
+        return fired
+        
+class atMostPerturbator(compositePerturbator):
+    """Defines a perturbator that applies at most k of a list of perturbators
+    
+    Each perturbator of the list is triggered independently, with its own probability, 
+    but if more than k of them are triggered for a value, only k of them, picked at 
+    random, are applied (in order).
+    
+    Example:
+        P = atMostPerturbator([punctuationPerturbator(prob = 0.3), subsPerturbator([("Street", "St.")], prob = 0.5), missingDataPerturbator("-", prob = 0.1)], 1)
+    """
+    def __init__(self, thePerturbators, k, prob = 1.0):
+        """Instantiates the atMostPerturbator
+        
+        Args:
+            thePerturbators: A list of dataPerturbators
+            k              : An integer, the maximum number of perturbators applied to a value
+            prob           : A Real number representing the probability of triggering this perturbator
+        Returns:
+            Nothing
+        """
+        super(atMostPerturbator, self).__init__(thePerturbators, prob)
+        self._k = k
+        self._leafOffsets = numpy.cumsum([0] + [len(aPerturbator.leaves) for aPerturbator in self._perturbators])
+        
+    @property
+    def k(self):
+        return self._k
+        
+    def _fireMembers(self):
+        fired = [aPerturbator._fire() for aPerturbator in self._perturbators]
+        triggered = [k for k, someFired in enumerate(fired) if any(someFired)]
+        if len(triggered) > self._k:
+            for k in _random().sample(triggered, len(triggered) - self._k):
+                fired[k] = [False] * len(fired[k])
+        return [isFired for someFired in fired for isFired in someFired]
+        
+    def _fireMembersBatch(self, N, randomState):
+        fired = numpy.hstack([aPerturbator._fireBatch(N, randomState) for aPerturbator in self._perturbators])
+        triggered = numpy.logical_or.reduceat(fired, self._leafOffsets[:-1], axis = 1)
+        overflow = numpy.flatnonzero(triggered.sum(axis = 1) > self._k)
+        if len(overflow):
+            #Random keys, with the perturbators that were not triggered last, ranked per value
+            keys = numpy.where(triggered[overflow], _subsetState(randomState, overflow, "drop").random_sample((len(overflow), len(self._perturbators))), 2.0)
+            dropped = numpy.argsort(numpy.argsort(keys, axis = 1), axis = 1) >= self._k
+            fired[overflow] &= ~numpy.repeat(dropped, numpy.diff(self._leafOffsets), axis = 1)
+        return fired
+        
+class perturbationLog(object):
+    """Defines the record of the perturbation of a column of values
+    
+    A perturbationLog records which values of a column were perturbed (as a bitmap), 
+    by which operations and what their original values were. Only the values that 
+    were perturbed are stored.
+    
+    The operations of a value are recorded as a code whose bit k is set if the k-th 
+    leaf of the perturbator was triggered (please see dataPerturbator.operationNames). 
+    For elementary perturbators, the code is always 1.
+    
+    The edit that each leaf applied to a value is recorded as well, as an index into 
+    the editNames of the leaf (e.g. whether a letter was erased, swapped or changed, or 
+    which prefix was prepended), or -1 if the leaf was not triggered or does not tell 
+    its edits apart (please see dataPerturbator.editNames).
     
+    Example:
+        P = punctuationPerturbator(prob = 0.3) * missingDataPerturbator("-", prob = 0.1)
+        Q, L = P.perturbBatch(aColumn, log = True)
+        L.rows, L.operationsOf(L.rows[0]), L.originals
+    """
+    def __init__(self, N, theRows, theCodes, theOriginals, theOperationNames, theEdits = None, theEditNames = None):
+        """Instantiates a perturbationLog
+        
+        Args:
+            N: An integer, the number of values of the column
+            theRows: An integer numpy array of the (ascending) indices of the values that were perturbed
+            theCodes: An unsigned integer numpy array, the code of the operations applied to each perturbed value
+            theOriginals: A numpy array (of dtype object), the original value of each perturbed value
+            theOperationNames: A list of the names of the operations
+            theEdits: An integer numpy array with one row per perturbed value and one column per operation, 
+                      the code of the edit that each operation applied (or None if no edits were recorded)
+            theEditNames: A list of the lists of the names of the edits of each operation (or None)
+        
+        Returns:
+            Nothing
+        """
+        isFired = numpy.zeros(N, dtype = bool)
+        isFired[theRows] = True
+        self._N = N
+        self._bitmap = numpy.packbits(isFired)
+        self._codes = numpy.asarray(theCodes)
+        self._originals = theOriginals
+        self._operationNames = list(theOperationNames)
+        if theEdits is None:
+            theEdits = numpy.full((len(self._codes), len(self._operationNames)), -1, dtype = numpy.int16)
+        self._edits = numpy.asarray(theEdits, dtype = numpy.int16).reshape(len(self._codes), len(self._operationNames))
+        self._editNames = [list(someNames) for someNames in theEditNames] if theEditNames is not None else [[] for aName in self._operationNames]
+        
+    def __len__(self):
+        return self._N
+        
+    @property
+    def bitmap(self):
+        """Returns the bitmap of the perturbed values, packed 8 values per byte (please see numpy.packbits)"""
+        return self._bitmap
+        
+    @property
+    def fired(self):
+        """Returns a boolean numpy array, whether each value of the column was perturbed"""
+        return numpy.unpackbits(self._bitmap)[:self._N].astype(bool)
+        
+    @property
+    def rows(self):
+        """Returns the indices of the values that were perturbed"""
+        return numpy.flatnonzero(self.fired)
+        
+    @property
+    def codes(self):
+        return self._codes
+        
+    @property
+    def originals(self):
+        return self._originals
+        
+    @property
+    def operationNames(self):
+        return self._operationNames
+        
+    @property
+    def edits(self):
+        """Returns the edit code of each operation (columns) applied to each perturbed value (rows), -1 where no edit was recorded"""
+        return self._edits
+        
+    @property
+    def editNames(self):
+        return self._editNames
+        
+    def _operationName(self, position, k):
+        """Returns the name of the k-th operation of the perturbed value at position, qualified by its edit if it was recorded"""
+        anEdit = int(self._edits[position, k])
+        if 0 <= anEdit < len(self._editNames[k]):
+            return "%s:%s" % (self._operationNames[k], self._editNames[k][anEdit])
+        return self._operationNames[k]
+        
+    def operationsOf(self, aRow):
+        """Returns the names of the operations applied to the value at index aRow (an empty list if it was not perturbed)
+        
+        Operations whose edit was recorded are named as operation:edit (e.g. punctuationPerturbator:swap).
+        """
+        position = numpy.searchsorted(self.rows, aRow)
+        if position == len(self._codes) or self.rows[position] != aRow:
+            return []
+        return [self._operationName(position, k) for k in range(len(self._operationNames)) if int(self._codes[position]) >> k & 1]
+        
+    def toDataFrame(self):
+        """Returns the log as a pandas DataFrame of (ROW, OPERATION, ORIGINAL) with one row per perturbed value"""
+        import pandas
+        bits = (self._codes[:, None].astype(numpy.uint64) >> numpy.arange(len(self._operationNames), dtype = numpy.uint64)) & 1
+        operations = [" * ".join([self._operationName(position, k) for k in numpy.flatnonzero(someBits)]) for position, someBits in enumerate(bits)]
+        return pandas.DataFrame({"ROW":self.rows, "OPERATION":operations, "ORIGINAL":self._originals}, columns = ["ROW", "OPERATION", "ORIGINAL"])
+        
+    def save(self, aFilename):
+        """Saves the log to a numpy .npz file"""
+        numpy.savez_compressed(aFilename, N = self._N, bitmap = self._bitmap, codes = self._codes, 
+                               originals = self._originals, operationNames = numpy.array(self._operationNames, dtype = object),
+                               edits = self._edits, editNames = numpy.array(json.dumps(self._editNames), dtype = object))
+        
+    @classmethod
+    def load(cls, aFilename):
+        """Loads a log saved by save (logs saved without edits load with no edits recorded)"""
+        data = numpy.load(aFilename, allow_pickle = True)
+        N = int(data["N"])
+        edits, editNames = None, None
+        if "edits" in data.files:
+            edits, editNames = data["edits"], json.loads(data["editNames"].item())
+        log = cls(N, [], data["codes"], data["originals"], list(data["operationNames"]), edits, editNames)
+        log._bitmap = data["bitmap"]
+        return log
+        
+    @classmethod
+    def concatenate(cls, theLogs):
+        """Concatenates the logs of successive chunks of a column into the log of the whole column"""
+        if not theLogs:
+            raise ValueError("At least one perturbationLog is required")
+        offsets = numpy.cumsum([0] + [len(aLog) for aLog in theLogs])
+        return cls(offsets[-1], 
+                   numpy.concatenate([aLog.rows + anOffset for aLog, anOffset in zip(theLogs, offsets)]), 
+                   numpy.concatenate([aLog.codes for aLog in theLogs]), 
+                   numpy.concatenate([aLog.originals for aLog in theLogs]), 
+                   theLogs[0].operationNames, 
+                   numpy.concatenate([aLog.edits for aLog in theLogs]), 
+                   theLogs[0].editNames)
+        
 class punctuationPerturbator(dataPerturbator):
     """Defines a punctuation perturbator.
     
        A punctuation pertubator either:
             Erases a letter
             Swaps two nearby letters (successive positions)
-            Changes a letter with a random one
+            Changes a letter with a random one (a digit with a random digit and an upper case letter with a random upper case letter)
+            
+       The first letter of strings longer than two letters is left intact and their last letter can only 
+       be swapped. The empty string is never perturbed and single letter strings can only be erased or changed.
     """        
-    def __init__(self, prob = 0.5):
+    def __init__(self, prob = 0.5, operationProbs = (1.0/3, 1.0/3, 1.0/3)):
+        """Instantiates the perturbator
+        
+        Args:
+            prob          : A Real number representing the probability of triggering this perturbator
+            operationProbs: A tuple of the probabilities of erasing, swapping and changing a letter (in that order) when triggered
+        Returns:
+            Nothing
+        """
         super(punctuationPerturbator, self).__init__(prob)
+        if len(operationProbs) != 3 or abs(sum(operationProbs) - 1.0) > 1e-9:
+            raise ValueError("operationProbs must be the three probabilities of erasing, swapping and changing a letter")
+        self._operationProbs = tuple(operationProbs)
+        self._cumulativeProbs = numpy.cumsum(self._operationProbs)
         
-    def __call__(self, aString):
-        if random.random()>self._prob:
-            return aString
-                                    
-        v = random.random()
-        lenS = len(aString)        
+    @property
+    def operationProbs(self):
+        return self._operationProbs
+        
+    @property
+    def editNames(self):
+        """The edit code of a value is 0 if a letter was erased, 1 if two were swapped, 2 if one was changed and 3 if the value was too short to edit"""
+        return ["erase", "swap", "change", "unchanged"]
+        
+    def perturb(self, aString):
+        return self._perturbEdit(aString)[0]
+        
+    def _perturbEdit(self, aString):
+        v = _random().random()
+        lenS = len(aString)
+        operation = min(int(numpy.searchsorted(self._cumulativeProbs, v, side = "right")), 2)
         #Generate some random position in the string
-        k = random.randrange(1,lenS-1)
-        if 0.0<v<=0.5:
+        lo, hi = _editRange(lenS, operation)
+        if hi <= lo:
+            return aString, 3
+        k = _random().randrange(lo, hi)
+        if operation == 0:
             #Erase a letter at random        
-            return aString[0:k]+aString[k+1:]
-            
-        if 0.5<v<=1.0:
+            return aString[0:k]+aString[k+1:], operation
+        if operation == 1:
             #Swap nearby symbols
+            return aString[0:k]+aString[k+1]+aString[k]+aString[k+2:], operation
+        #Change a letter
+        return aString[0:k]+_changeLetter(aString[k])+aString[k+1:], operation
+        
+    @staticmethod
+    def _edit(aString, operation, k, aLetter):
+        """Applies an operation at position k of aString, as perturbSubset does (aLetter is the uniform random number that picks a changed letter)"""
+        if operation == 0:
+            return aString[0:k]+aString[k+1:]
+        if operation == 1:
             return aString[0:k]+aString[k+1]+aString[k]+aString[k+2:]
+        changed = _changeCodes(numpy.array([ord(aString[k])], dtype = numpy.uint32), numpy.array([aLetter]))[0]
+        return aString[0:k]+(unichr(changed) if isinstance(aString, unicode) else chr(changed))+aString[k+1:]
+        
+    def perturbSubset(self, theValues, randomState, withEdits = False):
+        """Erases, swaps or changes letters of all values at once
+        
+        The values are laid out as the rows of a padded matrix of character codes and each 
+        operation is applied to all the rows it was drawn for with array operations. Columns 
+        whose values are not all strings of the same kind (e.g. that mix str and unicode, 
+        or hold str that are not ASCII) are perturbed one by one, with the same random numbers.
+        """
+        strings = _textArray(theValues)
+        N = len(theValues)
+        lengths = numpy.char.str_len(strings) if strings is not None else numpy.array([len(aValue) for aValue in theValues], dtype = numpy.int64)
+        operations = numpy.minimum(numpy.searchsorted(self._cumulativeProbs, randomState.random_sample(N), side = "right"), 2)
+        lo, hi = _editRange(lengths, operations)
+        positions = lo + numpy.floor(randomState.random_sample(N) * (hi - lo)).astype(numpy.int64)
+        letters = randomState.random_sample(N)
+        valid = hi > lo
+        if strings is None:
+            result = _objectColumn([self._edit(aValue, operation, k, aLetter) if isValid else aValue 
+                                    for aValue, operation, k, aLetter, isValid in zip(theValues, operations, positions, letters, valid)])
+            if withEdits:
+                return result, numpy.where(valid, operations, 3).astype(numpy.int16)
+            return result
+        codeType = numpy.uint8 if strings.dtype.kind == "S" else numpy.uint32
+        width = strings.dtype.itemsize // numpy.dtype(codeType).itemsize
+        #One spare column of padding, so that erasing can shift every row left by one
+        codes = numpy.zeros((N, width + 1), dtype = codeType)
+        codes[:, :width] = strings.view(codeType).reshape(N, width)
+        rows = numpy.arange(N)
+        
+        erased = rows[valid & (operations == 0)]
+        if len(erased):
+            columns = numpy.arange(width)
+            codes[erased[:, None], columns] = codes[erased[:, None], columns + (columns >= positions[erased][:, None])]
+            
+        swapped = rows[valid & (operations == 1)]
+        if len(swapped):
+            k = positions[swapped]
+            codes[swapped, k], codes[swapped, k + 1] = codes[swapped, k + 1], codes[swapped, k].copy()
+            
+        changed = rows[valid & (operations == 2)]
+        if len(changed):
+            k = positions[changed]
+            codes[changed, k] = _changeCodes(codes[changed, k], letters[changed])
             
+        result = numpy.ascontiguousarray(codes[:, :width]).view(strings.dtype).reshape(N).astype(object)
+        if withEdits:
+            return result, numpy.where(valid, operations, 3).astype(numpy.int16)
+        return result
             
 class subsPerturbator(dataPerturbator):
     """Defines a substitution perturbator
@@ -92,35 +703,68 @@ class subsPerturbator(dataPerturbator):
         and subsequently apply the substitution to 80% of the evaluations in I.
         
     WARNING!!!
-        The substitutions are applied **sequentially, by order of appearance**. This means that 
+        By default, the substitutions are applied **in one pass** over a string. At every position of 
+        the string, the longest of the strings to be substituted that appears there is replaced and the 
+        scan continues after it. Replacements are never substituted themselves. This means that 
         if Q = subsPerturbator([("Robert", "Bob"),("Bob", "Hoskins")]) and P() 
         generated "Robert", this WILL NOT be mapped automatically to "Hoskins".
         Rather, Robert will map to Bob and upon a second call to Q, Bob will map to Hoskins.
+        
+        With sequential = True, the substitutions are applied **sequentially, by order of appearance**, 
+        each one to the result of the previous ones, and "Robert" WILL map to "Hoskins".
     """
     
-    def __init__(self, subsList, prob = 0.5):
+    def __init__(self, subsList, prob = 0.5, sequential = False):
         """Instantitates the perturbator
         
         Instantiates the perturbator to the list of substitutions
         
         Args:
-            subsList: A list of tuples describing the substitutions
-            prob    : A Real number representing the probability of triggering this perturbator
+            subsList  : A list of tuples describing the substitutions
+            prob      : A Real number representing the probability of triggering this perturbator
+            sequential: A boolean, whether the substitutions are chained (please see WARNING above)
         Returns:
             Nothing
         """
         super(subsPerturbator, self).__init__(prob)
         self._subsList = subsList
+        self._sequential = sequential
+        if not sequential:
+            #If the same string appears more than once, its first substitution applies
+            self._subsTable = {}
+            for aFrom, aTo in reversed(subsList):
+                if not aFrom:
+                    raise ValueError("The strings to be substituted cannot be empty")
+                self._subsTable[aFrom] = aTo
+            self._subsPattern = re.compile(_triePattern(self._subsTable.keys())) if self._subsTable else None
         
-    def __call__(self, aString):
-        if random.random() > self._prob:            
-            return aString
-                    
+    @property
+    def sequential(self):
+        return self._sequential
+        
+    def _substitute(self, aMatch):
+        return self._subsTable[aMatch.group(0)]
+        
+    def perturb(self, aString):
+        if not self._sequential:
+            return self._subsPattern.sub(self._substitute, aString) if self._subsPattern is not None else aString
         currentString = aString
         for aSub in self._subsList:
             currentString = currentString.replace(aSub[0],aSub[1])
         return currentString
         
+    def perturbSubset(self, theValues, randomState, withEdits = False):
+        """Substitutes every value
+        
+        Substitutions draw no random numbers, so perturb is applied to the values directly, 
+        without seeding a stream per value.
+        """
+        result = numpy.empty(len(theValues), dtype=object)
+        result[:] = [self.perturb(aValue) for aValue in theValues]
+        if withEdits:
+            return result, _noEdits(len(result))
+        return result
+        
 class prefixPerturbator(dataPerturbator):
     """Defines a prefix perturbator
     
@@ -142,14 +786,29 @@ class prefixPerturbator(dataPerturbator):
         Returns:
             Nothing
         """
-        super(prefixPertubator, self).__init__(prob)
+        super(prefixPerturbator, self).__init__(prob)
         self._listOfPrefixes = listOfPrefixes
         self._Nprefixes = len(self._listOfPrefixes)
         
-    def __call__(self, aString):
-        if random.random()>self._prob:
-            return aString
-        return self._listOfPrefixes[random.randrange(0,self._Nprefixes)] + aString
+    @property
+    def editNames(self):
+        """The edit code of a value is the index of the prefix it was given"""
+        return list(self._listOfPrefixes)
+        
+    def perturb(self, aString):
+        return self._perturbEdit(aString)[0]
+        
+    def _perturbEdit(self, aString):
+        k = _random().randrange(0,self._Nprefixes)
+        return self._listOfPrefixes[k] + aString, k
+        
+    def perturbSubset(self, theValues, randomState, withEdits = False):
+        """Prepends a prefix, picked at random, to every value"""
+        choices = randomState.randint(0, self._Nprefixes, len(theValues))
+        result = numpy.array(self._listOfPrefixes, dtype=object)[choices] + theValues
+        if withEdits:
+            return result, choices.astype(numpy.int16)
+        return result
         
 class suffixPerturbator(dataPerturbator):
     """Defines a suffix to a string with a given probability
@@ -161,14 +820,29 @@ class suffixPerturbator(dataPerturbator):
         Q = suffixPerturbator(["ing", "ong", ". Jr"])
     """
     def __init__(self, listOfSuffixes, prob=0.5):
-        super(suffixPertubator, self).__init__(prob)
+        super(suffixPerturbator, self).__init__(prob)
         self._listOfSuffixes = listOfSuffixes
         self._Nsuffixes = len(self._listOfSuffixes)
         
-    def __call__(self,aString):
-        if random.random()>self._prob:
-            return aString
-        return aString + self._listOfSuffixes[random.randrange(0,self._Nsuffixes)]
+    @property
+    def editNames(self):
+        """The edit code of a value is the index of the suffix it was given"""
+        return list(self._listOfSuffixes)
+        
+    def perturb(self,aString):
+        return self._perturbEdit(aString)[0]
+        
+    def _perturbEdit(self, aString):
+        k = _random().randrange(0,self._Nsuffixes)
+        return aString + self._listOfSuffixes[k], k
+        
+    def perturbSubset(self, theValues, randomState, withEdits = False):
+        """Appends a suffix, picked at random, to every value"""
+        choices = randomState.randint(0, self._Nsuffixes, len(theValues))
+        result = theValues + numpy.array(self._listOfSuffixes, dtype=object)[choices]
+        if withEdits:
+            return result, choices.astype(numpy.int16)
+        return result
         
 class missingDataPerturbator(dataPerturbator):
     """Defines a missing data perturbator
@@ -181,18 +855,220 @@ class missingDataPerturbator(dataPerturbator):
         I = [Q(P()) for k in xrange(0,100)]
         
         This will return "N/A" to 20% of the evaluations within I
+        
+    In masked batch mode, missing values are not replaced by the symbol. Rather, perturbBatch returns 
+    a numpy masked array (please see numpy.ma) of the same type as its input (e.g. dates or numbers), 
+    whose mask marks the missing values. The symbol can then be applied when the data are written 
+    out (please see fill and toNullableSeries).
+    
+        Q = missingDataPerturbator("N/A", prob=0.2, masked=True)
+        D = Q.perturbBatch(numpy.array(["2017-04-01", "2017-04-02"], dtype="datetime64[s]"))
     """
-    def __init__(self, missingDataSymbol="", prob=0.5):
+    def __init__(self, missingDataSymbol="", prob=0.5, masked=False):
         """Instantiates the missing data perturbator
         
         Args:
             missingDataSymbol: A string describing the missing data symbol
             prob             : A Real number describing the probability of triggering this perturbator.
+            masked           : A boolean, whether perturbBatch marks missing values in a mask rather than replacing them with the symbol.
+                               Masked batch mode only applies to missingDataPerturbators that are not part of a compositePerturbator.
         """
         super(missingDataPerturbator, self).__init__(prob)
         self._missingDataSymbol = missingDataSymbol        
+        self._masked = masked
+        
+    @property
+    def missingDataSymbol(self):
+        return self._missingDataSymbol
+        
+    @property
+    def masked(self):
+        return self._masked
     
-    def __call__(self,aString):
-        if random.random()>self._prob:
-            return aString
+    def perturb(self,aString):
         return self._missingDataSymbol
+        
+    def perturbBatch(self, theValues, randomState = None, log = False):
+        if not self._masked:
+            return super(missingDataPerturbator, self).perturbBatch(theValues, randomState, log)
+        randomState = randomState if randomState is not None else numpy.random
+        values = theValues if isinstance(theValues, numpy.ndarray) else numpy.asarray(theValues)
+        mask = numpy.ma.getmaskarray(values).copy()
+        fired = numpy.flatnonzero(randomState.random_sample(len(values)) <= self._prob)
+        mask[fired] = True
+        result = numpy.ma.array(numpy.ma.getdata(values), mask = mask, copy = True)
+        if log:
+            return result, perturbationLog(len(result), fired, numpy.ones(len(fired), dtype = numpy.uint8), _valueColumn(numpy.ma.getdata(values)[fired]), self.operationNames,
+                                           _noEdits(len(fired))[:, None], [self.editNames])
+        return result
+        
+    def perturbSubset(self, theValues, randomState, withEdits = False):
+        """Replaces every value with the missing data symbol"""
+        result = numpy.empty(len(theValues), dtype=object)
+        result.fill(self._missingDataSymbol)
+        if withEdits:
+            return result, _noEdits(len(result))
+        return result
+        
+    def fill(self, theValues):
+        """Replaces the missing values of a masked array with the missing data symbol
+        
+        Args:
+            theValues: A numpy masked array (e.g. as returned by perturbBatch in masked mode)
+            
+        Returns:
+            A numpy array (of dtype object). Dates are formatted as strings (please see dateGenerator).
+        """
+        data = numpy.ma.getdata(theValues)
+        result = _datesToStrings(data) if data.dtype.kind == "M" else _valueColumn(data)
+        result[numpy.ma.getmaskarray(theValues)] = self._missingDataSymbol
+        return result
+
+def _textArray(theValues):
+    """Returns a column of values as a numpy array of strings (of kind S or U) or None if it cannot be
+    
+    A column can only be laid out as a matrix of character codes if its values are either all unicode 
+    or all ASCII str. A column that mixes the two (e.g. the values of batch and scalar generators) would 
+    have its str decoded as ASCII by numpy, so non-ASCII str (and mixed columns) are left to perturb.
+    """
+    if len(theValues) == 0:
+        return None
+    values = theValues.tolist()
+    isUnicode = [isinstance(aValue, unicode) for aValue in values]
+    if all(isUnicode):
+        return numpy.array(values, dtype = unicode)
+    if any(isUnicode) or not all([isinstance(aValue, str) for aValue in values]):
+        return None
+    try:
+        "".join(values).decode("ascii")
+    except UnicodeDecodeError:
+        return None
+    return numpy.array(values, dtype = str)
+    
+def _triePattern(theStrings):
+    """Returns a regular expression that matches the longest of theStrings that appears at a position
+    
+    The strings are arranged in a trie, so that the expression branches once per distinct character 
+    rather than once per string, and can be matched against a string in a single scan.
+    """
+    trie = {}
+    for aString in theStrings:
+        aNode = trie
+        for aChar in aString:
+            aNode = aNode.setdefault(aChar, {})
+        aNode[""] = None
+    return _trieNodePattern(trie)
+    
+def _trieNodePattern(aNode):
+    """Returns the regular expression of the strings that complete a node of a trie (please see _triePattern)"""
+    branches = [re.escape(aChar) + _trieNodePattern(aChild) for aChar, aChild in sorted(aNode.items()) if aChar != ""]
+    if not branches:
+        return ""
+    pattern = branches[0] if len(branches) == 1 else "(?:%s)" % "|".join(branches)
+    #Strings that end at this node match only if none of their (longer) continuations does
+    return "(?:%s)?" % pattern if "" in aNode else pattern
+    
+def toNullableSeries(theValues, theIndex = None):
+    """Converts a numpy masked array to a pandas Series that keeps the type of its values
+    
+    Masked values become missing values of the Series (NaN for numbers, NaT for dates, 
+    None for any other values). Integers become a nullable integer Series where 
+    pandas supports it. A missing data symbol can then be applied when the Series 
+    is written out (e.g. via to_csv(na_rep = "N/A")).
+    
+    Args:
+        theValues: A numpy masked array (or a numpy array)
+        theIndex: The index of the Series (optional)
+        
+    Returns:
+        A pandas Series
+    """
+    import pandas
+    data = numpy.ma.getdata(theValues)
+    mask = numpy.ma.getmaskarray(theValues)
+    if not mask.any():
+        return pandas.Series(data, index = theIndex)
+    if data.dtype.kind == "f":
+        data = numpy.where(mask, numpy.nan, data)
+    elif data.dtype.kind in "mM":
+        data = data.copy()
+        data[mask] = numpy.datetime64("NaT") if data.dtype.kind == "M" else numpy.timedelta64("NaT")
+    elif data.dtype.kind in "iu" and hasattr(pandas, "arrays") and hasattr(pandas.arrays, "IntegerArray"):
+        data = pandas.arrays.IntegerArray(data.astype(numpy.int64), mask)
+    else:
+        data = numpy.array(data, dtype = object)
+        data[mask] = None
+    return pandas.Series(data, index = theIndex)
+    
+def _valueColumn(theValues):
+    """Returns a copy of a sequence of values (e.g. a list, numpy array or pandas Series) as a numpy array of objects"""
+    if isinstance(theValues, numpy.ndarray) or hasattr(theValues, "values"):
+        return numpy.array(theValues, dtype=object)
+    return _objectColumn(theValues)
+    
+def _subsetState(randomState, theRows, aLabel):
+    """Returns the random state to perturb a subset of the values of a column with
+    
+    A keyedRandom is narrowed down to the keys of the subset and to a stream labelled by aLabel, 
+    which must be unique among the subsets taken from the same state. Other random states are shared.
+    
+    The subsets that trigger the members of a perturbator and those that its leaves are applied 
+    to are labelled apart (please see _fireLabel and _applyLabel).
+    """
+    return randomState.take(theRows, aLabel) if isinstance(randomState, keyedRandom) else randomState
+    
+def _fireLabel(k):
+    """Returns the label of the subset of values that the k-th member of a perturbator is triggered for"""
+    return "fire:%d" % k
+    
+def _applyLabel(k):
+    """Returns the label of the subset of values that the k-th leaf of a perturbator is applied to"""
+    return "apply:%d" % k
+    
+def _noEdits(N):
+    """Returns the edit codes of N values whose edits are not told apart"""
+    return numpy.full(N, -1, dtype = numpy.int16)
+    
+def _operationCodes(theFired):
+    """Packs the rows of an N x L boolean matrix of triggered leaves into one unsigned integer code per row"""
+    L = theFired.shape[1]
+    if L > 64:
+        raise ValueError("The perturbations of perturbators with more than 64 leaves cannot be logged")
+    codeType = numpy.uint8 if L <= 8 else numpy.uint16 if L <= 16 else numpy.uint32 if L <= 32 else numpy.uint64
+    return theFired.astype(numpy.uint64).dot(numpy.left_shift(numpy.uint64(1), numpy.arange(L, dtype = numpy.uint64))).astype(codeType)
+    
+def _editRange(theLength, theOperation):
+    """Returns the range [lo, hi) of positions of a string (or an array of strings) that an edit operation can apply to
+    
+    Swapping (operation 1) applies to a position and the one following it. The first letter of 
+    strings longer than two letters is left intact and their last letter can only be swapped.
+    """
+    isLong = theLength > 2
+    lo = numpy.where(isLong, 1, 0)
+    hi = numpy.where(isLong, theLength - 1, theLength - numpy.where(numpy.equal(theOperation, 1), 1, 0))
+    if numpy.ndim(theLength) == 0:
+        return int(lo), int(hi)
+    return lo, hi
+    
+def _changeLetter(aChar):
+    """Returns a random letter (or digit) other than aChar, of the same kind as aChar"""
+    if aChar.isdigit():
+        alphabet = "0123456789"
+    elif aChar.isupper():
+        alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    else:
+        alphabet = "abcdefghijklmnopqrstuvwxyz"
+    return _random().choice(alphabet.replace(aChar, "")) if aChar in alphabet else _random().choice(alphabet)
+    
+def _changeCodes(theCodes, theUniforms):
+    """Vectorised _changeLetter over an array of character codes, given a uniform random number in [0, 1) per code"""
+    isDigit = (theCodes >= ord("0")) & (theCodes <= ord("9"))
+    isUpper = (theCodes >= ord("A")) & (theCodes <= ord("Z"))
+    isLower = (theCodes >= ord("a")) & (theCodes <= ord("z"))
+    base = numpy.where(isDigit, ord("0"), numpy.where(isUpper, ord("A"), ord("a")))
+    span = numpy.where(isDigit, 10, 26)
+    inAlphabet = isDigit | isUpper | isLower
+    #Letters of the alphabet are shifted by 1..span-1, so that they always change
+    shift = numpy.where(inAlphabet, theCodes.astype(numpy.int64) - base + 1 + numpy.floor(theUniforms * (span - 1)).astype(numpy.int64),
+                                    numpy.floor(theUniforms * span).astype(numpy.int64))
+    return (base + shift % span).astype(theCodes.dtype)
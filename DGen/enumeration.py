@@ -0,0 +1,152 @@
+"""
+Defines the exact enumeration of the outputs of finite generator trees
+
+Many generator trees can only produce a finite number of values, e.g. the
+product of a gender and a condition, a name conditioned on a gender or a
+chain of option lists. enumerateDistribution computes the exact support of
+such a tree (every value it can produce) along with the probability of each
+value, by walking the tree:
+
+    * constantGenerator: its constant, with probability 1
+    * optionGenerator: the distribution of each option, weighted by its probability
+    * compositeORGenerator (*): the concatenation of every pair of values of its two generators
+    * compositeConditionalGenerator (|) of a condProbOptionGenerator: the distribution of
+      each option of the condProbOptionGenerator, weighted by the probability of its event
+    * aliasGenerator: its table
+
+tabulateDistributions replaces every subtree of a generator tree whose support
+is small enough by an aliasGenerator over its distribution, so that several
+levels of nested evaluations become a single draw from a table. The values
+are produced with the same probabilities but from different random numbers,
+so seeded outputs change once a tree is tabulated.
+
+Example:
+    P = optionGenerator(["Mr ", "Ms "]) * optionGenerator(["A", "B", "C"])
+    enumerateDistribution(P)   #[("Mr A", 1/6.), ("Mr B", 1/6.), ...]
+    P = tabulateDistributions(P)
+"""
+
+from .datagenerator import randomDataGenerator, constantGenerator, optionGenerator, archivedOptionGenerator, aliasGenerator, \
+                           compositeORGenerator, compositeConditionalGenerator, condProbOptionGenerator
+
+def enumerateDistribution(aGenerator, maxSupport = None):
+    """Computes the exact distribution of the values of a finite generator tree
+
+    Args:
+        aGenerator: A randomDataGenerator made of the generators listed in the module documentation
+        maxSupport: An integer, the largest number of distinct values that is enumerated (or None for no limit)
+
+    Returns:
+        A list of (value, probability) pairs, one per distinct value that the tree can produce
+
+    Raises:
+        TypeError: If the tree contains a generator whose values cannot be enumerated
+        ValueError: If the tree (or any of its subtrees) can produce more than maxSupport distinct values
+    """
+    return _enumerate(aGenerator, maxSupport)
+
+def tabulateDistributions(aGenerator, maxSupport = 4096):
+    """Replaces the finite subtrees of a generator tree by aliasGenerators
+
+    The largest subtrees whose distribution can be enumerated within maxSupport
+    values are replaced, in place, by aliasGenerators (with the same name).
+
+    Args:
+        aGenerator: A randomDataGenerator
+        maxSupport: An integer, the largest number of distinct values of a subtree that is tabulated
+
+    Returns:
+        The tabulated generator (a new aliasGenerator if aGenerator itself was tabulated, aGenerator otherwise)
+    """
+    return _tabulate(aGenerator, maxSupport, {})
+
+def _enumerate(aGenerator, maxSupport):
+    """Returns the distribution of a generator (please see enumerateDistribution)"""
+    aType = type(aGenerator)
+    if aType is constantGenerator:
+        return [(aGenerator(), 1.0)]
+    if aType is aliasGenerator:
+        return _merge(aGenerator.distribution, maxSupport)
+    if aType in (optionGenerator, archivedOptionGenerator):
+        if not aGenerator._options:
+            raise TypeError("An optionGenerator without options cannot be enumerated")
+        pairs = []
+        for aProbability, anOption in zip(_optionProbabilities(aGenerator._options), [anOption[1] for anOption in aGenerator._options]):
+            if aProbability > 0:
+                pairs.extend([(aValue, aProbability * p) for aValue, p in _enumerate(anOption, maxSupport)])
+        return _merge(pairs, maxSupport)
+    if aType is compositeORGenerator:
+        left, right = _enumerate(aGenerator._left, maxSupport), _enumerate(aGenerator._right, maxSupport)
+        return _merge([(aLeftValue + aRightValue, p * q) for aLeftValue, p in left for aRightValue, q in right], maxSupport)
+    if aType is compositeConditionalGenerator and type(aGenerator._left) is condProbOptionGenerator:
+        pairs = []
+        for anEvent, p in _enumerate(aGenerator._right, maxSupport):
+            if anEvent not in aGenerator._left._options:
+                raise TypeError("The conditional generator has no option for event %r" % (anEvent,))
+            pairs.extend([(aValue, p * q) for aValue, q in _enumerate(aGenerator._left._options[anEvent], maxSupport)])
+        return _merge(pairs, maxSupport)
+    raise TypeError("The values of %s cannot be enumerated" % aType.__name__)
+
+def _optionProbabilities(theOptions):
+    """Returns the probability of each option of an optionGenerator, as picked in batch mode
+
+    Cumulative probabilities are capped at one and probabilities that add up to less
+    than one are resolved in favour of the last option (please see optionGenerator.generateBatch).
+    """
+    probabilities = []
+    cumulative = 0.0
+    for aProbability, anOption in theOptions[:-1]:
+        newCumulative = min(cumulative + aProbability, 1.0)
+        probabilities.append(max(newCumulative - cumulative, 0.0))
+        cumulative = newCumulative
+    probabilities.append(1.0 - cumulative)
+    return probabilities
+
+def _merge(thePairs, maxSupport):
+    """Adds up the probabilities of equal values, keeping the order in which values first appear"""
+    probabilities = {}
+    values = []
+    for aValue, aProbability in thePairs:
+        if aValue not in probabilities:
+            probabilities[aValue] = 0.0
+            values.append(aValue)
+            if maxSupport is not None and len(values) > maxSupport:
+                raise ValueError("The generator can produce more than %d distinct values" % maxSupport)
+        probabilities[aValue] += aProbability
+    return [(aValue, probabilities[aValue]) for aValue in values]
+
+def _tabulate(aGenerator, maxSupport, theReplacements):
+    """Tabulates a generator or, if it cannot be tabulated, its children (please see tabulateDistributions)"""
+    if id(aGenerator) in theReplacements:
+        return theReplacements[id(aGenerator)]
+    theReplacements[id(aGenerator)] = aGenerator
+    replacement = aGenerator
+    if type(aGenerator) not in (constantGenerator, aliasGenerator):
+        try:
+            distribution = _enumerate(aGenerator, maxSupport)
+            replacement = aliasGenerator([aValue for aValue, p in distribution], [p for aValue, p in distribution]).setVarName(aGenerator.name)
+        except (TypeError, ValueError):
+            pass
+    if replacement is aGenerator:
+        for anAttribute, aValue in list(vars(aGenerator).items()):
+            newValue = _tabulateIn(aValue, maxSupport, theReplacements)
+            if newValue is not aValue:
+                setattr(aGenerator, anAttribute, newValue)
+    theReplacements[id(aGenerator)] = replacement
+    return replacement
+
+def _tabulateIn(aValue, maxSupport, theReplacements):
+    """Tabulates the generators within an attribute (a generator, or a list, tuple or dict of them)"""
+    if isinstance(aValue, randomDataGenerator):
+        return _tabulate(aValue, maxSupport, theReplacements)
+    if isinstance(aValue, (list, tuple)):
+        newItems = [_tabulateIn(anItem, maxSupport, theReplacements) for anItem in aValue]
+        if all([aNewItem is anItem for aNewItem, anItem in zip(newItems, aValue)]):
+            return aValue
+        return type(aValue)(newItems) if type(aValue) in (list, tuple) else aValue
+    if isinstance(aValue, dict):
+        newItems = dict([(aKey, _tabulateIn(anItem, maxSupport, theReplacements)) for aKey, anItem in aValue.items()])
+        if all([newItems[aKey] is aValue[aKey] for aKey in aValue]):
+            return aValue
+        return type(aValue)(newItems) if type(aValue) is dict else aValue
+    return aValue
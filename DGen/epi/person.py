@@ -5,6 +5,7 @@ generating case-control clinical data
 Athanasios Anastasiou April 2017
 """
 
+import numpy
 from ..datagenerator import *
 from utils import *
 
@@ -18,12 +19,25 @@ class PersonData(randomDataGenerator):
         
     def __call__(self):
         return self._data
+        
+    def generateBatch(self, N):
+        column = numpy.empty(N, dtype=object)
+        column.fill(self._data)
+        return column
     
 class Person(randomDataGenerator):
     """Defines an abstract class for a Person.
     
        This class abstracts an individual in a population and 
-       initialises it with a number of attributes that are commonly encountered in Epidemiology"""
+       initialises it with a number of attributes that are commonly encountered in Epidemiology.
+       
+       The keyword argument fields restricts the attributes that are generated 
+       to those listed (e.g. Person(fields = ["PATID", "DOB"])). The attributes 
+       that are generated have the same values as they would in a Person 
+       generated with all of its attributes, for the same seed.
+       
+       The keyword argument compact returns instances as slot based records
+       (please see records.recordType) rather than Bunches."""
     
     def __init__(self, *args, **kwargs):
         super(Person, self).__init__()
@@ -38,6 +52,18 @@ class Person(randomDataGenerator):
         except KeyError:
             self._ageMax = 65
             
+        #Names of the attributes to generate (None for all of them)
+        try:
+            self._fieldNames = kwargs["fields"]
+        except KeyError:
+            self._fieldNames = None
+            
+        #Whether instances are returned as compact (slot based) records rather than Bunches
+        try:
+            self._compact = kwargs["compact"]
+        except KeyError:
+            self._compact = False
+            
         #self._ageMin = ageMin
         #self._ageMax = ageMax
                     
@@ -51,27 +77,67 @@ class Person(randomDataGenerator):
         self._Postcode = revRegexGenerator("[A-Z][A-Z][1-9][1-9][A-Z][A-Z]").setVarName("Postcode")
         self._GPID = revRegexGenerator("[A-Z][0-9][0-9][0-9][0-9][0-9]").setVarName("GPID")
         self._Data = PersonData().setVarName("Data")
+        #The record is put together upon first use so that derived classes can still replace attributes after initialisation
+        self._record = None
+        
+    def _recordFields(self):
+        """Returns the named generators that make up the record of a Person
+        
+        The Name is conditioned on the Gender of the same record via a 
+        varRefGenerator, so that Gender is only evaluated once.
+        """
+        return [self._Identifier,
+                (self._Name | varRefGenerator(self._Gender.name)).setVarName(self._Name.name),
+                self._Surname,
+                self._Gender,
+                self._DOB,
+                self._Address,
+                self._Postcode,
+                self._GPID,
+                self._Data]
+                
+    @property
+    def record(self):
+        """Returns the recordGenerator that generates the attributes of a Person"""
+        if self._record is None:
+            self._record = recordGenerator(self._recordFields(), self._fieldNames, self._compact)
+        return self._record
         
     def __call__(self):
         """Generates and returns an instance of a Person"""
-        gnd = self._Gender()
-        nme = self._Name(gnd)
-        idf = self._Identifier()
-        dob = self._DOB()
-        srn = self._Surname()
-        adr = self._Address()
-        pcd = self._Postcode()
-        gpd = self._GPID()
-        dta = self._Data()
-        return Bunch({self._Identifier.name:idf,                 
-                self._Name.name:nme, 
-                self._Surname.name:srn,
-                self._Gender.name:gnd, 
-                self._DOB.name:dob,
-                self._Address.name:adr,
-                self._Postcode.name:pcd,
-                self._GPID.name:gpd,
-                self._Data.name:dta})                
+        return self.record()
+        
+    def generateColumns(self, N):
+        """Generates N instances of a Person in columnar form (please see recordGenerator)"""
+        return self.record.generateColumns(N)
+        
+    def generateTable(self, N):
+        """Generates N instances of a Person as a columnar recordTable (please see recordGenerator)"""
+        return self.record.generateTable(N)
+        
+    def generateBatch(self, N):
+        return self.record.generateBatch(N)
+        
+    def generatePopulation(self, N, chunkSize = None):
+        """Generates a population of N Persons as a pandas DataFrame
+        
+        The population is generated in batch mode (please see recordGenerator.generateColumns). 
+        Each attribute is generated as a whole column (names are sampled per 
+        gender group) and no per-Person record is ever created.
+        
+        Args:
+            N: An integer, the size of the population
+            chunkSize: An integer, the number of Persons generated per batch (or None for a single batch)
+            
+        Returns:
+            A pandas DataFrame with one row per Person and one column per attribute
+        """
+        import pandas
+        chunkSize = chunkSize or max(N, 1)
+        chunks = [pandas.DataFrame(self.generateColumns(min(chunkSize, N - k)), columns = self.record.fieldNames) for k in xrange(0, N, chunkSize)]
+        if not chunks:
+            return pandas.DataFrame(columns = self.record.fieldNames)
+        return pandas.concat(chunks, ignore_index = True) if len(chunks) > 1 else chunks[0]
                
 class DiseasePersonData(PersonData):
     """Defines the way a disease manifests in a patient data"""
@@ -0,0 +1,318 @@
+"""
+Defines the profiling of generator trees, node by node
+
+A generatorProfile is a context manager. While it is active, every call to a
+randomDataGenerator (__call__, generateBatch and the other methods that
+generate values) is timed and counted. The results are kept per node, keyed
+by the path of the node in the tree of generators that was being evaluated.
+Each node is identified by its name (please see setVarName) or, if it has
+none, by its type. For each node the profile records:
+
+    * the number of calls
+    * the cumulative time, including the nodes it evaluated
+    * the self time, excluding the nodes it evaluated
+    * the number of bytes that remained allocated after its calls (cumulative
+      and self), as traced by tracemalloc where it is available (Python 3) or,
+      otherwise (Python 2), as estimated from the size of the values that the
+      node returned (please see memoryMeasure). Estimated self bytes are
+      clamped at 0 and marked with a "~" by report.
+
+The generators are instrumented by wrapping the methods of their classes when
+the profile starts and restoring them when it stops. When no profile is active,
+generation does not pay any cost for profiling. Generators that are created
+during generation (e.g. within a __call__) are profiled too, since it is their
+classes that are instrumented.
+
+Example:
+    with generatorProfile() as P:
+        Person().record.generateBatch(10000)
+    P.report()
+    P.saveCollapsed("person.folded")
+
+The collapsed stack file can be turned into a flame graph with flamegraph.pl
+or speedscope.
+"""
+
+import sys
+import time
+import types
+import threading
+import numpy
+from .datagenerator import randomDataGenerator
+from .records import compactRecord, recordTable, childTable
+
+#The methods of a randomDataGenerator that generate values
+_profiledMethods = ("__call__", "generateBatch", "generateBatchGiven", "generateColumns", "generateTimelines")
+
+_timer = getattr(time, "perf_counter", time.time)
+
+#The profile that is currently active (if any)
+_activeProfile = None
+
+class nodeStats(object):
+    """Holds the statistics of a node of a generator tree, at a given path"""
+    def __init__(self, thePath, theType):
+        self.path = thePath
+        self.type = theType
+        self.calls = 0
+        self.cumulativeTime = 0.0
+        self.selfTime = 0.0
+        self.cumulativeBytes = None
+        self.selfBytes = None
+
+    @property
+    def label(self):
+        return self.path[-1]
+
+    def __repr__(self):
+        return "nodeStats(%s, calls=%d, cumulativeTime=%.6f, selfTime=%.6f)" % (";".join(self.path), self.calls, self.cumulativeTime, self.selfTime)
+
+class generatorProfile(object):
+    """Profiles the evaluation of generator trees
+
+    Please see the module documentation.
+    """
+    def __init__(self, memory = True):
+        """Instantiates a generatorProfile
+
+        Args:
+            memory: A boolean, whether to also record the bytes allocated by each node (please see memoryMeasure)
+
+        Returns:
+            Nothing
+        """
+        self._memory = memory
+        self._memoryMeasure = None
+        self._tracemalloc = None
+        self._startedTracing = False
+        self._stats = {}
+        self._threads = threading.local()
+        self._originals = []
+
+    @property
+    def memoryMeasure(self):
+        """Returns how the bytes of each node are measured: "tracemalloc", "returned" or None if they are not
+        
+        tracemalloc traces the bytes allocated by a node and still allocated when it returns. Without 
+        tracemalloc (Python 2), the bytes of a node are estimated from the size of the values that it 
+        returned ("returned"), which misses the memory that a node keeps (e.g. a pool of values) but 
+        accounts for the values generated. The self bytes of a call are then its returned bytes less 
+        those of the nodes it evaluated, clamped at 0, since a node may return less than it evaluated 
+        (e.g. one of the values of its options). They are estimates, even more so than the cumulative 
+        bytes. The measure is known once the profile has started.
+        """
+        return self._memoryMeasure
+
+    @property
+    def stats(self):
+        """Returns a dict of path (a tuple of node labels):nodeStats"""
+        return self._stats
+
+    def start(self):
+        """Starts profiling (please see __enter__)"""
+        global _activeProfile
+        if _activeProfile is not None:
+            raise RuntimeError("Another generatorProfile is already active")
+        if self._memory:
+            try:
+                import tracemalloc
+                self._startedTracing = not tracemalloc.is_tracing()
+                if self._startedTracing:
+                    tracemalloc.start()
+                self._tracemalloc = tracemalloc
+                self._memoryMeasure = "tracemalloc"
+            except ImportError:
+                self._tracemalloc = None
+                self._memoryMeasure = "returned"
+        for aClass in _generatorClasses():
+            for aMethod in _profiledMethods:
+                original = aClass.__dict__.get(aMethod)
+                if isinstance(original, types.FunctionType):
+                    self._originals.append((aClass, aMethod, original))
+                    setattr(aClass, aMethod, _profiled(original))
+        _activeProfile = self
+        return self
+
+    def stop(self):
+        """Stops profiling and restores the generators to their original methods"""
+        global _activeProfile
+        for aClass, aMethod, original in reversed(self._originals):
+            setattr(aClass, aMethod, original)
+        self._originals = []
+        if _activeProfile is self:
+            _activeProfile = None
+        if self._tracemalloc is not None and self._startedTracing:
+            self._tracemalloc.stop()
+        self._tracemalloc = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+        return False
+
+    def _call(self, aNode, aMethod, args, kwargs):
+        """Evaluates a method of a node, recording its statistics"""
+        try:
+            stack = self._threads.stack
+        except AttributeError:
+            stack = self._threads.stack = []
+        #A node calling its own methods (e.g. generateBatch calling __call__ N times) is a single node
+        if stack and stack[-1][0] is aNode:
+            return aMethod(aNode, *args, **kwargs)
+        path = (stack[-1][1] if stack else ()) + (_labelOf(aNode),)
+        #[node, path, time of the nodes it evaluates, bytes of the nodes it evaluates]
+        frame = [aNode, path, 0.0, 0]
+        stack.append(frame)
+        startBytes = self._tracemalloc.get_traced_memory()[0] if self._tracemalloc is not None else None
+        result = None
+        start = _timer()
+        try:
+            result = aMethod(aNode, *args, **kwargs)
+            return result
+        finally:
+            elapsed = _timer() - start
+            stack.pop()
+            stats = self._stats.get(path)
+            if stats is None:
+                stats = self._stats[path] = nodeStats(path, type(aNode).__name__)
+            stats.calls += 1
+            stats.cumulativeTime += elapsed
+            stats.selfTime += elapsed - frame[2]
+            if self._memoryMeasure is not None:
+                allocated = self._tracemalloc.get_traced_memory()[0] - startBytes if startBytes is not None else _sizeOf(result)
+                stats.cumulativeBytes = (stats.cumulativeBytes or 0) + allocated
+                selfAllocated = allocated - frame[3]
+                if self._memoryMeasure == "returned":
+                    #A node may return fewer bytes than the nodes it evaluated (please see memoryMeasure)
+                    selfAllocated = max(selfAllocated, 0)
+                stats.selfBytes = (stats.selfBytes or 0) + selfAllocated
+                if stack:
+                    stack[-1][3] += allocated
+            if stack:
+                stack[-1][2] += elapsed
+
+    def report(self, theStream = None, minFraction = 0.0):
+        """Prints the statistics as a tree, the children of each node in descending cumulative time
+
+        Self bytes that are estimated from the size of the returned values (please see memoryMeasure) 
+        are prefixed with a "~".
+
+        Args:
+            theStream: A file-like object (defaults to sys.stdout)
+            minFraction: A real number, nodes whose cumulative time is a smaller fraction of the total are omitted
+
+        Returns:
+            Nothing
+        """
+        theStream = theStream or sys.stdout
+        children = {}
+        for aPath in self._stats:
+            children.setdefault(aPath[:-1], []).append(self._stats[aPath])
+        total = sum([aStats.cumulativeTime for aStats in children.get((), [])]) or 1.0
+        estimated = "~" if self._memoryMeasure == "returned" else ""
+        theStream.write("%12s %12s %7s %10s %14s  %s\n" % ("cumulative s", "self s", "%", "calls", "self bytes", "node"))
+        pending = [(aStats, 0) for aStats in sorted(children.get((), []), key = lambda aStats:-aStats.cumulativeTime)]
+        while pending:
+            aStats, depth = pending.pop(0)
+            if aStats.cumulativeTime < minFraction * total:
+                continue
+            label = aStats.label if aStats.label == aStats.type else "%s (%s)" % (aStats.label, aStats.type)
+            theStream.write("%12.6f %12.6f %6.1f%% %10d %14s  %s%s\n" % (aStats.cumulativeTime, aStats.selfTime, 100.0 * aStats.cumulativeTime / total, aStats.calls,
+                                                                       "%s%d" % (estimated, aStats.selfBytes) if aStats.selfBytes is not None else "-", "  " * depth, label))
+            pending[0:0] = [(aChild, depth + 1) for aChild in sorted(children.get(aStats.path, []), key = lambda aStats:-aStats.cumulativeTime)]
+
+    def toCollapsed(self, metric = "time"):
+        """Returns the statistics as collapsed stacks (the input format of flame graph tools)
+
+        Args:
+            metric: A string, "time" (self time in microseconds), "calls" or "bytes" (self bytes)
+
+        Returns:
+            A list of strings, "node;node;...;node value", one per path
+        """
+        lines = []
+        for aPath, aStats in sorted(self._stats.items()):
+            if metric == "time":
+                value = int(round(aStats.selfTime * 1e6))
+            elif metric == "calls":
+                value = aStats.calls
+            elif metric == "bytes":
+                value = max(aStats.selfBytes or 0, 0)
+            else:
+                raise ValueError("Unknown metric %s" % metric)
+            if value > 0:
+                lines.append("%s %d" % (";".join([aLabel.replace(";", ":") for aLabel in aPath]), value))
+        return lines
+
+    def saveCollapsed(self, aFilename, metric = "time"):
+        """Saves the statistics as a collapsed stack file (please see toCollapsed)"""
+        with open(aFilename, "w") as aFile:
+            for aLine in self.toCollapsed(metric):
+                aFile.write(aLine + "\n")
+
+def _sizeOf(aValue, depth = 0):
+    """Estimates the number of bytes held by a generated value (please see generatorProfile.memoryMeasure)
+
+    The elements of arrays of objects and the items of lists are sized from a sample of at most 
+    _sampleSize of them. Fields are followed to a depth of 3 (e.g. the events of the records of a table).
+    """
+    if aValue is None:
+        return 0
+    if isinstance(aValue, numpy.ndarray):
+        if aValue.dtype != object or depth >= 3:
+            return aValue.nbytes
+        return aValue.nbytes + _sampledSize(aValue.ravel(), depth)
+    if isinstance(aValue, recordTable):
+        return sum([_sizeOf(aColumn, depth + 1) for aColumn in aValue.columns.values()] + 
+                   [_sizeOf(aChild, depth + 1) for aChild in aValue.children.values()])
+    if isinstance(aValue, childTable):
+        return _sizeOf(aValue.rows, depth) + aValue.offsets.nbytes
+    size = sys.getsizeof(aValue)
+    if depth >= 3:
+        return size
+    if isinstance(aValue, compactRecord):
+        return size + sum([_sizeOf(getattr(aValue, aName), depth + 1) for aName in aValue.__slots__])
+    if isinstance(aValue, dict):
+        return size + sum([_sizeOf(anItem, depth + 1) for anItem in aValue.values()])
+    if isinstance(aValue, (list, tuple)):
+        return size + _sampledSize(aValue, depth)
+    return size
+
+#The largest number of elements of an array or list that are sized by _sizeOf
+_sampleSize = 64
+
+def _sampledSize(theItems, depth):
+    """Estimates the total size of the items of a sequence from that of (a sample of) them"""
+    N = len(theItems)
+    if N == 0:
+        return 0
+    positions = range(N) if N <= _sampleSize else numpy.linspace(0, N - 1, _sampleSize).astype(int)
+    return int(sum([_sizeOf(theItems[k], depth + 1) for k in positions]) * N / float(len(positions)))
+
+def _labelOf(aNode):
+    """Returns the name of a node or, if it has none, the name of its type"""
+    aName = aNode.name
+    return aName if isinstance(aName, basestring) and aName else type(aNode).__name__
+
+def _generatorClasses():
+    """Returns randomDataGenerator and all of its (currently defined) subclasses"""
+    classes = []
+    pending = [randomDataGenerator]
+    while pending:
+        aClass = pending.pop()
+        if aClass not in classes:
+            classes.append(aClass)
+            pending.extend(aClass.__subclasses__())
+    return classes
+
+def _profiled(aMethod):
+    """Wraps a method of a randomDataGenerator class so that its calls are recorded by the active profile"""
+    def profiledMethod(self, *args, **kwargs):
+        if _activeProfile is None:
+            return aMethod(self, *args, **kwargs)
+        return _activeProfile._call(self, aMethod, args, kwargs)
+    profiledMethod.__name__ = aMethod.__name__
+    profiledMethod.__doc__ = aMethod.__doc__
+    return profiledMethod
@@ -0,0 +1,141 @@
+"""
+Defines random numbers that are keyed to the identity of records
+
+A numpy.random.RandomState produces a single stream of random numbers, so
+which value of a column receives which random number depends on the order
+in which values are processed (and on how a table is split in chunks).
+
+A keyedRandom instead derives each random number from a hash of a seed,
+a stream (e.g. the name of a column), the index of the draw and the key
+(e.g. the identifier) of the record it is drawn for. The same record
+therefore always receives the same random numbers, no matter how a table
+is chunked, how many workers process it or in which order.
+
+keyedRandom provides the part of the numpy.random.RandomState interface
+that perturbators use (please see dataPerturbator.perturbBatch) and can be
+passed wherever a RandomState is expected, provided that every draw is of
+one random number (or one row of random numbers) per record.
+
+Example:
+    R = keyedRandom(aDataFrame["PATID"], seed = 42, theStream = ("ADDRESS",))
+    Q = subsPerturbator([("Street", "St.")]).perturbBatch(aDataFrame["ADDRESS"], R)
+"""
+
+import numpy
+
+_GOLDEN = numpy.uint64(0x9E3779B97F4A7C15)
+_FNV_OFFSET = numpy.uint64(0xCBF29CE484222325)
+_FNV_PRIME = numpy.uint64(0x100000001B3)
+
+class keyedRandom(object):
+    """Defines a source of random numbers keyed by record
+
+    Please see the module documentation.
+    """
+    def __init__(self, theKeys, seed = 0, theStream = ()):
+        """Instantiates a keyedRandom
+
+        Args:
+            theKeys: A sequence of record keys (integers or strings), one per record
+            seed: An integer
+            theStream: A tuple of labels (integers or strings) that distinguishes this stream of random numbers from others of the same seed
+
+        Returns:
+            Nothing
+        """
+        self._setUp(hashKeys(theKeys), seed, theStream)
+
+    def _setUp(self, theHashedKeys, seed, theStream):
+        self._keys = theHashedKeys
+        self._seed = seed
+        self._stream = tuple(theStream)
+        self._streamHash = _labelHash(seed)
+        for aLabel in self._stream:
+            self._streamHash = _splitMix64(numpy.array([self._streamHash ^ _labelHash(aLabel)], dtype = numpy.uint64))[0]
+        self._draws = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def stream(self):
+        return self._stream
+
+    def take(self, theRows, aLabel):
+        """Returns the keyedRandom of a subset of the records
+
+        Args:
+            theRows: An integer numpy array, the indices of the records of the subset
+            aLabel: An integer or string that distinguishes this subset from other subsets taken from the same keyedRandom
+
+        Returns:
+            A keyedRandom whose stream is this stream, extended by aLabel
+        """
+        aState = keyedRandom.__new__(keyedRandom)
+        aState._setUp(self._keys[theRows], self._seed, self._stream + (aLabel,))
+        return aState
+
+    def _nextDraw(self):
+        """Returns the hash of the next draw of this stream"""
+        self._draws += 1
+        return _splitMix64(self._streamHash ^ (numpy.arange(self._draws, self._draws + 1, dtype = numpy.uint64) * _GOLDEN))[0]
+
+    def random_sample(self, size = None):
+        """Returns uniform random numbers in [0, 1), one per record (or a records x columns array of them)
+
+        Args:
+            size: An integer (the number of records) or a tuple of (the number of records[, the number of columns])
+        """
+        shape = (size,) if isinstance(size, (int, long, numpy.integer)) else tuple(size)
+        if not shape or shape[0] != len(self._keys) or len(shape) > 2:
+            raise ValueError("A keyedRandom of %d records cannot draw random numbers of shape %s" % (len(self._keys), shape))
+        drawHash = self._nextDraw()
+        with numpy.errstate(over = "ignore"):
+            state = self._keys ^ drawHash
+            if len(shape) == 2:
+                state = state[:, None] + (numpy.arange(1, shape[1] + 1, dtype = numpy.uint64) * _GOLDEN)[None, :]
+            bits = _splitMix64(state)
+        return (bits >> numpy.uint64(11)).astype(numpy.float64) * (1.0 / 9007199254740992.0)
+
+    def randint(self, low, high = None, size = None):
+        """Returns random integers in [low, high), one per record (please see random_sample)"""
+        if high is None:
+            low, high = 0, low
+        return (low + numpy.floor(self.random_sample(size) * (high - low))).astype(numpy.int64)
+
+def hashKeys(theKeys):
+    """Returns a uint64 hash of each of a sequence of keys (integers or strings)
+
+    The hash does not depend on the Python process (unlike the built-in hash of strings).
+    """
+    keys = numpy.asarray(theKeys)
+    if keys.dtype == object:
+        keys = numpy.array(keys.tolist()) if len(keys) else numpy.empty(0, dtype = numpy.int64)
+    with numpy.errstate(over = "ignore"):
+        if keys.dtype.kind in "iub":
+            return _splitMix64(keys.astype(numpy.uint64))
+        if keys.dtype.kind not in "SU":
+            raise TypeError("Record keys must be integers or strings")
+        #FNV-1a over the characters of all keys at once
+        codeType = numpy.uint8 if keys.dtype.kind == "S" else numpy.uint32
+        width = keys.dtype.itemsize // numpy.dtype(codeType).itemsize
+        codes = keys.view(codeType).reshape(len(keys), width).astype(numpy.uint64)
+        lengths = numpy.char.str_len(keys)
+        hashes = numpy.empty(len(keys), dtype = numpy.uint64)
+        hashes.fill(_FNV_OFFSET)
+        #Only the characters of each key are hashed, so that the hash does not depend on the longest key it is hashed with
+        for k in xrange(width):
+            hashes = numpy.where(k < lengths, (hashes ^ codes[:, k]) * _FNV_PRIME, hashes)
+        return _splitMix64(hashes)
+
+def _labelHash(aLabel):
+    """Returns the uint64 hash of a single key (please see hashKeys)"""
+    return hashKeys([aLabel])[0]
+
+def _splitMix64(theStates):
+    """The SplitMix64 finaliser, applied elementwise to a uint64 numpy array"""
+    with numpy.errstate(over = "ignore"):
+        z = theStates + _GOLDEN
+        z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+        return z ^ (z >> numpy.uint64(31))
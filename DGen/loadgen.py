@@ -0,0 +1,553 @@
+"""
+Defines the emission of generated records at a controlled rate
+
+A loadGenerator emits the records of a generator to a sink (e.g. a service
+that ingests them) at a target rate, to load test the sink. Every record is
+due at a time set by a schedule, before any record is emitted:
+
+    * constant: records are evenly spaced at the target rate
+    * bursts: records are due in bursts of burstSize, every burstSize / rate seconds
+    * poisson: records arrive at random, with exponential gaps of mean 1 / rate
+    * sine: the rate varies as rate * (1 + amplitude * sin(2 * pi * t / period))
+
+Records that are due are written to the sink at once, one line of JSON per
+record. The emit latency of a record is the time from when it was due to
+when its write to the sink completed. Since it is measured from the schedule
+(rather than from when the write started), a run that falls behind schedule
+shows it in its latencies, instead of silently emitting at a lower rate.
+
+The records are generated in chunks (optionally, ahead of their emission,
+please see prefetch). The time spent waiting for records is kept apart from
+the time spent writing to the sink, so that a run that fell behind can tell
+whether generation or the sink was the bottleneck.
+
+The sinks are:
+
+    * streamSink: a file-like object (e.g. sys.stdout)
+    * fileSink: a file, appended to
+    * unixSocketSink: a Unix domain (stream) socket
+    * httpSink: an HTTP endpoint, that each write is POSTed to
+    * httpStandIn: a local HTTP server that accepts (and counts) what is POSTed
+      to it, standing in for a service that is not available
+
+Example:
+    aSink = httpSink("http://localhost:8080/ingest")
+    aReport = loadGenerator(Person().record, aSink, rate = 500, shape = "poisson").run(duration = 60)
+    print(aReport.summary())
+
+Example (command line):
+    generate-load --generator patients.py --rate 500 --duration 60 --sink unix:/tmp/ingest.sock
+
+where patients.py defines a randomDataGenerator called generator:
+
+    from DGen.epi.person import Person
+    generator = Person().record
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import argparse
+import importlib
+import threading
+import runpy
+import datetime
+import numpy
+from .datagenerator import randomDataGenerator, _fieldStreams
+from .prefetch import prefetchStream
+from .telemetry import telemetry
+
+try:
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+_timer = getattr(time, "perf_counter", time.time)
+
+_shapes = ("constant", "bursts", "poisson", "sine")
+
+#The percentiles of the emit latency that are reported
+_percentiles = (50, 90, 99, 99.9)
+
+class streamSink(object):
+    """Writes to a file-like object (e.g. sys.stdout)"""
+    def __init__(self, aStream, aName = "stream"):
+        self._stream = getattr(aStream, "buffer", aStream)
+        self.name = aName
+
+    def send(self, theData):
+        self._stream.write(theData)
+        self._stream.flush()
+
+    def close(self):
+        pass
+
+class fileSink(streamSink):
+    """Appends to a file"""
+    def __init__(self, aFilename):
+        super(fileSink,self).__init__(open(aFilename, "ab"), aFilename)
+
+    def close(self):
+        self._stream.close()
+
+class unixSocketSink(object):
+    """Writes to a Unix domain (stream) socket"""
+    def __init__(self, aPath):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(aPath)
+        self.name = aPath
+
+    def send(self, theData):
+        self._socket.sendall(theData)
+
+    def close(self):
+        self._socket.close()
+
+class httpSink(object):
+    """POSTs each write to an HTTP endpoint, as newline delimited JSON, over a persistent connection"""
+    def __init__(self, aURL):
+        aLocation = urlparse(aURL)
+        self._connection = HTTPConnection(aLocation.hostname, aLocation.port or 80)
+        self._path = aLocation.path or "/"
+        self.name = aURL
+
+    def send(self, theData):
+        if self._connection.sock is None:
+            self._connection.connect()
+            #Small requests would otherwise wait for delayed acknowledgements
+            self._connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connection.request("POST", self._path, theData, {"Content-Type":"application/x-ndjson"})
+        aResponse = self._connection.getresponse()
+        aResponse.read()
+        if aResponse.status >= 300:
+            raise IOError("%s responded %d %s" % (self.name, aResponse.status, aResponse.reason))
+
+    def close(self):
+        self._connection.close()
+
+class httpStandIn(object):
+    """A local HTTP server that accepts POSTed records, standing in for an ingestion service
+
+    It counts the requests, records (lines) and bytes it receives and responds
+    with 204 (No Content), optionally after a delay that simulates a slow service.
+    """
+    def __init__(self, port = 0, responseDelay = 0.0):
+        """Instantiates an httpStandIn and starts serving, on a background thread
+
+        Args:
+            port: An integer, the port to listen to on localhost (0 for any free port)
+            responseDelay: A number of seconds to wait before responding to each request
+
+        Returns:
+            Nothing
+        """
+        self.requests = 0
+        self.records = 0
+        self.bytes = 0
+        self._responseDelay = responseDelay
+        self._lock = threading.Lock()
+        self._server = HTTPServer(("127.0.0.1", port), _standInHandler)
+        self._server.standIn = self
+        self._thread = threading.Thread(target = self._server.serve_forever, name = "httpStandIn")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self._server.server_address[1]
+
+    def _received(self, theData):
+        time.sleep(self._responseDelay)
+        with self._lock:
+            self.requests += 1
+            self.records += theData.count(b"\n")
+            self.bytes += len(theData)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class _standInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        self.server.standIn._received(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class latencyHistogram(object):
+    """Counts latencies in logarithmic bins (100 per decade, from 100 ns to 1000 s), in constant memory
+
+    Percentiles are resolved to the upper edge of their bin, within about 2.3%.
+    """
+    _edges = 10.0 ** numpy.arange(-7, 3.005, 0.01)
+
+    def __init__(self):
+        self._counts = numpy.zeros(len(self._edges) + 1, dtype = numpy.int64)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, theLatencies):
+        """Adds a numpy array of latencies (in seconds)"""
+        if len(theLatencies):
+            self._counts += numpy.bincount(numpy.searchsorted(self._edges, theLatencies), minlength = len(self._counts))
+            self.count += len(theLatencies)
+            self.total += float(theLatencies.sum())
+            self.maximum = max(self.maximum, float(theLatencies.max()))
+
+    def percentile(self, q):
+        """Returns the latency that q percent of the latencies do not exceed (or None if there are none)"""
+        if not self.count:
+            return None
+        k = int(numpy.searchsorted(numpy.cumsum(self._counts), math.ceil(q / 100.0 * self.count)))
+        return min(self._edges[min(k, len(self._edges) - 1)], self.maximum)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+class loadReport(object):
+    """Holds the outcome of a run of a loadGenerator
+
+    Attributes:
+        records: The number of records emitted
+        bytes: The number of bytes written to the sink
+        elapsed: The seconds from the start of the run to its last write or, if later, to when its next record would have been due
+        targetRate: The mean rate of the schedule (records per second)
+        achievedRate: The records emitted per second
+        latency: A latencyHistogram of the emit latencies
+        generationSeconds: The seconds spent waiting for records to be generated
+        sinkSeconds: The seconds spent writing to the sink
+        idleSeconds: The seconds spent waiting for records to become due
+        lag: The seconds that the last record was emitted after it was due
+        generationRate: The records generated per second of generation (or None if generation was prefetched)
+    """
+    def __init__(self, targetRate, shape):
+        self.targetRate = targetRate
+        self.shape = shape
+        self.records = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.latency = latencyHistogram()
+        self.generationSeconds = 0.0
+        self.sinkSeconds = 0.0
+        self.idleSeconds = 0.0
+        self.lag = 0.0
+        self.generationRate = None
+
+    @property
+    def achievedRate(self):
+        return self.records / self.elapsed if self.elapsed > 0 else None
+
+    @property
+    def behind(self):
+        """Returns whether the run fell behind its schedule (its last record was late by more than 100 ms or 2% of the run)"""
+        return self.lag > max(0.1, 0.02 * self.elapsed)
+
+    @property
+    def bottleneck(self):
+        """Returns "generation" or "sink", whichever the run spent longer waiting for, if it fell behind (None otherwise)"""
+        if not self.behind:
+            return None
+        return "generation" if self.generationSeconds >= self.sinkSeconds else "sink"
+
+    def percentiles(self):
+        """Returns a list of (percentile, seconds) pairs of the emit latency"""
+        return [(q, self.latency.percentile(q)) for q in _percentiles]
+
+    def summary(self):
+        """Returns a few lines that summarise the run"""
+        lines = ["Emitted %d records (%.1f MB) in %.2f s: %.1f records/s, target %.1f records/s (%s)" % \
+                 (self.records, self.bytes / 1048576.0, self.elapsed, self.achievedRate or 0, self.targetRate, self.shape)]
+        if self.records:
+            lines.append("Emit latency: %s, max %s" % (", ".join(["p%s %s" % (q, _formatLatency(aValue)) for q, aValue in self.percentiles()]),
+                                                      _formatLatency(self.latency.maximum)))
+        elapsed = self.elapsed or 1.0
+        lines.append("Time: generation %.2f s (%.0f%%), sink %.2f s (%.0f%%), idle %.2f s (%.0f%%)" % \
+                     (self.generationSeconds, 100.0 * self.generationSeconds / elapsed, self.sinkSeconds, 100.0 * self.sinkSeconds / elapsed,
+                      self.idleSeconds, 100.0 * self.idleSeconds / elapsed))
+        if self.generationRate is not None:
+            lines.append("Generation alone runs at %.1f records/s (%.1fx the target rate)" % (self.generationRate, self.generationRate / self.targetRate))
+        if self.bottleneck == "generation":
+            lines.append("Generation is the bottleneck: the run fell %.2f s behind schedule, waiting %.2f s for records to be generated" % (self.lag, self.generationSeconds))
+        elif self.bottleneck == "sink":
+            lines.append("The sink is the bottleneck: the run fell %.2f s behind schedule, waiting %.2f s for writes to complete" % (self.lag, self.sinkSeconds))
+        return "\n".join(lines)
+
+class loadGenerator(object):
+    """Emits the records of a generator to a sink at a target rate
+
+    Please see the module documentation.
+    """
+    def __init__(self, theGenerator, theSink, rate, shape = "constant", burstSize = 100, period = 10.0, amplitude = 0.5,
+                 chunkSize = 1000, prefetch = None, seed = None, theTelemetry = None):
+        """Instantiates a loadGenerator
+
+        Args:
+            theGenerator: A randomDataGenerator (e.g. a recordGenerator). It cannot refer to other fields (via varRefGenerator).
+            theSink: The sink that records are written to (please see the module documentation)
+            rate: A number, the mean number of records per second
+            shape: A string, the shape of the schedule: "constant", "bursts", "poisson" or "sine"
+            burstSize: An integer, the number of records per burst (shape "bursts")
+            period: A number of seconds, the period of the variation of the rate (shape "sine")
+            amplitude: A number in [0, 1), the relative amplitude of the variation of the rate (shape "sine")
+            chunkSize: An integer, the number of records generated at a time
+            prefetch: None to generate records when they are needed, "thread" or "process" to generate them ahead (please see prefetch.prefetchStream)
+            seed: An integer that generation (and the schedule) are seeded with (or None)
+            theTelemetry: A telemetry object that the records emitted and the bytes written are reported to (or None)
+
+        Returns:
+            Nothing
+        """
+        if rate <= 0:
+            raise ValueError("The rate of a loadGenerator must be positive")
+        if shape not in _shapes:
+            raise ValueError("Unknown shape %s, expected one of %s" % (shape, ", ".join(_shapes)))
+        if shape == "sine" and not 0 <= amplitude < 1:
+            raise ValueError("The amplitude of a sine shape must be in [0, 1)")
+        if prefetch not in (None, "thread", "process"):
+            raise ValueError("Unknown prefetch %s, expected thread or process" % prefetch)
+        self._generator = theGenerator
+        self._sink = theSink
+        self._rate = float(rate)
+        self._shape = shape
+        self._burstSize = max(int(burstSize), 1)
+        self._period = float(period)
+        self._amplitude = float(amplitude)
+        self._chunkSize = chunkSize
+        self._prefetch = prefetch
+        self._seed = seed
+        self._telemetry = theTelemetry
+        self._tableName = theGenerator.name or "records"
+        #The time the last scheduled record is due (a poisson schedule continues from it)
+        self._lastDue = 0.0
+
+    def schedule(self, theIndices, theRandomState):
+        """Returns the times (in seconds from the start) that the records with the given (consecutive) indices are due
+
+        Args:
+            theIndices: A numpy array of consecutive record indices
+            theRandomState: A numpy.random.RandomState, the source of the gaps of a poisson schedule
+
+        Returns:
+            A numpy array of times, one per index
+        """
+        k = theIndices.astype(numpy.float64)
+        if self._shape == "constant":
+            return k / self._rate
+        if self._shape == "bursts":
+            return numpy.floor(k / self._burstSize) * self._burstSize / self._rate
+        if self._shape == "poisson":
+            return self._lastDue + numpy.cumsum(theRandomState.exponential(1.0 / self._rate, len(k)))
+        #The sine rate integrates to rate * (t + amplitude * period / (2 * pi) * (1 - cos(2 * pi * t / period))),
+        #which is increasing, so the time of record k is found by Newton's method
+        w = 2 * math.pi / self._period
+        t = k / self._rate
+        for anIteration in xrange(20):
+            f = self._rate * (t + self._amplitude / w * (1 - numpy.cos(w * t))) - k
+            t = t - f / (self._rate * (1 + self._amplitude * numpy.sin(w * t)))
+        return t
+
+    def run(self, N = None, duration = None):
+        """Emits records until N records were emitted or duration seconds have passed (whichever comes first)
+
+        Args:
+            N: An integer, the number of records to emit (or None)
+            duration: A number of seconds (or None)
+
+        Returns:
+            A loadReport
+        """
+        if N is None and duration is None:
+            raise ValueError("A run requires a number of records, a duration, or both")
+        aReport = loadReport(self._rate, self._shape)
+        randomState = numpy.random.RandomState(self._seed)
+        self._lastDue = 0.0
+        if self._prefetch is not None:
+            chunks = prefetchStream(_lineChunks, useProcess = self._prefetch == "process", theArguments = (self._generator, self._chunkSize, self._seed),
+                                    theTelemetry = self._telemetry, aQueueName = self._tableName)
+        else:
+            chunks = _lineChunks(self._generator, self._chunkSize, self._seed)
+        lines, dues, offset = [], numpy.zeros(0), 0
+        generatedRecords = 0
+        #When (since the start) the last wait for records ended and how long it took
+        fetchEnd, fetchSeconds = 0.0, 0.0
+        if self._telemetry is not None and N is not None:
+            self._telemetry.expectRows(self._tableName, N)
+        start = _timer()
+        try:
+            while N is None or aReport.records < N:
+                if offset == len(lines):
+                    #Waiting for records, whether they are generated now or were prefetched
+                    before = _timer()
+                    lines = next(chunks)
+                    fetchSeconds = _timer() - before
+                    fetchEnd = before + fetchSeconds - start
+                    aReport.generationSeconds += fetchSeconds
+                    generatedRecords += len(lines)
+                    dues = self.schedule(numpy.arange(generatedRecords - len(lines), generatedRecords), randomState)
+                    self._lastDue = dues[-1]
+                    offset = 0
+                now = _timer() - start
+                if duration is not None and (dues[offset] >= duration or now >= duration):
+                    break
+                if dues[offset] > now:
+                    time.sleep(dues[offset] - now)
+                    aReport.idleSeconds += _timer() - start - now
+                    now = _timer() - start
+                #Every record that is due (within the current chunk and the requested number) is written at once
+                end = int(numpy.searchsorted(dues, now, side = "right"))
+                if N is not None:
+                    end = min(end, offset + N - aReport.records)
+                data = b"".join(lines[offset:end])
+                self._sink.send(data)
+                finish = _timer() - start
+                aReport.sinkSeconds += finish - now
+                aReport.latency.add(finish - dues[offset:end])
+                aReport.lag = finish - dues[end - 1]
+                aReport.records += end - offset
+                aReport.bytes += len(data)
+                aReport.elapsed = finish
+                if self._telemetry is not None:
+                    self._telemetry.addRows(self._tableName, end - offset)
+                    self._telemetry.addBytes(self._sink.name, len(data))
+                offset = end
+        finally:
+            if self._prefetch is not None:
+                chunks.close()
+        #A run that ends ahead of its schedule (e.g. right after a burst) still lasts until its next record is due
+        nextDue = dues[offset] if offset < len(dues) else self.schedule(numpy.arange(generatedRecords, generatedRecords + 1), randomState)[0]
+        aReport.elapsed = max(aReport.elapsed, min(nextDue, duration) if duration is not None else nextDue)
+        if self._prefetch is None and aReport.generationSeconds > 0:
+            aReport.generationRate = generatedRecords / aReport.generationSeconds
+        #A run that stops on its duration while waiting for records only counts the wait up to its end
+        aReport.generationSeconds -= min(max(fetchEnd - aReport.elapsed, 0.0), fetchSeconds)
+        return aReport
+
+def _lineChunks(theGenerator, chunkSize, seed):
+    """Generates chunks of records as lines of JSON (encoded as UTF-8), endlessly
+    
+    If seed is not None, the k-th chunk is generated within the k-th stream of seed (please see 
+    datagenerator._fieldStreams), so the chunks are the same whichever thread or process generates 
+    them and the random modules of the program are left as they were.
+    """
+    k = 0
+    while True:
+        if seed is None:
+            aChunk = theGenerator.generateBatch(chunkSize)
+        else:
+            with _fieldStreams(seed, k):
+                aChunk = theGenerator.generateBatch(chunkSize)
+        k += 1
+        yield [(json.dumps(aValue, default = _jsonValue) + "\n").encode("utf-8") for aValue in aChunk]
+
+def _jsonValue(aValue):
+    """Converts the values that json cannot serialise (dates, numpy scalars, records)"""
+    if isinstance(aValue, (datetime.date, datetime.time)):
+        return aValue.isoformat()
+    if isinstance(aValue, numpy.generic):
+        return aValue.item()
+    if isinstance(aValue, numpy.ndarray):
+        return aValue.tolist()
+    if hasattr(aValue, "items"):
+        return dict(aValue.items())
+    return str(aValue)
+
+def _formatLatency(seconds):
+    if seconds is None:
+        return "-"
+    return "%.3f ms" % (seconds * 1e3) if seconds < 1 else "%.3f s" % seconds
+
+def openSink(aSpecification):
+    """Opens a sink by its specification
+
+    Args:
+        aSpecification: A string, "-" (stdout), "unix:path" (a Unix socket), "http://..." (an HTTP endpoint)
+                        or the name of a file
+
+    Returns:
+        A sink
+    """
+    if aSpecification == "-":
+        return streamSink(sys.stdout, "stdout")
+    if aSpecification.startswith("unix:"):
+        return unixSocketSink(aSpecification[len("unix:"):])
+    if aSpecification.startswith("http://"):
+        return httpSink(aSpecification)
+    return fileSink(aSpecification)
+
+def loadGeneratorTree(aSpecification):
+    """Loads a generator from a Python file or module
+
+    Args:
+        aSpecification: A string, the name of a Python file (or an importable module), optionally
+                        followed by :name, the name of the randomDataGenerator it defines (generator, by default)
+
+    Returns:
+        A randomDataGenerator
+    """
+    aSource, aName = aSpecification, "generator"
+    if ":" in aSpecification and not os.path.exists(aSpecification):
+        aSource, aName = aSpecification.rsplit(":", 1)
+    if aSource.endswith(".py") or os.path.exists(aSource):
+        aGenerator = runpy.run_path(aSource).get(aName)
+    else:
+        aGenerator = getattr(importlib.import_module(aSource), aName, None)
+    if not isinstance(aGenerator, randomDataGenerator):
+        raise ValueError("%s does not define a randomDataGenerator called %s" % (aSource, aName))
+    return aGenerator
+
+def main(argv = None):
+    """The generate-load command"""
+    parser = argparse.ArgumentParser(prog = "generate-load", description = "Emits generated records to a sink at a target rate and reports the achieved rate and emit latency")
+    parser.add_argument("--generator", required = True, help = "A Python file (or module) defining a randomDataGenerator called generator. Use file.py:name for another name.")
+    parser.add_argument("--rate", type = float, required = True, help = "The mean number of records per second")
+    parser.add_argument("--records", type = int, help = "The number of records to emit")
+    parser.add_argument("--duration", type = float, help = "The number of seconds to emit records for")
+    parser.add_argument("--sink", default = "-", help = "- (stdout, the default), a file name, unix:path (a Unix socket), http://... (an HTTP endpoint) or stand-in (a local HTTP stand-in)")
+    parser.add_argument("--shape", choices = _shapes, default = "constant", help = "The shape of the schedule of the records")
+    parser.add_argument("--burst-size", type = int, default = 100, help = "The number of records per burst (--shape bursts)")
+    parser.add_argument("--period", type = float, default = 10.0, help = "The period of the variation of the rate in seconds (--shape sine)")
+    parser.add_argument("--amplitude", type = float, default = 0.5, help = "The relative amplitude of the variation of the rate (--shape sine)")
+    parser.add_argument("--chunk-size", type = int, default = 1000, help = "The number of records generated at a time")
+    parser.add_argument("--prefetch", choices = ["thread", "process"], help = "Generates records ahead of their emission")
+    parser.add_argument("--seed", type = int, help = "The seed of generation and of the schedule")
+    parser.add_argument("--progress", action = "store_true", help = "Shows a progress line")
+    parser.add_argument("--prometheus-file", help = "A file that progress metrics are periodically written to, in the Prometheus text format")
+    args = parser.parse_args(argv)
+    if args.records is None and args.duration is None:
+        parser.error("one of --records or --duration is required")
+    aStandIn = httpStandIn() if args.sink == "stand-in" else None
+    aSink = openSink(aStandIn.url if aStandIn is not None else args.sink)
+    try:
+        with telemetry(prometheusFile = args.prometheus_file, progress = args.progress) as aTelemetry:
+            aReport = loadGenerator(loadGeneratorTree(args.generator), aSink, args.rate, args.shape, args.burst_size, args.period, args.amplitude,
+                                    args.chunk_size, args.prefetch, args.seed, aTelemetry).run(args.records, args.duration)
+    finally:
+        aSink.close()
+        if aStandIn is not None:
+            aStandIn.close()
+    #The report goes to stderr, since stdout may be the sink
+    sys.stderr.write(aReport.summary() + "\n")
+    if aStandIn is not None:
+        sys.stderr.write("The stand-in received %d records in %d requests\n" % (aStandIn.records, aStandIn.requests))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+Defines table level perturbation
+
+A perturbationPlan maps the columns of a table to the perturbators that
+are applied to them. The perturbators are instantiated once, when the plan
+is defined, and every column is then perturbed in batch mode (please see
+dataPerturbator.perturbBatch), in chunks of rows. Since the columns of a
+table are perturbed independently of each other, chunks of different
+columns can be perturbed in parallel, by a pool of threads or processes.
+
+If the plan is given the column of the keys of the records (e.g. their
+identifiers), the random numbers of each value are keyed to its record
+(please see keyedRandom) and a table is perturbed identically no matter
+how it is chunked, streamed or spread over workers.
+
+Example:
+    P = perturbationPlan({"CAUSE":missingDataPerturbator(prob = 0.1),
+                          "PATID":punctuationPerturbator(prob = 0.8),
+                          "ADDRESS":[subsPerturbator([("Street", "St.")], 0.6), punctuationPerturbator(prob = 0.1)]}, seed = 42)
+    perturbedTable = P.apply(aDataFrame, workers = 4)
+"""
+
+import numpy
+from .dataperturbator import dataPerturbator, sequencePerturbator, perturbationLog, toNullableSeries
+from .keyedrandom import keyedRandom
+
+class perturbationPlan(object):
+    """Defines the perturbation of the columns of a table
+
+    Every chunk of every column is perturbed with its own numpy.random.RandomState.
+    If the plan is seeded, these are derived from the seed, the position of the
+    column in the plan and the number of chunks perturbed so far by the plan, so
+    that the outcome of a seeded plan does not depend on the number of workers.
+    
+    If the plan has a key column, every chunk of every column is perturbed with a 
+    keyedRandom instead, keyed by the values of the key column and by the name of 
+    the column, so that the outcome of a seeded plan does not depend on chunking either.
+    """
+    def __init__(self, thePlan, seed = None, keyColumn = None):
+        """Instantiates a perturbationPlan
+
+        Args:
+            thePlan: A dict of column name:perturbator. A list of perturbators is applied in sequence (please see sequencePerturbator).
+            seed: An integer to seed the perturbation with (or None for a random seed)
+            keyColumn: The name of the column that identifies the records of the table (or None)
+
+        Returns:
+            Nothing
+        """
+        self._perturbators = {}
+        for aColumnName, aPerturbator in thePlan.items():
+            if isinstance(aPerturbator, (list, tuple)):
+                aPerturbator = sequencePerturbator(list(aPerturbator))
+            if not isinstance(aPerturbator, dataPerturbator):
+                raise TypeError("Column %s is mapped to %r, which is not a dataPerturbator" % (aColumnName, aPerturbator))
+            self._perturbators[aColumnName] = aPerturbator
+        self._columnNames = sorted(self._perturbators.keys())
+        self._seed = seed if seed is not None else numpy.random.randint(0, 2**31 - 1)
+        self._keyColumn = keyColumn
+        self._chunksPerturbed = 0
+
+    @property
+    def columnNames(self):
+        """Returns the names of the columns that the plan perturbs"""
+        return self._columnNames
+
+    @property
+    def perturbators(self):
+        """Returns the dict of column name:perturbator of the plan"""
+        return self._perturbators
+
+    @property
+    def seed(self):
+        return self._seed
+
+    @property
+    def keyColumn(self):
+        return self._keyColumn
+
+    def apply(self, theTable, chunkSize = 100000, workers = 1, useProcesses = False, log = False):
+        """Perturbs the columns of a table
+
+        Args:
+            theTable: A pandas DataFrame or a dict (or Bunch) of column name:sequence of values
+            chunkSize: An integer, the number of rows of a column that are perturbed at a time
+            workers: An integer, the number of threads (or processes) that perturb chunks in parallel
+            useProcesses: A boolean, whether the workers are processes rather than threads.
+                          Threads share the perturbators but only run in parallel while in numpy.
+                          Processes receive a copy of the perturbator of each chunk they perturb.
+            log: A boolean, whether to also return the perturbationLog of each column
+
+        Returns:
+            A table of the same type as theTable, with the perturbed columns replaced. theTable is not modified.
+            If log is True, a tuple of the table and a dict of column name:perturbationLog.
+        """
+        result = self._apply(theTable, chunkSize, workers, useProcesses, log, self._chunksPerturbed)
+        N = len(theTable[self._columnNames[0]]) if self._columnNames else 0
+        self._chunksPerturbed += len(xrange(0, N, chunkSize))
+        return result
+
+    def _apply(self, theTable, chunkSize, workers, useProcesses, log, theFirstChunk):
+        """Perturbs the columns of a table, as chunks theFirstChunk, theFirstChunk + 1, ... of the plan (please see apply)"""
+        missingColumns = [aColumnName for aColumnName in self._columnNames + ([self._keyColumn] if self._keyColumn is not None else []) if aColumnName not in theTable]
+        if missingColumns:
+            raise KeyError("The table does not have column(s) %s" % ", ".join(missingColumns))
+        N = len(theTable[self._columnNames[0]]) if self._columnNames else 0
+        chunks = [(k, min(k + chunkSize, N)) for k in xrange(0, N, chunkSize)]
+        keys = numpy.asarray(theTable[self._keyColumn]) if self._keyColumn is not None else None
+        tasks = []
+        for aColumnIndex, aColumnName in enumerate(self._columnNames):
+            #Masked missing data perturbators keep the type of a column, all other perturbators work on objects
+            values = numpy.asarray(theTable[aColumnName]) if getattr(self._perturbators[aColumnName], "masked", False) else numpy.asarray(theTable[aColumnName], dtype = object)
+            for aChunkIndex, (start, stop) in enumerate(chunks):
+                if keys is not None:
+                    tasks.append((self._perturbators[aColumnName], values[start:stop], keys[start:stop], (self._seed, aColumnName), log))
+                else:
+                    tasks.append((self._perturbators[aColumnName], values[start:stop], None, [self._seed, aColumnIndex, theFirstChunk + aChunkIndex], log))
+
+        if workers > 1 and len(tasks) > 1:
+            if useProcesses:
+                from multiprocessing import Pool
+            else:
+                from multiprocessing.pool import ThreadPool as Pool
+            aPool = Pool(min(workers, len(tasks)))
+            try:
+                perturbedChunks = aPool.map(_perturbChunk, tasks)
+            finally:
+                aPool.close()
+                aPool.join()
+        else:
+            perturbedChunks = [_perturbChunk(aTask) for aTask in tasks]
+
+        result = theTable.copy() if hasattr(theTable, "iloc") else type(theTable)(theTable)
+        logs = {}
+        for aColumnIndex, aColumnName in enumerate(self._columnNames):
+            columnChunks = perturbedChunks[aColumnIndex * len(chunks):(aColumnIndex + 1) * len(chunks)]
+            if log:
+                logs[aColumnName] = perturbationLog.concatenate([aLog for aChunk, aLog in columnChunks]) if columnChunks else \
+                                    perturbationLog(0, [], numpy.empty(0, dtype = numpy.uint8), numpy.empty(0, dtype = object), self._perturbators[aColumnName].operationNames)
+                columnChunks = [aChunk for aChunk, aLog in columnChunks]
+            if any([isinstance(aChunk, numpy.ma.MaskedArray) for aChunk in columnChunks]):
+                #Masked columns (please see missingDataPerturbator) keep their type
+                column = numpy.ma.concatenate(columnChunks)
+                result[aColumnName] = toNullableSeries(column, result.index) if hasattr(result, "iloc") else column
+            else:
+                result[aColumnName] = numpy.concatenate(columnChunks) if columnChunks else numpy.empty(0, dtype = object)
+        if log:
+            return result, logs
+        return result
+
+    def applyStream(self, theChunks, workers = 1, useProcesses = False, log = False, theTelemetry = None, aTableName = "perturbed"):
+        """Perturbs a stream of chunks of a table (e.g. the chunks of relationalSchema.stream)
+
+        Args:
+            theChunks: An iterable of tables (please see apply)
+            workers, useProcesses, log: Please see apply
+            theTelemetry: A telemetry object that the perturbed rows are reported to (or None)
+            aTableName: A string, the name of the table that the perturbed rows are reported under
+
+        Returns:
+            A generator of the perturbed chunks (or of (chunk, logs) tuples if log is True), in order
+        """
+        for aChunk in theChunks:
+            N = len(aChunk[self._columnNames[0]]) if self._columnNames else 0
+            perturbed = self.apply(aChunk, chunkSize = max(N, 1), workers = workers, useProcesses = useProcesses, log = log)
+            if theTelemetry is not None:
+                theTelemetry.addRows(aTableName, N)
+            yield perturbed
+
+def _perturbChunk(aTask):
+    """Perturbs a chunk of a column (a module level function, so that it can be sent to worker processes)"""
+    aPerturbator, theValues, theKeys, theSeed, log = aTask
+    if theKeys is not None:
+        randomState = keyedRandom(theKeys, theSeed[0], theSeed[1:])
+    else:
+        randomState = numpy.random.RandomState(theSeed)
+    return aPerturbator.perturbBatch(theValues, randomState, log = log)
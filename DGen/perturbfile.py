@@ -0,0 +1,232 @@
+"""
+Defines the perturbation of existing data files
+
+The module applies a perturbationPlan to a data file that already exists
+(e.g. a real extract, or one previously generated by DGen) and writes the
+perturbed data to a new file. The input file is read one chunk of rows at
+a time and chunks are perturbed in parallel, by a pool of worker processes,
+and written to the output file in order. At any time, only a few chunks
+per worker are held in memory, so files of any size can be perturbed.
+
+CSV files are read and written as text, so that the values of columns that
+are not perturbed are copied verbatim. Parquet files require pyarrow.
+
+The perturbation of each chunk only depends on the plan and the position of
+the chunk in the file (or, if the plan has a key column, on the keys of its
+rows) and not on the number of workers.
+
+Example (command line):
+    perturb-file DEATHREG.csv DEATHREG_perturbed.csv --plan deathRegPlan.py --workers 4
+
+where deathRegPlan.py defines a perturbationPlan called plan:
+
+    from DGen.dataperturbator import *
+    from DGen.perturbationplan import perturbationPlan
+    plan = perturbationPlan({"CAUSE":missingDataPerturbator(prob = 0.1)}, seed = 42, keyColumn = "PATID")
+"""
+
+import os
+import sys
+import argparse
+import importlib
+import collections
+import runpy
+from .perturbationplan import perturbationPlan
+from .telemetry import telemetry
+
+_formats = {".csv":"csv", ".parquet":"parquet", ".pq":"parquet"}
+
+def readChunks(aFilename, chunkSize = 100000, aFormat = None):
+    """Reads a data file one chunk of rows at a time
+
+    Args:
+        aFilename: A string, the file to read
+        chunkSize: An integer, the number of rows per chunk
+        aFormat: A string, "csv" or "parquet" (or None to tell by the extension of the file)
+
+    Returns:
+        A generator of pandas DataFrames
+    """
+    aFormat = aFormat or _formatOf(aFilename)
+    if aFormat == "csv":
+        import pandas
+        for aChunk in pandas.read_csv(aFilename, chunksize = chunkSize, dtype = str, keep_default_na = False):
+            yield aChunk
+    else:
+        import pandas
+        import pyarrow.parquet
+        #Row groups are read one at a time (ParquetFile.iter_batches requires a later pyarrow than 
+        #Python 2 supports) and their rows are regrouped into chunks of chunkSize rows
+        aFile = pyarrow.parquet.ParquetFile(aFilename)
+        pending = None
+        for k in range(aFile.num_row_groups):
+            aGroup = aFile.read_row_group(k).to_pandas()
+            pending = aGroup if pending is None else pandas.concat([pending, aGroup], ignore_index = True)
+            while len(pending) >= chunkSize:
+                yield pending.iloc[:chunkSize].reset_index(drop = True)
+                pending = pending.iloc[chunkSize:]
+        if pending is not None and len(pending):
+            yield pending.reset_index(drop = True)
+
+class chunkWriter(object):
+    """Writes chunks of rows to a data file, one after the other"""
+    def __init__(self, aFilename, aFormat = None):
+        """Instantiates a chunkWriter
+
+        Args:
+            aFilename: A string, the file to write (it is overwritten)
+            aFormat: A string, "csv" or "parquet" (or None to tell by the extension of the file)
+
+        Returns:
+            Nothing
+        """
+        self._filename = aFilename
+        self._format = aFormat or _formatOf(aFilename)
+        self._writer = None
+        self._rowsWritten = 0
+        self._chunksWritten = 0
+
+    @property
+    def rowsWritten(self):
+        return self._rowsWritten
+
+    @property
+    def bytesWritten(self):
+        """Returns the size of the file so far (Parquet files are only complete once closed)"""
+        return os.path.getsize(self._filename) if os.path.exists(self._filename) else 0
+
+    def write(self, aChunk):
+        """Appends a chunk (a pandas DataFrame) to the file"""
+        if self._format == "csv":
+            aChunk.to_csv(self._filename, index = False, mode = "a" if self._chunksWritten else "w", header = not self._chunksWritten)
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            aTable = pyarrow.Table.from_pandas(aChunk, preserve_index = False)
+            if self._writer is None:
+                self._writer = pyarrow.parquet.ParquetWriter(self._filename, aTable.schema)
+            self._writer.write_table(aTable)
+        self._rowsWritten += len(aChunk)
+        self._chunksWritten += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        elif not self._chunksWritten and self._format == "csv":
+            open(self._filename, "w").close()
+
+def perturbFile(inputFilename, outputFilename, thePlan, chunkSize = 100000, workers = 1, inputFormat = None, outputFormat = None, theTelemetry = None):
+    """Perturbs a data file
+
+    Args:
+        inputFilename: A string, the file to perturb
+        outputFilename: A string, the file the perturbed data are written to
+        thePlan: A perturbationPlan
+        chunkSize: An integer, the number of rows that are read (and perturbed) at a time
+        workers: An integer, the number of processes that perturb chunks in parallel
+        inputFormat, outputFormat: Strings, "csv" or "parquet" (or None to tell by the extension of each file)
+        theTelemetry: A telemetry object that the rows written, the bytes of the output file and the
+                      number of chunks waiting for (or in) a worker are reported to (or None)
+
+    Returns:
+        An integer, the number of rows written
+    """
+    chunks = readChunks(inputFilename, chunkSize, inputFormat)
+    aWriter = chunkWriter(outputFilename, outputFormat)
+
+    def write(aChunk):
+        aWriter.write(aChunk)
+        if theTelemetry is not None:
+            theTelemetry.addRows(os.path.basename(inputFilename), len(aChunk))
+            theTelemetry.setBytes(outputFilename, aWriter.bytesWritten)
+
+    try:
+        if workers > 1:
+            from multiprocessing import Pool
+            aPool = Pool(workers, _initWorker, (thePlan,))
+            try:
+                #At most two chunks per worker are in flight, the chunks are written in order
+                pending = collections.deque()
+                for aChunkIndex, aChunk in enumerate(chunks):
+                    pending.append(aPool.apply_async(_perturbChunk, (aChunk, aChunkIndex)))
+                    if theTelemetry is not None:
+                        theTelemetry.setQueueDepth("chunks", len(pending))
+                    if len(pending) >= 2 * workers:
+                        write(pending.popleft().get())
+                while pending:
+                    write(pending.popleft().get())
+                    if theTelemetry is not None:
+                        theTelemetry.setQueueDepth("chunks", len(pending))
+                aPool.close()
+            except:
+                aPool.terminate()
+                raise
+            finally:
+                aPool.join()
+        else:
+            for aChunkIndex, aChunk in enumerate(chunks):
+                write(thePlan._apply(aChunk, max(len(aChunk), 1), 1, False, False, aChunkIndex))
+    finally:
+        aWriter.close()
+    return aWriter.rowsWritten
+
+def loadPlan(aSpecification):
+    """Loads a perturbationPlan
+
+    Args:
+        aSpecification: A string, either the path of a Python file or the name of a Python module, optionally
+                        followed by :name, the name of the perturbationPlan it defines (plan, by default)
+
+    Returns:
+        A perturbationPlan
+    """
+    aSource, aName = aSpecification, "plan"
+    if ":" in aSpecification and not os.path.exists(aSpecification):
+        aSource, aName = aSpecification.rsplit(":", 1)
+    if aSource.endswith(".py") or os.path.exists(aSource):
+        aPlan = runpy.run_path(aSource).get(aName)
+    else:
+        aPlan = getattr(importlib.import_module(aSource), aName, None)
+    if not isinstance(aPlan, perturbationPlan):
+        raise ValueError("%s does not define a perturbationPlan called %s" % (aSource, aName))
+    return aPlan
+
+def main(argv = None):
+    """The perturb-file command"""
+    parser = argparse.ArgumentParser(prog = "perturb-file", description = "Perturbs the columns of a CSV or Parquet file according to a perturbationPlan")
+    parser.add_argument("input", help = "The file to perturb")
+    parser.add_argument("output", help = "The file to write the perturbed data to")
+    parser.add_argument("--plan", required = True, help = "A Python file (or module) defining a perturbationPlan called plan. Use file.py:name for another name.")
+    parser.add_argument("--chunk-size", type = int, default = 100000, help = "The number of rows perturbed at a time")
+    parser.add_argument("--workers", type = int, default = 1, help = "The number of worker processes")
+    parser.add_argument("--input-format", choices = ["csv", "parquet"], help = "The format of the input file (by default, told by its extension)")
+    parser.add_argument("--output-format", choices = ["csv", "parquet"], help = "The format of the output file (by default, told by its extension)")
+    parser.add_argument("--progress", action = "store_true", help = "Shows a progress line")
+    parser.add_argument("--prometheus-file", help = "A file that progress metrics are periodically written to, in the Prometheus text format")
+    args = parser.parse_args(argv)
+    with telemetry(prometheusFile = args.prometheus_file, progress = args.progress) as aTelemetry:
+        N = perturbFile(args.input, args.output, loadPlan(args.plan), args.chunk_size, args.workers, args.input_format, args.output_format, aTelemetry)
+    sys.stdout.write("Perturbed %d rows\n" % N)
+    return 0
+
+def _formatOf(aFilename):
+    """Tells the format of a file by its extension"""
+    anExtension = os.path.splitext(aFilename)[1].lower()
+    if anExtension not in _formats:
+        raise ValueError("Cannot tell the format of %s, please specify it" % aFilename)
+    return _formats[anExtension]
+
+_workerPlan = None
+
+def _initWorker(thePlan):
+    """Receives the plan, once per worker process"""
+    global _workerPlan
+    _workerPlan = thePlan
+
+def _perturbChunk(aChunk, aChunkIndex):
+    """Perturbs a chunk of the file in a worker process"""
+    return _workerPlan._apply(aChunk, max(len(aChunk), 1), 1, False, False, aChunkIndex)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""
+Defines the generation of values ahead of their consumption
+
+A consumer of generated data (e.g. a loader or a network sender) that asks
+for data only when it needs it, waits for the data to be generated, while the
+generator waits for the consumer in between. A prefetchStream instead produces
+the chunks of a stream (e.g. relationalSchema.stream) on a background thread or
+process, into a queue of bounded depth, while the consumer is busy with the
+chunks produced before. When the queue is full, the producer waits for the
+consumer (backpressure), so at most depth chunks are held in memory.
+
+A prefetchGenerator does the same for a randomDataGenerator, by generating
+chunks of its values in batch mode, and hands out values (or batches of values)
+on demand.
+
+Threads share the interpreter, so they overlap with consumers that wait (e.g.
+on I/O) or with generation that runs in numpy. Processes overlap in all cases,
+at the cost of sending each chunk to the consumer.
+
+Please note:
+    A producer thread draws from the same random and numpy.random modules as
+    the rest of the program, so its values are not reproducible by seeding.
+    A producer process is seeded on its own (and on every restart, e.g. after
+    close, to a different substream of its seed).
+
+    A producer process generates from a copy of the generator, whose state
+    is lost with the process. Generators that keep state between calls (of
+    unique values or pooled values, anywhere in their tree) are therefore
+    only prefetched by a thread.
+
+Example:
+    with prefetchStream(aSchema.stream(10000), depth = 4) as chunks:
+        for aTableName, aChunk in chunks:
+            send(aChunk)
+
+    P = prefetchGenerator(Person().record, chunkSize = 10000, useProcess = True, seed = 42)
+    someRecords = P.generateBatch(500)
+"""
+
+import random
+import threading
+import traceback
+import multiprocessing
+import numpy
+from .datagenerator import randomDataGenerator, revRegexGenerator, seqGenerator, recordGenerator, pooledGenerator, _referencedNames, _seedStreams
+from .records import _objectColumn
+
+try:
+    from Queue import Queue, Full, Empty
+except ImportError:
+    from queue import Queue, Full, Empty
+
+#The kinds of items that a producer puts in the queue
+_CHUNK, _END, _ERROR = 0, 1, 2
+
+class prefetchStream(object):
+    """Produces the chunks of a stream ahead of their consumption
+
+    Please see the module documentation.
+    """
+    def __init__(self, theChunks, depth = 4, useProcess = False, theArguments = (), theTelemetry = None, aQueueName = "prefetch"):
+        """Instantiates a prefetchStream
+
+        Args:
+            theChunks: An iterable of chunks or a callable that returns one (called with theArguments, by the producer).
+                       A producer process requires a callable.
+            depth: An integer, the largest number of chunks produced ahead of the consumer
+            useProcess: A boolean, whether the producer is a process rather than a thread
+            theArguments: A tuple of the arguments of theChunks (if it is a callable)
+            theTelemetry: A telemetry object that the number of chunks waiting in the queue is reported to (or None)
+            aQueueName: A string, the name of the queue in the telemetry
+
+        Returns:
+            Nothing
+        """
+        if useProcess and not callable(theChunks):
+            raise TypeError("A prefetchStream in a process requires a callable that returns the chunks")
+        if depth < 1:
+            raise ValueError("The depth of a prefetchStream must be at least 1")
+        self._chunks = theChunks
+        self._arguments = tuple(theArguments)
+        self._depth = depth
+        self._useProcess = useProcess
+        self._telemetry = theTelemetry
+        self._queueName = aQueueName
+        self._queue = None
+        self._producer = None
+        self._stopped = None
+        self._finished = False
+
+    def start(self):
+        """Starts the producer (this happens upon the first chunk if it is not called)"""
+        if self._producer is not None or self._finished:
+            return self
+        if self._useProcess:
+            self._queue = multiprocessing.Queue(self._depth)
+            self._stopped = multiprocessing.Event()
+            self._producer = multiprocessing.Process(target = _produce, args = (self._chunks, self._arguments, self._queue, self._stopped, True))
+        else:
+            self._queue = Queue(self._depth)
+            self._stopped = threading.Event()
+            self._producer = threading.Thread(target = _produce, args = (self._chunks, self._arguments, self._queue, self._stopped, False), name = "prefetch")
+        self._producer.daemon = True
+        self._producer.start()
+        return self
+
+    @property
+    def buffered(self):
+        """Returns the number of chunks waiting in the queue (or None if it cannot be told)"""
+        if self._queue is None:
+            return 0
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            return None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Returns the next chunk, waiting for it if it has not been produced yet"""
+        if self._finished:
+            raise StopIteration
+        self.start()
+        while True:
+            try:
+                aKind, aValue = self._queue.get(timeout = 1.0)
+                break
+            except Empty:
+                if not self._producer.is_alive():
+                    self.close()
+                    raise RuntimeError("The producer of a prefetchStream exited unexpectedly")
+        if self._telemetry is not None:
+            self._telemetry.setQueueDepth(self._queueName, self.buffered)
+        if aKind == _CHUNK:
+            return aValue
+        self.close()
+        if aKind == _ERROR:
+            if isinstance(aValue, BaseException):
+                raise aValue
+            raise RuntimeError("The producer of a prefetchStream failed:\n%s" % aValue)
+        raise StopIteration
+
+    __next__ = next
+
+    def close(self):
+        """Stops the producer and discards any chunks produced ahead"""
+        self._finished = True
+        if self._producer is None:
+            return
+        self._stopped.set()
+        #Draining the queue releases a producer that waits to put a chunk
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Empty:
+            pass
+        self._producer.join(5.0)
+        if self._useProcess and self._producer.is_alive():
+            self._producer.terminate()
+        self._producer = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+class prefetchGenerator(randomDataGenerator):
+    """Defines a generator that generates the values of another generator ahead of their use
+
+    Values are generated in chunks, in batch mode, by a prefetchStream and are
+    then handed out one at a time (via __call__) or in batches (via generateBatch).
+    The generator is named after the generator it prefetches.
+    """
+    def __init__(self, theGenerator, chunkSize = 10000, depth = 4, useProcess = False, seed = None, theTelemetry = None):
+        """Instantiates a prefetchGenerator
+
+        Args:
+            theGenerator: The randomDataGenerator whose values are prefetched. It cannot refer to other fields (via varRefGenerator).
+            chunkSize: An integer, the number of values generated at a time
+            depth: An integer, the largest number of chunks generated ahead of their use
+            useProcess: A boolean, whether the values are generated by a process rather than a thread. 
+                        Generators of unique or pooled values cannot be generated by a process (please see the module documentation).
+            seed: An integer that the producer process is seeded with (or None to draw one from the random module)
+            theTelemetry: A telemetry object that the number of chunks waiting is reported to (or None)
+
+        Returns:
+            Nothing
+        """
+        super(prefetchGenerator,self).__init__()
+        if theGenerator.inputNames if isinstance(theGenerator, recordGenerator) else _referencedNames(theGenerator):
+            raise ValueError("A prefetched generator cannot refer to other fields")
+        if useProcess:
+            stateful = _statefulNodes(theGenerator)
+            if stateful:
+                raise ValueError("Generators of unique or pooled values (%s) cannot be prefetched by a process, their state would be lost with it" % 
+                                 ", ".join(sorted(set([aNode.name or type(aNode).__name__ for aNode in stateful]))))
+        self._generator = theGenerator
+        self._chunkSize = chunkSize
+        self._depth = depth
+        self._useProcess = useProcess
+        self._seed = seed
+        self._telemetry = theTelemetry
+        self._stream = None
+        #The number of producers started so far, each of which generates from its own substream of the seed
+        self._starts = 0
+        self._buffer = _objectColumn([])
+        self._offset = 0
+        self.setVarName(theGenerator.name)
+
+    def _nextChunk(self):
+        if self._stream is None:
+            seed = (self._seed if self._seed is not None else random.getrandbits(63)) if self._useProcess else None
+            self._stream = prefetchStream(_generatorChunks, self._depth, self._useProcess, (self._generator, self._chunkSize, seed, self._starts), 
+                                          self._telemetry, self.name or "prefetch")
+            self._starts += 1
+        self._buffer = next(self._stream)
+        self._offset = 0
+
+    def __call__(self):
+        if self._offset == len(self._buffer):
+            self._nextChunk()
+        self._offset += 1
+        return self._buffer[self._offset - 1]
+
+    def generateBatch(self, N):
+        """Hands out the next N values, from as many chunks as required"""
+        pieces = []
+        while N:
+            if self._offset == len(self._buffer):
+                self._nextChunk()
+            taken = min(N, len(self._buffer) - self._offset)
+            pieces.append(self._buffer[self._offset:self._offset + taken])
+            self._offset += taken
+            N -= taken
+        if len(pieces) == 1:
+            return pieces[0]
+        return numpy.concatenate(pieces) if pieces else _objectColumn([])
+
+    def close(self):
+        """Stops generating values ahead"""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self._buffer = _objectColumn([])
+        self._offset = 0
+
+def _generatorChunks(theGenerator, chunkSize, seed, streamIndex = 0):
+    """Generates chunks of the values of a generator, endlessly, from substream streamIndex of seed (if it is not None)"""
+    if seed is not None:
+        _seedStreams(seed, streamIndex & 0xFFFF)
+    while True:
+        yield theGenerator.generateBatch(chunkSize)
+
+def _statefulNodes(aGenerator):
+    """Returns the generators in the tree of aGenerator (including nested records) that keep state between calls
+    
+    These are the generators of unique values (please see uniquevalues.uniqueSequence) and pooledGenerators.
+    """
+    stateful = []
+    visited = set()
+    pending = [aGenerator]
+    while pending:
+        current = pending.pop()
+        if id(current) in visited:
+            continue
+        visited.add(id(current))
+        if isinstance(current, pooledGenerator) or (isinstance(current, (revRegexGenerator, seqGenerator)) and current.unique):
+            stateful.append(current)
+        pending.extend(current.children)
+    return stateful
+
+def _produce(theChunks, theArguments, aQueue, aStopEvent, inProcess):
+    """Puts the chunks of a stream in a queue, waiting whenever the queue is full, until the stream ends or the consumer stops"""
+    try:
+        chunks = theChunks(*theArguments) if callable(theChunks) else theChunks
+        for aChunk in chunks:
+            if not _put(aQueue, (_CHUNK, aChunk), aStopEvent):
+                return
+        _put(aQueue, (_END, None), aStopEvent)
+    except Exception as anException:
+        #Exceptions are sent to the consumer, as text if they have to cross processes
+        _put(aQueue, (_ERROR, traceback.format_exc() if inProcess else anException), aStopEvent)
+
+def _put(aQueue, anItem, aStopEvent):
+    """Puts an item in a queue, waiting while it is full, unless the consumer stops. Returns whether the item was put."""
+    while not aStopEvent.is_set():
+        try:
+            aQueue.put(anItem, timeout = 0.1)
+            return True
+        except Full:
+            pass
+    return False
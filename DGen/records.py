@@ -0,0 +1,337 @@
+"""
+Defines compact representations of generated records
+
+Generators return their records as Bunch objects by default, which are
+convenient but carry a dictionary per record. This module defines two
+more compact representations with the same attribute (and item) access:
+
+ * compactRecord: Slot based records, one object per record without a dictionary.
+ * recordTable: Columnar tables of records (one numpy array per field)
+   whose rows are accessed through light weight views. Nested lists of
+   records (e.g. the events of a person) are stored as childTables,
+   flat columns indexed by an array of offsets, rather than lists of
+   dictionaries.
+"""
+
+import re
+import numpy
+from bunch import Bunch
+
+_identifier = re.compile("^[A-Za-z_][A-Za-z0-9_]*$")
+
+class compactRecord(object):
+    """Defines the base class of slot based records
+
+    A compactRecord stores its fields in slots and supports both attribute
+    and item access, so that it can be used in place of a Bunch whose keys
+    are the same. Unlike a Bunch, fields cannot be added to a compactRecord
+    after its creation.
+
+    This class is not supposed to be instantiated directly. Record classes
+    are derived from it via recordType.
+    """
+    __slots__ = ()
+
+    def __init__(self, *someValues):
+        """Instantiates a record with the values of its fields, in order of declaration"""
+        for aName, aValue in zip(self.__slots__, someValues):
+            setattr(self, aName, aValue)
+
+    def __getitem__(self, aKey):
+        try:
+            return getattr(self, aKey)
+        except AttributeError:
+            raise KeyError(aKey)
+
+    def __setitem__(self, aKey, aValue):
+        if aKey not in self.__slots__:
+            raise KeyError(aKey)
+        setattr(self, aKey, aValue)
+
+    def __contains__(self, aKey):
+        return aKey in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(["%s=%r" % anItem for anItem in self.items()]))
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, aName) for aName in self.__slots__]
+
+    def items(self):
+        return zip(self.__slots__, self.values())
+
+    def get(self, aKey, default = None):
+        return getattr(self, aKey, default)
+
+    def update(self, someValues):
+        """Updates the values of existing fields from a dict (or a record)"""
+        for aKey in someValues.keys():
+            self[aKey] = someValues[aKey]
+
+    def toBunch(self):
+        """Returns the record as a Bunch"""
+        return Bunch(self.items())
+
+def recordType(theFieldNames, theTypeName = "record"):
+    """Creates a compactRecord class for records with specific fields
+
+    Args:
+        theFieldNames: A list of strings, the names of the fields. These must be valid Python identifiers.
+        theTypeName: A string, the name of the class
+
+    Returns:
+        A class derived from compactRecord
+
+    Example:
+        R = recordType(["PATID", "DOB"])
+        r = R("A1234", "1980-01-01 00:00:00")
+        r.PATID, r["DOB"]
+    """
+    theFieldNames = tuple(theFieldNames)
+    for aName in theFieldNames:
+        if not _identifier.match(aName):
+            raise ValueError("%s cannot be used as the name of a field" % aName)
+    return type(theTypeName, (compactRecord,), {"__slots__":theFieldNames})
+
+class recordView(object):
+    """Defines a view to a single row of a recordTable
+
+    A recordView does not hold any values itself. Fields are looked up in
+    the columns of the table upon access and child tables (e.g. events)
+    are returned as recordTables of the rows of the child table that
+    belong to this row.
+    """
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, aTable, anIndex):
+        self._table = aTable
+        self._index = anIndex
+
+    def __getattr__(self, aName):
+        try:
+            return self._table.valueOf(aName, self._index)
+        except KeyError:
+            raise AttributeError(aName)
+
+    def __getitem__(self, aKey):
+        return self._table.valueOf(aKey, self._index)
+
+    def __contains__(self, aKey):
+        return aKey in self._table.fieldNames
+
+    def __iter__(self):
+        return iter(self._table.fieldNames)
+
+    def __repr__(self):
+        return "recordView(%s)" % ", ".join(["%s=%r" % anItem for anItem in self.items()])
+
+    def keys(self):
+        return self._table.fieldNames
+
+    def values(self):
+        return [self._table.valueOf(aName, self._index) for aName in self._table.fieldNames]
+
+    def items(self):
+        return zip(self._table.fieldNames, self.values())
+
+    def get(self, aKey, default = None):
+        try:
+            return self._table.valueOf(aKey, self._index)
+        except KeyError:
+            return default
+
+    def toBunch(self):
+        """Returns the row (including the rows of its child tables) as a Bunch"""
+        return Bunch([(aName, [aChild.toBunch() for aChild in aValue] if isinstance(aValue, recordTable) else aValue) for aName, aValue in self.items()])
+
+class recordTable(object):
+    """Defines a columnar table of records
+
+    A recordTable holds one numpy array per field and, optionally, a number
+    of childTables that hold nested lists of records (e.g. the events of a
+    person). Indexing a recordTable returns a recordView of a row, which
+    supports the same attribute access as the Bunch that the row would
+    otherwise have been.
+
+    Example:
+        T = recordTable({"PATID":numpy.array(["A", "B"], dtype=object)})
+        T[1].PATID
+    """
+    def __init__(self, theColumns, theChildren = None, theFieldNames = None):
+        """Instantiates a recordTable
+
+        Args:
+            theColumns: A dict of field name:numpy array. All arrays must be of the same length.
+            theChildren: A dict of field name:childTable. Each childTable must have one group of rows per row of this table.
+            theFieldNames: A list of the names of all fields (columns and child tables) in order. Defaults to sorted names.
+
+        Returns:
+            Nothing
+        """
+        self._columns = dict(theColumns)
+        self._children = dict(theChildren or {})
+        self._fieldNames = list(theFieldNames) if theFieldNames is not None else sorted(self._columns.keys() + self._children.keys())
+        lengths = set([len(aColumn) for aColumn in self._columns.values()] + [len(aChild) for aChild in self._children.values()])
+        if len(lengths) > 1:
+            raise ValueError("All columns of a recordTable must have the same length")
+        self._N = lengths.pop() if lengths else 0
+
+    @property
+    def fieldNames(self):
+        return self._fieldNames
+
+    @property
+    def columns(self):
+        """Returns the dict of columns of the table (excluding child tables)"""
+        return self._columns
+
+    @property
+    def children(self):
+        """Returns the dict of child tables of the table"""
+        return self._children
+
+    def __len__(self):
+        return self._N
+
+    def __getitem__(self, anIndex):
+        if isinstance(anIndex, slice):
+            return self.take(anIndex)
+        if anIndex < 0:
+            anIndex += self._N
+        if not 0 <= anIndex < self._N:
+            raise IndexError(anIndex)
+        return recordView(self, anIndex)
+
+    def __iter__(self):
+        for k in xrange(self._N):
+            yield recordView(self, k)
+
+    def valueOf(self, aName, anIndex):
+        """Returns the value of field aName at row anIndex"""
+        try:
+            return self._columns[aName][anIndex]
+        except KeyError:
+            return self._children[aName].rowsOf(anIndex)
+
+    def take(self, indices):
+        """Returns a recordTable with the rows at indices (an integer array or a slice)"""
+        return recordTable(dict([(aName, aColumn[indices]) for aName, aColumn in self._columns.items()]),
+                           dict([(aName, aChild.take(indices)) for aName, aChild in self._children.items()]),
+                           self._fieldNames)
+
+    def toDataFrame(self):
+        """Returns the columns of the table (excluding child tables) as a pandas DataFrame"""
+        import pandas
+        return pandas.DataFrame(self._columns, columns = [aName for aName in self._fieldNames if aName in self._columns])
+
+    @classmethod
+    def fromColumns(cls, theColumns, theFieldNames = None):
+        """Instantiates a recordTable from columns of values
+
+        Columns whose values are lists of records (Bunches, dicts, compactRecords
+        or recordViews) are converted to childTables. Columns of lists of any
+        other values are kept as columns of objects.
+
+        Args:
+            theColumns: A dict of field name:sequence of values
+            theFieldNames: A list of the names of the fields in order (please see recordTable)
+        """
+        columns = {}
+        children = {}
+        for aName, aColumn in theColumns.items():
+            if len(aColumn) and all([isinstance(aValue, (list, tuple)) and all([_isRecord(anElement) for anElement in aValue]) for aValue in aColumn]):
+                children[aName] = childTable.fromLists(aColumn)
+            else:
+                columns[aName] = aColumn if isinstance(aColumn, numpy.ndarray) else _objectColumn(aColumn)
+        return cls(columns, children, theFieldNames)
+
+class childTable(object):
+    """Defines a table of nested records, grouped by parent row
+
+    A childTable is a flat recordTable of all the nested records of all
+    parent rows, plus an array of offsets. The nested records of parent
+    row k are the rows offsets[k]:offsets[k+1] of the flat table.
+    """
+    def __init__(self, theRows, theOffsets):
+        """Instantiates a childTable
+
+        Args:
+            theRows: A recordTable with the nested records of all parent rows
+            theOffsets: An integer numpy array with one more element than the parent rows, starting at 0 and ending at len(theRows)
+
+        Returns:
+            Nothing
+        """
+        self._rows = theRows
+        self._offsets = numpy.asarray(theOffsets, dtype = numpy.int64)
+        if self._offsets[0] != 0 or self._offsets[-1] != len(theRows):
+            raise ValueError("The offsets of a childTable must span all of its rows")
+
+    @property
+    def rows(self):
+        """Returns the flat recordTable of all nested records"""
+        return self._rows
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+    @property
+    def parentIndex(self):
+        """Returns, for every nested record, the index of its parent row"""
+        return numpy.repeat(numpy.arange(len(self)), numpy.diff(self._offsets))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def rowsOf(self, anIndex):
+        """Returns the nested records of parent row anIndex as a recordTable"""
+        return self._rows.take(slice(self._offsets[anIndex], self._offsets[anIndex + 1]))
+
+    def take(self, indices):
+        """Returns a childTable with the groups of the parent rows at indices (an integer array or a slice)"""
+        if isinstance(indices, slice):
+            indices = numpy.arange(len(self))[indices]
+        indices = numpy.asarray(indices, dtype = numpy.int64)
+        counts = numpy.diff(self._offsets)[indices]
+        offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+        rows = numpy.repeat(self._offsets[indices] - offsets[:-1], counts) + numpy.arange(offsets[-1])
+        return childTable(self._rows.take(rows), offsets)
+
+    @classmethod
+    def fromLists(cls, someLists):
+        """Instantiates a childTable from one list of records per parent row
+
+        Args:
+            someLists: A sequence of lists of records (Bunches, dicts, compactRecords or recordViews) sharing the same fields
+        """
+        offsets = numpy.concatenate([[0], numpy.cumsum([len(aList) for aList in someLists])])
+        flat = [aRecord for aList in someLists for aRecord in aList]
+        fieldNames = list(flat[0].keys()) if flat else []
+        return cls(recordTable.fromColumns(dict([(aName, [aRecord[aName] for aRecord in flat]) for aName in fieldNames]), sorted(fieldNames)), offsets)
+
+def _isRecord(aValue):
+    """Returns whether a value is a record (a Bunch, dict, compactRecord or recordView)"""
+    return isinstance(aValue, (dict, compactRecord, recordView))
+
+def _objectColumn(values):
+    """Packs a sequence of values into a numpy array of objects, one value per element"""
+    column = numpy.empty(len(values), dtype = object)
+    for k, aValue in enumerate(values):
+        column[k] = aValue
+    return column
@@ -0,0 +1,271 @@
+"""
+Defines relational (multi-table) generators
+
+The module gathers together the classes that describe a relational schema
+of generated tables. An entityTable generates a fixed number of entities
+(e.g. persons) and a dependentTable generates, for every row of its parent
+table, a number of rows (e.g. the primary care events of a person) that
+carry the foreign key of their parent.
+
+A relationalSchema generates its tables directly in columnar form, one
+chunk of parent rows (and the rows that depend on them) at a time, so that
+tables of any size can be generated in bounded memory and without building
+nested records per entity.
+
+Example:
+    P = entityTable("GP_DEM", Person().record, 1000)
+    C = dependentTable("GP_CLIN", P,
+                       [optionGenerator(["ITX10", "QB65"]).setVarName("EVENT_CODE")],
+                       dateTimelineGenerator(varRefGenerator("GP_DEM.DOB"), datetime.datetime.now(), 20).setVarName("EVENT_DATE"))
+    S = relationalSchema([P, C])
+    for aTableName, aChunk in S.stream(chunkSize = 100):
+        ...
+"""
+
+import os
+import numpy
+from bunch import Bunch
+from .datagenerator import randomDataGenerator, constantGenerator, dateTimelineGenerator, recordGenerator, rowContext, _fieldStreams, _random
+
+class entityTable(object):
+    """Defines a table of entities
+
+    An entityTable is the root of a hierarchy of tables. It generates a
+    fixed number of records from a recordGenerator.
+    """
+    def __init__(self, theName, theRecord, N, theColumnNames = None):
+        """Instantiates an entityTable
+
+        Args:
+            theName: A string, the name of the table
+            theRecord: A recordGenerator (or a list of named randomDataGenerators) describing a row of the table
+            N: An integer, the number of rows of the table
+            theColumnNames: A list of the names of the fields that are output as columns of the table (or None for all fields).
+                            The rest of the fields can still be referred to by other fields and by dependent tables.
+
+        Returns:
+            Nothing
+        """
+        self._name = theName
+        self._record = theRecord if isinstance(theRecord, recordGenerator) else recordGenerator(theRecord)
+        self._N = N
+        self._columnNames = list(theColumnNames) if theColumnNames is not None else self._record.fieldNames
+        self._parent = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def parent(self):
+        """Returns the table that this table depends on (None for an entityTable)"""
+        return self._parent
+
+    @property
+    def columnNames(self):
+        """Returns the names of the columns of the table, in order"""
+        return self._columnNames
+
+    @property
+    def inputNames(self):
+        """Returns the names under which the fields of this table are available to its dependent tables"""
+        return ["%s.%s" % (self._name, aName) for aName in self._record.fieldNames]
+
+    def _inputsOf(self, theColumns, theInputs):
+        """Returns the inputs of the tables that depend on this one, given a chunk of its columns (and its own inputs)"""
+        inputs = dict(theInputs)
+        inputs.update([("%s.%s" % (self._name, aName), aColumn) for aName, aColumn in theColumns.items()])
+        return inputs
+
+class dependentTable(entityTable):
+    """Defines a table whose rows depend on the rows of another (parent) table
+
+    For every row of the parent table, a dependentTable generates a number
+    of rows given by a cardinality generator. Each row carries the foreign key
+    of its parent row and the fields of the dependentTable, as well as its
+    cardinality, can refer to the fields of the parent row (and of the
+    parent's own parents) through varRefGenerators named after the table and
+    the field (e.g. varRefGenerator("GP_DEM.DOB")).
+
+    If the cardinality is a (named) dateTimelineGenerator, the number of rows
+    of each parent row is the number of events of its timeline and the
+    (sorted) dates of the timeline are output as a column of the table
+    named after the timeline generator.
+    """
+    def __init__(self, theName, theParent, theFields, theCardinality, theForeignKey = "PATID", theColumnNames = None):
+        """Instantiates a dependentTable
+
+        Args:
+            theName: A string, the name of the table
+            theParent: An entityTable or dependentTable, the parent table
+            theFields: A list of named randomDataGenerators describing a row of the table
+            theCardinality: An integer, a randomDataGenerator of integers or a named dateTimelineGenerator, the number of rows per parent row
+            theForeignKey: A string, the name of the field of the parent table that is copied to each row of this one
+            theColumnNames: A list of the names of the fields that are output as columns of the table (or None for all fields)
+
+        Returns:
+            Nothing
+        """
+        self._timeline = theCardinality if isinstance(theCardinality, dateTimelineGenerator) else None
+        super(dependentTable, self).__init__(theName, recordGenerator(theFields, theInputNames = theParent.inputNames + list(theParent._record.inputNames)), 0, theColumnNames)
+        self._parent = theParent
+        self._cardinality = theCardinality if isinstance(theCardinality, randomDataGenerator) else constantGenerator(theCardinality)
+        self._foreignKey = theForeignKey
+        if theForeignKey not in theParent._record.fieldNames + theParent.columnNames:
+            raise ValueError("The foreign key %s is not a field of table %s" % (theForeignKey, theParent.name))
+        if self._timeline is not None:
+            if self._timeline.name is None:
+                raise ValueError("A timeline that defines the cardinality of a table must be named (please see setVarName)")
+            if theColumnNames is None:
+                self._columnNames = self._columnNames + [self._timeline.name]
+        self._columnNames = [theForeignKey] + [aName for aName in self._columnNames if aName != theForeignKey]
+
+    @property
+    def inputNames(self):
+        names = super(dependentTable, self).inputNames + ["%s.%s" % (self._name, self._foreignKey)]
+        if self._timeline is not None:
+            names.append("%s.%s" % (self._name, self._timeline.name))
+        return names
+
+    @property
+    def foreignKey(self):
+        return self._foreignKey
+
+    def _generate(self, theParentColumns, theParentInputs):
+        """Generates the rows that depend on a chunk of rows of the parent table
+
+        Args:
+            theParentColumns: A dict of the columns of the chunk of the parent table
+            theParentInputs: A dict of the inputs of the parent table (i.e. the columns of its own parents)
+
+        Returns:
+            A tuple of (the columns of this table, its inputs, the index of the parent row of each row)
+        """
+        parentInputs = self._parent._inputsOf(theParentColumns, theParentInputs)
+        N = len(theParentColumns[self._foreignKey])
+        with rowContext() as context:
+            for anInputName, anInput in parentInputs.items():
+                context.setValue(anInputName, anInput)
+            #The number of rows per parent row is drawn from its own stream, like a field of a record
+            #(please see recordGenerator), so that seeding the random module reproduces it
+            with _fieldStreams(_random().getrandbits(64), 0):
+                if self._timeline is not None:
+                    timelines = self._timeline.generateTimelines(N)
+                    counts = numpy.diff(timelines.offsets)
+                else:
+                    counts = numpy.asarray(self._cardinality.generateBatch(N), dtype = numpy.int64)
+        parentIndex = numpy.repeat(numpy.arange(N), counts)
+        #Every row of this table sees the values of its parent row
+        inputs = dict([(anInputName, anInput[parentIndex]) for anInputName, anInput in parentInputs.items()])
+        columns = self._record.generateColumns(len(parentIndex), inputs)
+        if self._timeline is not None:
+            columns[self._timeline.name] = timelines.rows.columns["EVENT_DATE"]
+        columns[self._foreignKey] = theParentColumns[self._foreignKey][parentIndex]
+        return columns, inputs, parentIndex
+
+class relationalSchema(object):
+    """Defines a set of related tables that are generated together
+
+    Tables are generated in chunks of rows of their entityTable. For each
+    chunk, the rows of every dependent table that depend on it are generated
+    directly in columnar form. Only one chunk (and the rows that depend on
+    it) is held in memory at any time.
+    """
+    def __init__(self, theTables):
+        """Instantiates the relationalSchema
+
+        Args:
+            theTables: A list of entityTables and dependentTables. The parent of every dependentTable must be in the list too.
+
+        Returns:
+            Nothing
+        """
+        self._tables = list(theTables)
+        names = [aTable.name for aTable in self._tables]
+        if len(set(names)) != len(names):
+            raise ValueError("Table names must be unique")
+        for aTable in self._tables:
+            if aTable.parent is not None and aTable.parent not in self._tables:
+                raise ValueError("The parent of table %s is not part of the schema" % aTable.name)
+
+    @property
+    def tableNames(self):
+        return [aTable.name for aTable in self._tables]
+
+    def _tablesByName(self, aTableName):
+        return [aTable for aTable in self._tables if aTable.name == aTableName][0]
+
+    def _childrenOf(self, aTable):
+        return [aChild for aChild in self._tables if aChild.parent is aTable]
+
+    def _generateChunk(self, aTable, theColumns, theInputs, theTableNames, asDataFrame):
+        """Yields the chunk of aTable (if requested) and the chunks of all the tables that depend on it"""
+        if aTable.name in theTableNames:
+            yield aTable.name, self._toChunk(aTable, theColumns, asDataFrame)
+        for aChild in self._childrenOf(aTable):
+            if not self._isRequired(aChild, theTableNames):
+                continue
+            childColumns, childInputs, parentIndex = aChild._generate(theColumns, theInputs)
+            for aChunk in self._generateChunk(aChild, childColumns, childInputs, theTableNames, asDataFrame):
+                yield aChunk
+
+    def _isRequired(self, aTable, theTableNames):
+        """Returns True if aTable or any of the tables that depend on it is requested"""
+        return aTable.name in theTableNames or any([self._isRequired(aChild, theTableNames) for aChild in self._childrenOf(aTable)])
+
+    def _toChunk(self, aTable, theColumns, asDataFrame):
+        if asDataFrame:
+            import pandas
+            return pandas.DataFrame(dict([(aName, theColumns[aName]) for aName in aTable.columnNames]), columns = aTable.columnNames)
+        return Bunch([(aName, theColumns[aName]) for aName in aTable.columnNames])
+
+    def stream(self, chunkSize = 10000, theTableNames = None, asDataFrame = True, theTelemetry = None):
+        """Generates the tables of the schema as a stream of chunks
+
+        Args:
+            chunkSize: An integer, the number of rows of an entityTable per chunk
+            theTableNames: A list of the names of the tables to generate (or None for all tables).
+                           Tables that are not requested are only generated if tables that are requested depend on them, and are not output.
+            asDataFrame: A boolean, whether chunks are pandas DataFrames rather than Bunches of numpy arrays
+            theTelemetry: A telemetry object that the rows of each table are reported to (or None)
+
+        Returns:
+            A generator of (table name, chunk) tuples. The chunks of each table appear in order.
+        """
+        theTableNames = set(theTableNames if theTableNames is not None else self.tableNames)
+        unknownNames = theTableNames - set(self.tableNames)
+        if unknownNames:
+            raise ValueError("Unknown table(s) %s" % ", ".join(sorted(unknownNames)))
+        if theTelemetry is not None:
+            for aTable in self._tables:
+                if aTable.parent is None and aTable.name in theTableNames:
+                    theTelemetry.expectRows(aTable.name, aTable._N)
+        for aTable in self._tables:
+            if aTable.parent is not None or not self._isRequired(aTable, theTableNames):
+                continue
+            for k in xrange(0, aTable._N, chunkSize):
+                columns = aTable._record.generateColumns(min(chunkSize, aTable._N - k))
+                for aTableName, aChunk in self._generateChunk(aTable, columns, {}, theTableNames, asDataFrame):
+                    if theTelemetry is not None:
+                        theTelemetry.addRows(aTableName, len(aChunk) if asDataFrame else len(aChunk[self._tablesByName(aTableName).columnNames[0]]))
+                    yield aTableName, aChunk
+
+    def toCSV(self, theDirectory, chunkSize = 10000, theTableNames = None, theTelemetry = None):
+        """Generates the tables of the schema directly to CSV files, one per table, named after the table
+
+        Args:
+            theDirectory: A string, the directory that the files are written to
+            chunkSize, theTableNames: Please see stream
+            theTelemetry: A telemetry object that the rows of each table and the bytes of each file are reported to (or None)
+
+        Returns:
+            A dict of table name:number of rows written
+        """
+        rowsWritten = {}
+        for aTableName, aChunk in self.stream(chunkSize, theTableNames, theTelemetry = theTelemetry):
+            aFilename = os.path.join(theDirectory, "%s.csv" % aTableName)
+            aChunk.to_csv(aFilename, index = False, mode = "a" if aTableName in rowsWritten else "w", header = aTableName not in rowsWritten)
+            rowsWritten[aTableName] = rowsWritten.get(aTableName, 0) + len(aChunk)
+            if theTelemetry is not None:
+                theTelemetry.setBytes(aFilename, os.path.getsize(aFilename))
+        return rowsWritten
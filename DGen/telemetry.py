@@ -0,0 +1,249 @@
+"""
+Defines the telemetry of long generation (and perturbation) jobs
+
+A telemetry object collects the progress of a job while it runs:
+
+    * the rows produced per table (and their rate, since the start and recently)
+    * the bytes written per sink (e.g. per output file)
+    * the depth of the queues between the stages of the job (e.g. the chunks
+      that are waiting for a worker)
+    * the time that the job is expected to take to finish (ETA), for the tables
+      whose total number of rows is known
+
+The batch and streaming paths of DGen (relationalSchema.stream and toCSV,
+perturbationPlan.applyStream and perturbFile) accept a telemetry object and
+update it as they go. Every few seconds, from a background thread, the
+telemetry object reports a snapshot of the job to any of:
+
+    * a callback, that receives the snapshot (a dict)
+    * a file in the Prometheus text exposition format, which is rewritten
+      atomically (e.g. for the textfile collector of the node exporter)
+    * a progress line, rewritten in place on a terminal
+
+Since reports are periodic, a job that has stalled (e.g. because a worker
+hangs) keeps reporting, with a growing number of seconds since its last
+progress.
+
+Example:
+    with telemetry(progress = True, prometheusFile = "dgen.prom") as T:
+        aSchema.toCSV("out", theTelemetry = T)
+"""
+
+import os
+import sys
+import time
+import threading
+
+class telemetry(object):
+    """Collects and reports the progress of a job
+
+    Please see the module documentation.
+    """
+    def __init__(self, theCallback = None, prometheusFile = None, progress = False, interval = 5.0, theStream = None, prefix = "dgen"):
+        """Instantiates a telemetry object
+
+        Args:
+            theCallback: A callable that receives every snapshot (please see snapshot), called from the reporting thread (or None)
+            prometheusFile: A string, the file that the metrics are written to in the Prometheus text format (or None)
+            progress: A boolean, whether to write a progress line to theStream
+            interval: A number of seconds, the period of the reports
+            theStream: A file-like object that the progress line is written to (defaults to sys.stderr)
+            prefix: A string, the prefix of the names of the Prometheus metrics
+
+        Returns:
+            Nothing
+        """
+        self._callback = theCallback
+        self._prometheusFile = prometheusFile
+        self._progress = progress
+        self._interval = interval
+        self._stream = theStream or sys.stderr
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._expectedRows = {}
+        self._bytes = {}
+        self._queues = {}
+        self._start = None
+        self._lastProgress = None
+        self._lastReport = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._progressWidth = 0
+
+    def start(self):
+        """Starts the clock and the periodic reports (please see __enter__)"""
+        self._start = self._lastProgress = time.time()
+        self._lastReport = (self._start, {})
+        if self._callback is not None or self._prometheusFile is not None or self._progress:
+            self._stopped.clear()
+            self._thread = threading.Thread(target = self._reportPeriodically, name = "telemetry")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the periodic reports, after a final report"""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.report()
+        if self._progress:
+            self._stream.write("\n")
+            self._stream.flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+        return False
+
+    def expectRows(self, aTableName, N):
+        """Declares the total number of rows of a table, so that the ETA of the job can be estimated"""
+        with self._lock:
+            self._expectedRows[aTableName] = N
+
+    def addRows(self, aTableName, N):
+        """Records that N more rows of a table were produced"""
+        with self._lock:
+            if self._start is None:
+                self._start = time.time()
+            self._rows[aTableName] = self._rows.get(aTableName, 0) + N
+            self._lastProgress = time.time()
+
+    def addBytes(self, aSinkName, N):
+        """Records that N more bytes were written to a sink"""
+        with self._lock:
+            self._bytes[aSinkName] = self._bytes.get(aSinkName, 0) + N
+
+    def setBytes(self, aSinkName, N):
+        """Records that a sink has received N bytes in total (e.g. the size of an output file)"""
+        with self._lock:
+            self._bytes[aSinkName] = N
+
+    def setQueueDepth(self, aQueueName, N):
+        """Records the number of items currently waiting in a queue"""
+        with self._lock:
+            self._queues[aQueueName] = N
+
+    def snapshot(self):
+        """Returns the state of the job
+
+        Returns:
+            A dict with the keys:
+                elapsed: The seconds since the start of the job
+                secondsSinceProgress: The seconds since rows were last produced
+                tables: A dict of table name:dict of rows, expectedRows, rowsPerSecond (since the start),
+                        recentRowsPerSecond (since the previous report) and eta (seconds, or None)
+                sinks: A dict of sink name:bytes written
+                queues: A dict of queue name:depth
+                eta: The seconds until all the tables with expected rows are complete (or None)
+        """
+        with self._lock:
+            now = time.time()
+            start = self._start if self._start is not None else now
+            elapsed = now - start
+            previousTime, previousRows = self._lastReport if self._lastReport is not None else (start, {})
+            tables = {}
+            for aTableName in sorted(set(self._rows) | set(self._expectedRows)):
+                rows = self._rows.get(aTableName, 0)
+                expected = self._expectedRows.get(aTableName)
+                rate = rows / elapsed if elapsed > 0 else None
+                recentRate = (rows - previousRows.get(aTableName, 0)) / (now - previousTime) if now > previousTime else None
+                eta = None
+                if expected is not None:
+                    eta = 0.0 if rows >= expected else ((expected - rows) / rate if rate else None)
+                tables[aTableName] = {"rows":rows, "expectedRows":expected, "rowsPerSecond":rate, "recentRowsPerSecond":recentRate, "eta":eta}
+            etas = [aTable["eta"] for aTable in tables.values() if aTable["expectedRows"] is not None]
+            return {"elapsed":elapsed,
+                    "secondsSinceProgress":now - (self._lastProgress if self._lastProgress is not None else start),
+                    "tables":tables,
+                    "sinks":dict(self._bytes),
+                    "queues":dict(self._queues),
+                    "eta":(None if None in etas else max(etas)) if etas else None}
+
+    def report(self):
+        """Reports a snapshot of the job to the callback, the Prometheus file and the progress line"""
+        aSnapshot = self.snapshot()
+        with self._lock:
+            self._lastReport = (time.time(), dict(self._rows))
+        if self._callback is not None:
+            self._callback(aSnapshot)
+        if self._prometheusFile is not None:
+            self._writePrometheus(aSnapshot)
+        if self._progress:
+            aLine = progressLine(aSnapshot)
+            #Spaces clear what is left of a longer previous line
+            self._stream.write("\r" + aLine + " " * max(self._progressWidth - len(aLine), 0))
+            self._progressWidth = len(aLine)
+            self._stream.flush()
+        return aSnapshot
+
+    def toPrometheus(self, aSnapshot = None):
+        """Returns a snapshot (by default, the current one) in the Prometheus text exposition format"""
+        aSnapshot = aSnapshot or self.snapshot()
+        p = self._prefix
+        lines = []
+
+        def metric(aName, aType, aHelp, theSamples):
+            lines.append("# HELP %s_%s %s" % (p, aName, aHelp))
+            lines.append("# TYPE %s_%s %s" % (p, aName, aType))
+            for theLabels, aValue in theSamples:
+                if aValue is not None:
+                    labels = ",".join(['%s="%s"' % (aLabel, _escape(aLabelValue)) for aLabel, aLabelValue in theLabels])
+                    lines.append("%s_%s%s %s" % (p, aName, "{%s}" % labels if labels else "", _formatValue(aValue)))
+
+        tables = sorted(aSnapshot["tables"].items())
+        metric("rows_total", "counter", "Rows produced per table", [([("table", aName)], aTable["rows"]) for aName, aTable in tables])
+        metric("rows_expected", "gauge", "Total rows expected per table", [([("table", aName)], aTable["expectedRows"]) for aName, aTable in tables])
+        metric("rows_per_second", "gauge", "Rows produced per second per table, since the start", [([("table", aName)], aTable["rowsPerSecond"]) for aName, aTable in tables])
+        metric("recent_rows_per_second", "gauge", "Rows produced per second per table, since the previous report", [([("table", aName)], aTable["recentRowsPerSecond"]) for aName, aTable in tables])
+        metric("sink_bytes_total", "counter", "Bytes written per sink", [([("sink", aName)], N) for aName, N in sorted(aSnapshot["sinks"].items())])
+        metric("queue_depth", "gauge", "Items waiting per queue", [([("queue", aName)], N) for aName, N in sorted(aSnapshot["queues"].items())])
+        metric("elapsed_seconds", "gauge", "Seconds since the start of the job", [([], aSnapshot["elapsed"])])
+        metric("seconds_since_progress", "gauge", "Seconds since rows were last produced", [([], aSnapshot["secondsSinceProgress"])])
+        metric("eta_seconds", "gauge", "Estimated seconds until the job is complete", [([], aSnapshot["eta"])])
+        return "\n".join(lines) + "\n"
+
+    def _writePrometheus(self, aSnapshot):
+        """Rewrites the Prometheus file atomically, so that it is never read half written"""
+        temporaryFilename = "%s.%d.tmp" % (self._prometheusFile, os.getpid())
+        with open(temporaryFilename, "w") as aFile:
+            aFile.write(self.toPrometheus(aSnapshot))
+        try:
+            os.rename(temporaryFilename, self._prometheusFile)
+        except OSError:
+            #os.rename does not replace an existing file on Windows
+            os.remove(self._prometheusFile)
+            os.rename(temporaryFilename, self._prometheusFile)
+
+    def _reportPeriodically(self):
+        while not self._stopped.wait(self._interval):
+            self.report()
+
+def progressLine(aSnapshot):
+    """Returns a one line summary of a snapshot (please see telemetry.snapshot)"""
+    parts = []
+    for aTableName, aTable in sorted(aSnapshot["tables"].items()):
+        rows = "%d/%d" % (aTable["rows"], aTable["expectedRows"]) if aTable["expectedRows"] is not None else "%d" % aTable["rows"]
+        parts.append("%s %s rows (%.0f/s)" % (aTableName, rows, aTable["rowsPerSecond"] or 0))
+    if aSnapshot["sinks"]:
+        parts.append("%.1f MB written" % (sum(aSnapshot["sinks"].values()) / 1048576.0))
+    if aSnapshot["queues"]:
+        parts.append("queued %s" % ", ".join(["%s %d" % anItem for anItem in sorted(aSnapshot["queues"].items())]))
+    parts.append("elapsed %s" % _formatSeconds(aSnapshot["elapsed"]))
+    if aSnapshot["eta"] is not None:
+        parts.append("ETA %s" % _formatSeconds(aSnapshot["eta"]))
+    return " | ".join(parts)
+
+def _formatSeconds(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def _formatValue(aValue):
+    return "%d" % aValue if isinstance(aValue, (int, long)) else repr(float(aValue))
+
+def _escape(aLabelValue):
+    return str(aLabelValue).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
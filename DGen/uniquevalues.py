@@ -0,0 +1,157 @@
+"""
+Defines the generation of unique values without keeping track of them
+
+Identifiers (e.g. a PATID, a GPID or a postcode) must not repeat. Rather than
+drawing values at random and discarding the ones that were seen before (which
+requires a set of all the values generated so far), a uniqueSequence maps a
+counter (0, 1, 2, ...) through a keyed permutation of the space of all the
+values of a pattern. Distinct counters map to distinct values, so the values
+are unique by construction, in constant memory, while they still look random.
+
+The space of values is mixed radix: each position of a value is drawn from its
+own alphabet (e.g. [A-Z][0-9]{5} has 26 * 10^5 values). The permutation is a
+Feistel network over a rectangle [0, a) x [0, b) that covers the space,
+restricted to the space by cycle walking (please see feistelPermutation).
+
+Example:
+    S = uniqueSequence([u"ABC", u"0123456789"], key = 42)
+    S.take(5)   #Five distinct values, e.g. [u"B7", u"A2", ...]
+"""
+
+import numpy
+from .keyedrandom import _splitMix64, _GOLDEN
+
+#The largest space that is permuted with int64 arithmetic
+_MAX_PERMUTED = 2**62
+
+class feistelPermutation(object):
+    """Defines a keyed permutation of the integers [0, N)
+
+    The integers are split as x = L * b + R, with a * b >= N, and every round
+    maps (L, R) to (R, (L + F(R)) mod a), where F is a keyed hash. Each round
+    is a bijection of [0, a * b), and values that fall outside [0, N) are
+    mapped again until they fall within it (cycle walking), which makes the
+    whole a bijection of [0, N).
+    """
+    def __init__(self, N, key = 0, rounds = 6):
+        """Instantiates a feistelPermutation
+
+        Args:
+            N: An integer, the size of the domain (at most 2**62)
+            key: An integer, the key of the permutation
+            rounds: An integer, the number of Feistel rounds
+
+        Returns:
+            Nothing
+        """
+        if N < 1 or N > _MAX_PERMUTED:
+            raise ValueError("A feistelPermutation permutes between 1 and 2**62 integers, not %d" % N)
+        self._N = N
+        self._a = _ceilSqrt(N)
+        self._b = (N + self._a - 1) // self._a
+        self._roundKeys = _splitMix64(numpy.uint64(key & 0xFFFFFFFFFFFFFFFF) ^ (numpy.arange(1, rounds + 1, dtype = numpy.uint64) * _GOLDEN))
+
+    def __len__(self):
+        return self._N
+
+    def permute(self, theIndices):
+        """Returns the images of an integer numpy array of indices in [0, N)"""
+        values = self._encrypt(numpy.asarray(theIndices, dtype = numpy.int64))
+        outside = numpy.flatnonzero(values >= self._N)
+        while len(outside):
+            values[outside] = self._encrypt(values[outside])
+            outside = outside[values[outside] >= self._N]
+        return values
+
+    def _encrypt(self, theValues):
+        a, b = numpy.int64(self._a), numpy.int64(self._b)
+        values = theValues.copy()
+        for aRoundKey in self._roundKeys:
+            L, R = values // b, values % b
+            F = (_splitMix64(R.astype(numpy.uint64) ^ aRoundKey) % a.astype(numpy.uint64)).astype(numpy.int64)
+            values = a * R + (L + F) % a
+            #The next round splits its input by a instead of b
+            a, b = b, a
+        return values
+
+class uniqueSequence(object):
+    """Maps a counter to unique values of a mixed radix space
+
+    Please see the module documentation.
+    """
+    def __init__(self, theAlphabets, key = 0):
+        """Instantiates a uniqueSequence
+
+        Args:
+            theAlphabets: A list of sequences of characters, the alphabet of each position of a value
+            key: An integer, the key of the permutation
+
+        Returns:
+            Nothing
+        """
+        self._alphabets = [numpy.array(_distinct(anAlphabet), dtype = "U1") for anAlphabet in theAlphabets]
+        self._cardinality = 1
+        for anAlphabet in self._alphabets:
+            self._cardinality *= len(anAlphabet)
+        if not self._cardinality:
+            raise ValueError("Every position of a unique value requires at least one character")
+        #Positions are permuted from the last one backwards while their space fits in int64,
+        #the rest are derived from those (so values still differ wherever the permuted part differs)
+        self._permuted = []
+        permutedSize = 1
+        for k in reversed(xrange(len(self._alphabets))):
+            if permutedSize * len(self._alphabets[k]) > _MAX_PERMUTED:
+                break
+            permutedSize *= len(self._alphabets[k])
+            self._permuted.append(k)
+        self._derived = [k for k in xrange(len(self._alphabets)) if k not in self._permuted]
+        self._permutation = feistelPermutation(permutedSize, key)
+        self._key = numpy.uint64(key & 0xFFFFFFFFFFFFFFFF)
+        self._counter = 0
+
+    @property
+    def cardinality(self):
+        """Returns the number of distinct values of the space"""
+        return self._cardinality
+
+    @property
+    def remaining(self):
+        """Returns the number of unique values that can still be taken"""
+        return max(min(self._cardinality, len(self._permutation)) - self._counter, 0)
+
+    def take(self, N):
+        """Returns the next N unique values
+
+        Raises:
+            ValueError: If fewer than N unique values remain (before any value is taken)
+        """
+        if N > self.remaining:
+            raise ValueError("Cannot take %d more unique values, the space of %d values has %d left" % (N, self._cardinality, self.remaining))
+        indices = self._permutation.permute(numpy.arange(self._counter, self._counter + N, dtype = numpy.int64))
+        self._counter += N
+        if not self._alphabets:
+            return numpy.array([u""] * N, dtype = object)
+        chars = numpy.empty((N, len(self._alphabets)), dtype = "U1")
+        remainder = indices.copy()
+        for k in self._permuted:
+            chars[:, k] = self._alphabets[k][remainder % len(self._alphabets[k])]
+            remainder //= len(self._alphabets[k])
+        if self._derived:
+            hashed = _splitMix64(indices.astype(numpy.uint64) ^ self._key)
+            for k in self._derived:
+                hashed = _splitMix64(hashed ^ numpy.uint64(k))
+                chars[:, k] = self._alphabets[k][(hashed % numpy.uint64(len(self._alphabets[k]))).astype(numpy.int64)]
+        return chars.view("U%d" % len(self._alphabets)).ravel().astype(object)
+
+def _ceilSqrt(N):
+    root = int(N ** 0.5)
+    while root * root < N:
+        root += 1
+    while root > 1 and (root - 1) * (root - 1) >= N:
+        root -= 1
+    return root
+
+def _distinct(theCharacters):
+    """Returns the distinct characters of a sequence, in the order they first appear"""
+    seen = set()
+    return [aCharacter for aCharacter in theCharacters if not (aCharacter in seen or seen.add(aCharacter))]
@@ -0,0 +1,3 @@
+"""Defines DGen's benchmarks
+"""
+__all__ = ["common", "micro", "macro"]
@@ -0,0 +1,158 @@
+"""
+Defines the functions shared by DGen's benchmarks
+
+Benchmark results are saved as JSON documents of the form:
+
+    {"environment":{...}, "results":[{"name":..., "mode":..., <metric>:...}, ...]}
+
+where every result is identified by its name and mode. Two such documents
+(e.g. a stored baseline and a new run) can be compared metric by metric.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import datetime
+
+def environment():
+    """Returns a description of the environment that a benchmark runs in"""
+    import numpy
+    anEnvironment = {"python":platform.python_version(),
+                     "implementation":platform.python_implementation(),
+                     "platform":platform.platform(),
+                     "processor":platform.processor(),
+                     "numpy":numpy.__version__,
+                     "memoryMeasure":memoryMeasure(),
+                     "date":datetime.datetime.now().replace(microsecond = 0).isoformat()}
+    try:
+        import pandas
+        anEnvironment["pandas"] = pandas.__version__
+    except ImportError:
+        pass
+    return anEnvironment
+
+def saveResults(theResults, aFilename):
+    """Saves a list of results (dicts) along with the environment to a JSON file"""
+    with open(aFilename, "w") as aFile:
+        json.dump({"environment":environment(), "results":theResults}, aFile, indent = 1, sort_keys = True)
+
+def loadResults(aFilename):
+    """Loads a JSON file of results saved by saveResults"""
+    with open(aFilename) as aFile:
+        return json.load(aFile)
+
+def bestOf(aFunction, repeats):
+    """Returns the shortest of a number of timings of a function call, in seconds"""
+    timings = []
+    for k in xrange(repeats):
+        start = time.time()
+        aFunction()
+        timings.append(time.time() - start)
+    return min(timings)
+
+def memoryMeasure():
+    """Returns how tracedBytes measures memory here: "tracemalloc", "rusage" or None if it cannot"""
+    try:
+        import tracemalloc
+        return "tracemalloc"
+    except ImportError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    return "rusage" if hasattr(os, "fork") else None
+
+def tracedBytes(aFunction):
+    """Returns the peak number of bytes allocated during a function call (or None if memory cannot be measured here)
+
+    Allocations are traced by tracemalloc where it is available (Python 3). Otherwise (Python 2), the
+    function is called in a forked child process and the growth of the peak resident set size of the
+    child is returned (please see resource.getrusage). This is coarser (memory is counted in pages and
+    memory that the allocator had already obtained is not counted), so the two are not comparable.
+    """
+    aMeasure = memoryMeasure()
+    if aMeasure == "tracemalloc":
+        import tracemalloc
+        wasTracing = tracemalloc.is_tracing()
+        if not wasTracing:
+            tracemalloc.start()
+        try:
+            tracemalloc.clear_traces()
+            baseline = tracemalloc.get_traced_memory()[0]
+            aFunction()
+            return tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            if not wasTracing:
+                tracemalloc.stop()
+    if aMeasure == "rusage":
+        return _forkedPeakBytes(aFunction)
+    return None
+
+def _forkedPeakBytes(aFunction):
+    """Returns the growth of the peak resident set size of a child process during a function call"""
+    import resource
+    #ru_maxrss is in kilobytes, except on macOS where it is in bytes
+    scale = 1 if sys.platform == "darwin" else 1024
+    reader, writer = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    child = os.fork()
+    if child == 0:
+        os.close(reader)
+        try:
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            aFunction()
+            os.write(writer, str((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * scale).encode("ascii"))
+        finally:
+            os._exit(0)
+    os.close(writer)
+    output = b""
+    while True:
+        aPiece = os.read(reader, 64)
+        if not aPiece:
+            break
+        output += aPiece
+    os.close(reader)
+    os.waitpid(child, 0)
+    if not output:
+        raise RuntimeError("The function whose memory was measured failed in the child process")
+    return int(output)
+
+def compareResults(theBaseline, theCurrent, theMetrics, threshold = 0.2):
+    """Compares the results of two benchmark runs
+
+    Args:
+        theBaseline, theCurrent: Documents as loaded by loadResults
+        theMetrics: A dict of metric name:direction, where direction is 1 if higher values are better and -1 if lower values are better
+        threshold: A real number, the relative change of a metric, for the worse, that counts as a regression
+
+    Returns:
+        A list of (name, mode, metric, baseline value, current value, relative change, is regression) tuples
+        for all the metrics of the results that appear in both runs
+    """
+    baseline = dict([((aResult["name"], aResult["mode"]), aResult) for aResult in theBaseline["results"]])
+    comparison = []
+    for aResult in theCurrent["results"]:
+        key = (aResult["name"], aResult["mode"])
+        if key not in baseline:
+            continue
+        for aMetric, direction in sorted(theMetrics.items()):
+            before, after = baseline[key].get(aMetric), aResult.get(aMetric)
+            if before is None or after is None or before == 0:
+                continue
+            change = (after - before) / float(before)
+            comparison.append((key[0], key[1], aMetric, before, after, change, direction * change < -threshold))
+    return comparison
+
+def printComparison(theComparison, theStream = None):
+    """Prints a comparison (please see compareResults) as a table and returns the number of regressions"""
+    theStream = theStream or sys.stdout
+    theStream.write("%-60s %-7s %-18s %14s %14s %9s\n" % ("Benchmark", "Mode", "Metric", "Baseline", "Current", "Change"))
+    for aName, aMode, aMetric, before, after, change, isRegression in theComparison:
+        theStream.write("%-60s %-7s %-18s %14.4g %14.4g %+8.1f%%%s\n" % (aName, aMode, aMetric, before, after, 100 * change, "  REGRESSION" if isRegression else ""))
+    regressions = len([aRow for aRow in theComparison if aRow[-1]])
+    theStream.write("%d regression(s)\n" % regressions)
+    return regressions
@@ -0,0 +1,321 @@
+"""
+Macro benchmark of the data linking example pipelines
+
+examples/detDataLinking.py generates a population of participants,
+denormalises it into four tables, perturbs the death registry and saves the
+tables to CSV files (the "scalar" pipeline). examples/relDataLinking.py
+generates the same four tables directly from a relational schema, in chunks
+of participants, with the batch paths of the generators and perturbators
+(the "batch" pipeline). This benchmark runs either pipeline for populations
+of increasing size (by default 1e3 to 1e4 participants for the scalar
+pipeline and 1e3 to 1e7 for the batch one) and records, for every stage, its
+wall time, the peak resident memory (RSS) of the process by the end of the
+stage and, for the last stage, the number of bytes written.
+
+Every size is run in a fresh Python process, so that the peak RSS of one
+size is not inherited by the next. The results are tabulated along with the
+exponent of the growth of each stage between successive sizes (1 for linear
+scaling, 2 for quadratic and so on), which is where superlinear behaviour
+shows up first.
+
+Usage:
+    python -m benchmarks.macro run [--pipeline scalar|batch] [--sizes 1000,10000,...] [--budget SECONDS] [--output macro.json] [--plot macro.png]
+    python -m benchmarks.macro compare baseline.json results.json [--threshold 0.2]
+
+--budget (300 seconds by default) stops the run before the next (larger)
+size if that size is expected to take longer than that many seconds, by
+linear extrapolation from the last size.
+
+The scalar pipeline generates its participants one record at a time, which
+takes about 30ms per participant (with 10 primary and 10 secondary care
+events each), so the default sizes take about 9 minutes altogether. Larger
+sizes (e.g. --sizes 100000,1000000) take hours and need a larger --budget.
+
+The batch pipeline has no denormalise stage (the tables are generated as
+they are saved). Its generate, perturb and save stages are timed over all the
+chunks of a size. It takes about 0.1ms per participant, with a peak RSS that
+does not grow with N, so 1e6 participants take under 2 minutes and 1e7 about
+16 minutes (which needs a --budget of at least 1000 seconds) and 16GB of disk.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy
+from .common import saveResults, loadResults, compareResults, printComparison
+
+#The metrics of a result and whether higher (1) or lower (-1) values are better
+METRICS = {"seconds":-1, "peakRSS":-1}
+
+STAGES = ["generate", "denormalise", "perturb", "save"]
+
+SIZES = [1000, 2000, 5000, 10000]
+
+BATCH_SIZES = [1000, 10000, 100000, 1000000, 10000000]
+
+#The number of participants per chunk of the batch pipeline
+CHUNK_SIZE = 10000
+
+#The number of seconds that the next size of a run is expected to take, beyond which the run stops
+BUDGET = 300.0
+
+_examples = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples")
+
+def peakRSS():
+    """Returns the peak resident memory of this process so far, in bytes (or None if it cannot be measured)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    #ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def runSize(N, theDirectory, events = 10):
+    """Runs the scalar pipeline once, in this process
+
+    The proportions of cases and deaths are those of the example (half of the
+    population are cases, 40% of the controls and 60% of the cases are dead).
+
+    Args:
+        N: An integer, the number of participants
+        theDirectory: A string, the directory the tables are saved to
+        events: An integer, the number of primary and of secondary care events per participant
+
+    Returns:
+        A list of results (dicts), one per stage
+    """
+    if _examples not in sys.path:
+        sys.path.insert(0, _examples)
+    import detDataLinking
+    random.seed(0)
+    numpy.random.seed(0)
+    results = []
+
+    def timed(aStage, aFunction, *args):
+        start = time.time()
+        value = aFunction(*args)
+        results.append({"name":"detDataLinking[N=%d]" % N, "mode":aStage, "N":N, "seconds":time.time() - start, "peakRSS":peakRSS(), "outputBytes":None})
+        return value
+
+    Z = timed("generate", detDataLinking.generate, N, N // 2, events, events, N // 5, (3 * N) // 10)
+    tables = timed("denormalise", detDataLinking.denormalise, Z)
+    tables = timed("perturb", detDataLinking.perturb, tables)
+    filenames = timed("save", detDataLinking.save, tables, theDirectory)
+    results[-1]["outputBytes"] = sum([os.path.getsize(aFilename) for aFilename in filenames.values()])
+    results[-1]["rows"] = dict([(aName, len(aTable)) for aName, aTable in tables.items()])
+    return results
+
+def runBatchSize(N, theDirectory, events = 10, chunkSize = CHUNK_SIZE):
+    """Runs the batch pipeline once, in this process
+
+    The tables of examples/relDataLinking.py are generated in chunks of chunkSize participants, the
+    chunks of the death registry are perturbed and every chunk is appended to the CSV file of its table.
+    The time of each stage is summed over all chunks and the peak RSS is that by the end of the run.
+
+    Args:
+        N: An integer, the number of participants
+        theDirectory: A string, the directory the tables are saved to
+        events: An integer, the (mean) number of primary and of secondary care events per participant
+        chunkSize: An integer, the number of participants per chunk
+
+    Returns:
+        A list of results (dicts), one per stage
+    """
+    if _examples not in sys.path:
+        sys.path.insert(0, _examples)
+    import relDataLinking
+    from DGen.dataperturbator import missingDataPerturbator, punctuationPerturbator, subsPerturbator
+    from DGen.perturbationplan import perturbationPlan
+    random.seed(0)
+    numpy.random.seed(0)
+    deathRegPlan = perturbationPlan({"CAUSE":missingDataPerturbator(prob = 0.1),
+                                     "PATID":punctuationPerturbator(prob = 0.8),
+                                     "ADDRESS":subsPerturbator([("Street", "St."), ("Avenue", "Avn"), ("Drive", "Drv"), ("Road", "Rd")], 0.6)})
+    seconds = dict([(aStage, 0.0) for aStage in ["generate", "perturb", "save"]])
+    rows = {}
+    chunks = relDataLinking.participantSchema(N, N // 2, events, events, N // 5, (3 * N) // 10).stream(chunkSize)
+    while True:
+        start = time.time()
+        try:
+            aTableName, aChunk = next(chunks)
+        except StopIteration:
+            break
+        seconds["generate"] += time.time() - start
+        if aTableName == "DEATHREG":
+            start = time.time()
+            aChunk = deathRegPlan.apply(aChunk)
+            seconds["perturb"] += time.time() - start
+        start = time.time()
+        aChunk.to_csv(os.path.join(theDirectory, "%s.csv" % aTableName), index = False, mode = "a" if aTableName in rows else "w", header = aTableName not in rows)
+        seconds["save"] += time.time() - start
+        rows[aTableName] = rows.get(aTableName, 0) + len(aChunk)
+    results = [{"name":"relDataLinking[N=%d]" % N, "mode":aStage, "N":N, "seconds":seconds[aStage], "peakRSS":peakRSS(), "outputBytes":None} for aStage in ["generate", "perturb", "save"]]
+    results[-1]["outputBytes"] = sum([os.path.getsize(os.path.join(theDirectory, "%s.csv" % aTableName)) for aTableName in rows])
+    results[-1]["rows"] = rows
+    return results
+
+def run(theSizes = SIZES, events = 10, budget = BUDGET, theStream = None, pipeline = "scalar"):
+    """Runs the pipeline for each size, each in a new process
+
+    Args:
+        theSizes: A list of integers, the numbers of participants
+        events: An integer, the number of primary and of secondary care events per participant
+        budget: A number of seconds, a size is not run (nor any larger one) if it is expected to take longer than this (or None)
+        theStream: A file-like object that progress is reported to (defaults to sys.stderr)
+        pipeline: A string, "scalar" (runSize) or "batch" (runBatchSize)
+
+    Returns:
+        A list of results (dicts)
+    """
+    theStream = theStream or sys.stderr
+    results = []
+    theDirectory = tempfile.mkdtemp(prefix = "dgen-macro-")
+    try:
+        previous = None
+        for N in sorted(theSizes):
+            if budget is not None and previous is not None and previous[1] * N / float(previous[0]) > budget:
+                theStream.write("N=%d is expected to take %.0fs, more than the budget of %.0fs. Stopping\n" % (N, previous[1] * N / float(previous[0]), budget))
+                break
+            theStream.write("N=%d. . ." % N)
+            theStream.flush()
+            aProcess = subprocess.Popen([sys.executable, "-m", "benchmarks.macro", "single", str(N), "--events", str(events), "--directory", theDirectory, "--pipeline", pipeline],
+                                        stdout = subprocess.PIPE, cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            output = aProcess.communicate()[0]
+            if aProcess.returncode != 0:
+                #E.g. out of memory, there is no point in trying larger sizes
+                theStream.write("Failed (exit status %d)\n" % aProcess.returncode)
+                break
+            sizeResults = json.loads(output.decode("utf-8"))
+            results.extend(sizeResults)
+            total = sum([aResult["seconds"] for aResult in sizeResults])
+            theStream.write("%.1fs\n" % total)
+            previous = (N, total)
+    finally:
+        shutil.rmtree(theDirectory, ignore_errors = True)
+    return results
+
+def scaling(theResults):
+    """Returns the exponent of the growth of the wall time and peak RSS of each stage between successive sizes
+
+    Returns:
+        A list of (smaller N, larger N, stage, time exponent, RSS exponent) tuples, where an exponent
+        is log(larger value / smaller value) / log(larger N / smaller N) (or None if it cannot be computed)
+    """
+    bySize = _bySize(theResults)
+    sizes = sorted(bySize)
+    exponents = []
+    for N1, N2 in zip(sizes[:-1], sizes[1:]):
+        for aStage in STAGES:
+            before, after = bySize[N1].get(aStage), bySize[N2].get(aStage)
+            if before is None or after is None:
+                continue
+            exponents.append((N1, N2, aStage, _exponent(before["seconds"], after["seconds"], N1, N2), _exponent(before["peakRSS"], after["peakRSS"], N1, N2)))
+    return exponents
+
+def printScaling(theResults, theStream = None):
+    """Prints the results of a run, and how each stage scales, as tables"""
+    theStream = theStream or sys.stdout
+    bySize = _bySize(theResults)
+    theStream.write("%10s %s %10s %12s %12s\n" % ("N", " ".join(["%12s" % aStage for aStage in STAGES]), "total", "peak RSS MB", "output MB"))
+    for N in sorted(bySize):
+        stages = bySize[N]
+        seconds = [stages[aStage]["seconds"] if aStage in stages else None for aStage in STAGES]
+        rss = max([aResult["peakRSS"] or 0 for aResult in stages.values()])
+        output = stages["save"]["outputBytes"] if "save" in stages else None
+        theStream.write("%10d %s %10.2f %12.1f %12s\n" % (N, " ".join([_formatSeconds(aValue) for aValue in seconds]), sum([aValue or 0 for aValue in seconds]),
+                                                       rss / 1048576.0, "%.1f" % (output / 1048576.0) if output is not None else "-"))
+    exponents = scaling(theResults)
+    if not exponents:
+        return
+    theStream.write("\nScaling exponents (time / peak RSS) between successive sizes:\n")
+    theStream.write("%23s %s\n" % ("N", " ".join(["%15s" % aStage for aStage in STAGES])))
+    pairs = sorted(set([(N1, N2) for N1, N2, aStage, t, m in exponents]))
+    for N1, N2 in pairs:
+        cells = dict([(aStage, (t, m)) for n1, n2, aStage, t, m in exponents if (n1, n2) == (N1, N2)])
+        theStream.write("%23s %s\n" % ("%d->%d" % (N1, N2), " ".join(["%15s" % _formatExponents(cells.get(aStage)) for aStage in STAGES])))
+
+def plot(theResults, aFilename):
+    """Plots the wall time of each stage and the peak RSS against N, on log-log axes, to an image file (requires matplotlib)"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot
+    bySize = _bySize(theResults)
+    sizes = sorted(bySize)
+    aFigure, (timeAxes, memoryAxes) = matplotlib.pyplot.subplots(1, 2, figsize = (12, 5))
+    for aStage in STAGES:
+        points = [(N, bySize[N][aStage]["seconds"]) for N in sizes if aStage in bySize[N]]
+        if not points:
+            continue
+        timeAxes.loglog([N for N, t in points], [t for N, t in points], marker = "o", label = aStage)
+    timeAxes.set_xlabel("Participants")
+    timeAxes.set_ylabel("Wall time (s)")
+    timeAxes.legend()
+    memoryAxes.loglog(sizes, [max([aResult["peakRSS"] or 0 for aResult in bySize[N].values()]) / 1048576.0 for N in sizes], marker = "o")
+    memoryAxes.set_xlabel("Participants")
+    memoryAxes.set_ylabel("Peak RSS (MB)")
+    aFigure.tight_layout()
+    aFigure.savefig(aFilename)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m benchmarks.macro", description = "Macro benchmark of the data linking example pipelines")
+    commands = parser.add_subparsers(dest = "command")
+    runParser = commands.add_parser("run", help = "Runs the benchmark")
+    runParser.add_argument("--pipeline", choices = ["scalar", "batch"], default = "scalar", help = "The pipeline of detDataLinking (scalar) or of relDataLinking (batch)")
+    runParser.add_argument("--sizes", help = "Comma separated numbers of participants (by default %s for the scalar pipeline and %s for the batch one)" % (",".join([str(N) for N in SIZES]), ",".join([str(N) for N in BATCH_SIZES])))
+    runParser.add_argument("--events", type = int, default = 10, help = "The number of primary and of secondary care events per participant")
+    runParser.add_argument("--budget", type = float, default = BUDGET, help = "Stops before the next size if it is expected to take longer than this many seconds")
+    runParser.add_argument("--output", default = "macro.json", help = "The JSON file the results are saved to")
+    runParser.add_argument("--plot", help = "An image file the scaling of each stage is plotted to (requires matplotlib)")
+    compareParser = commands.add_parser("compare", help = "Compares results against a baseline")
+    compareParser.add_argument("baseline", help = "The JSON file of the baseline results")
+    compareParser.add_argument("current", help = "The JSON file of the results to compare")
+    compareParser.add_argument("--threshold", type = float, default = 0.2, help = "The relative change for the worse that counts as a regression")
+    #Runs a single size, in the process started by run
+    singleParser = commands.add_parser("single")
+    singleParser.add_argument("N", type = int)
+    singleParser.add_argument("--events", type = int, default = 10)
+    singleParser.add_argument("--directory", default = ".")
+    singleParser.add_argument("--pipeline", choices = ["scalar", "batch"], default = "scalar")
+    args = parser.parse_args(argv)
+    if args.command == "single":
+        sys.stdout.write(json.dumps((runBatchSize if args.pipeline == "batch" else runSize)(args.N, args.directory, args.events)))
+        return 0
+    if args.command == "run":
+        theSizes = [int(float(aSize)) for aSize in args.sizes.split(",")] if args.sizes else BATCH_SIZES if args.pipeline == "batch" else SIZES
+        results = run(theSizes, args.events, args.budget, pipeline = args.pipeline)
+        saveResults(results, args.output)
+        printScaling(results)
+        if args.plot:
+            plot(results, args.plot)
+        return 0
+    return 1 if printComparison(compareResults(loadResults(args.baseline), loadResults(args.current), METRICS, args.threshold)) else 0
+
+def _bySize(theResults):
+    """Returns a dict of N:dict of stage:result"""
+    bySize = {}
+    for aResult in theResults:
+        bySize.setdefault(aResult["N"], {})[aResult["mode"]] = aResult
+    return bySize
+
+def _exponent(before, after, N1, N2):
+    if not before or not after or N1 == N2:
+        return None
+    return math.log(after / float(before)) / math.log(N2 / float(N1))
+
+def _formatSeconds(aValue):
+    return "%12.2f" % aValue if aValue is not None else "%12s" % "-"
+
+def _formatExponents(theExponents):
+    if theExponents is None:
+        return "-"
+    return "/".join(["%.2f" % anExponent if anExponent is not None else "-" for anExponent in theExponents])
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+"""
+Micro benchmarks of DGen's generators and perturbators
+
+Every generator of DGen.datagenerator and every perturbator of
+DGen.dataperturbator is timed in scalar mode (one call per value) and in
+batch mode (generateBatch / perturbBatch), across a sweep of the parameters
+that its cost depends on (e.g. the number of options of an optionGenerator,
+the shape of a regular expression, the range of a dateGenerator or the
+number of substitutions of a subsPerturbator).
+
+For every case and mode, the benchmark records the number of values per
+second and the peak number of bytes allocated per value. Allocations are
+traced by tracemalloc on Python 3 and estimated from the peak resident set
+size of a forked process on Python 2 (please see common.tracedBytes), so
+bytesPerValue is only compared between runs that measured it the same way.
+
+Usage:
+    python -m benchmarks.micro run [--output results.json] [--filter REGEX] [--quick]
+    python -m benchmarks.micro compare baseline.json results.json [--threshold 0.2]
+
+compare exits with a non-zero status if any benchmark regressed by more than
+the threshold (20% by default).
+"""
+
+import os
+import re
+import sys
+import random
+import argparse
+import datetime
+import tempfile
+import numpy
+from DGen.datagenerator import *
+from DGen.dataperturbator import *
+from DGen.epi.person import Person
+from DGen.epi.utils import StreetNames, Surnames
+from .common import saveResults, loadResults, bestOf, tracedBytes, memoryMeasure, compareResults, printComparison
+
+#The metrics of a result and whether higher (1) or lower (-1) values are better
+METRICS = {"valuesPerSecond":1, "bytesPerValue":-1}
+
+class benchmarkCase(object):
+    """Defines a benchmark of a generator or perturbator, in scalar and batch mode
+
+    The subject of the benchmark is created by a factory, outside of the timings.
+    """
+    def __init__(self, theName, theParameters, theFactory, scalarScale = 1.0):
+        """Instantiates a benchmarkCase
+
+        Args:
+            theName: A string, the name of the class that is benchmarked
+            theParameters: A dict of the parameters of this case
+            theFactory: A callable that returns the subject of the benchmark
+            scalarScale: A real number, the fraction of the usual number of values that is generated in scalar mode (for slow cases)
+
+        Returns:
+            Nothing
+        """
+        self._name = theName
+        self._parameters = theParameters
+        self._factory = theFactory
+        self._scalarScale = scalarScale
+
+    @property
+    def name(self):
+        """Returns the name of the case, including its parameters"""
+        if not self._parameters:
+            return self._name
+        return "%s[%s]" % (self._name, ",".join(["%s=%s" % anItem for anItem in sorted(self._parameters.items())]))
+
+    def _prepare(self, N):
+        """Prepares the inputs of up to N evaluations, outside of the timings"""
+        pass
+
+    def _modes(self, aSubject):
+        """Returns a dict of mode:function of N that evaluates the subject N times"""
+        raise NotImplementedError("benchmarkCases must define how their subject is evaluated")
+
+    def run(self, scalarN, batchN, repeats):
+        """Runs the case in every mode
+
+        Returns:
+            A list of results (dicts)
+        """
+        aSubject = self._factory()
+        self._prepare(max(scalarN, batchN))
+        results = []
+        for aMode, aFunction in sorted(self._modes(aSubject).items()):
+            N = max(int((scalarN * self._scalarScale) if aMode == "scalar" else batchN), 1)
+            seconds = bestOf(lambda: aFunction(N), repeats)
+            allocated = tracedBytes(lambda: aFunction(N))
+            results.append({"name":self.name, "class":self._name, "parameters":self._parameters, "mode":aMode, "N":N,
+                            "seconds":seconds, "valuesPerSecond":N / seconds if seconds > 0 else None,
+                            "bytesPerValue":allocated / float(N) if allocated is not None else None})
+        return results
+
+class generatorCase(benchmarkCase):
+    """Benchmarks a randomDataGenerator, via __call__ and generateBatch"""
+    def _modes(self, aGenerator):
+        return {"scalar":lambda N: [aGenerator() for k in xrange(N)],
+                "batch":lambda N: aGenerator.generateBatch(N)}
+
+class perturbatorCase(benchmarkCase):
+    """Benchmarks a dataPerturbator, via __call__ and perturbBatch, on a column of addresses"""
+    def __init__(self, theName, theParameters, theFactory, scalarScale = 1.0):
+        super(perturbatorCase, self).__init__(theName, theParameters, theFactory, scalarScale)
+        self._values = None
+
+    def _prepare(self, N):
+        self._valuesOf(N)
+
+    def _valuesOf(self, N):
+        if self._values is None or len(self._values) < N:
+            aRandomState = numpy.random.RandomState(0)
+            streets = numpy.array(StreetNames, dtype = object)[aRandomState.randint(0, len(StreetNames), N)]
+            self._values = numpy.array(["%d %s" % (k % 200 + 1, aStreet) for k, aStreet in enumerate(streets)], dtype = object)
+        return self._values[:N]
+
+    def _modes(self, aPerturbator):
+        return {"scalar":lambda N: [aPerturbator(aValue) for aValue in self._valuesOf(N)],
+                "batch":lambda N: aPerturbator.perturbBatch(self._valuesOf(N), numpy.random.RandomState(0))}
+
+def _substitutions(N):
+    """Returns N (from, to) substitutions, a few of which apply to the addresses the perturbators are benchmarked on"""
+    common = [("Street", "St."), ("Avenue", "Avn"), ("Drive", "Drv"), ("Road", "Rd"), ("Lane", "Ln")]
+    return (common + [("%s%d" % (aSurname, k), aSurname[:3]) for k, aSurname in enumerate(Surnames * (N // len(Surnames) + 1))])[:N]
+
+def _filledPool():
+    """Returns a pooledGenerator whose pool is already filled, so that only lookups (and refreshes) are timed"""
+    aGenerator = revRegexGenerator("([a-z]{3})-\\1").pooled(10000, refreshEvery = 100000)
+    aGenerator.pool
+    return aGenerator
+
+def _archivedOptions(N, weighted = False):
+    """Returns an archivedOptionGenerator of N street names, read from a temporary file (that is removed once read)"""
+    aHandle, aFilename = tempfile.mkstemp(suffix = ".csv")
+    try:
+        with os.fdopen(aHandle, "w") as aFile:
+            for k in xrange(N):
+                aName = "%s %d" % (StreetNames[k % len(StreetNames)], k)
+                aFile.write("%f,%s\n" % (1.0 / N, aName) if weighted else "%s\n" % aName)
+        return archivedOptionGenerator(aFilename)
+    finally:
+        os.remove(aFilename)
+
+def _varRefRecord():
+    """Returns a recordGenerator whose fields refer to an earlier field of the record via varRefGenerators"""
+    return recordGenerator([optionGenerator(Surnames).setVarName("Surname"),
+                            varRefGenerator("Surname").setVarName("SurnameAtBirth"),
+                            (condProbOptionGenerator({"1":varRefGenerator("Surname"), "0":optionGenerator(Surnames)}) | optionGenerator(["0", "1"])).setVarName("SurnameAtDeath")])
+
+def cases():
+    """Returns the list of all benchmark cases"""
+    now = datetime.datetime(2017, 4, 1)
+    allCases = [generatorCase("constantGenerator", {}, lambda: constantGenerator("A constant"))]
+    for N in [2, 100, 1700, 1000000]:
+        allCases.append(generatorCase("optionGenerator", {"options":N}, lambda N = N: optionGenerator(["Option %d" % k for k in xrange(N)]),
+                                      scalarScale = min(1.0, 100.0 / N)))
+    allCases.append(generatorCase("optionGenerator", {"options":2, "weighted":True}, lambda: optionGenerator([(0.2, "Male"), (0.8, "Female")])))
+    for N in [100, 10000]:
+        allCases.append(generatorCase("archivedOptionGenerator", {"options":N}, lambda N = N: _archivedOptions(N), scalarScale = min(1.0, 100.0 / N)))
+        allCases.append(generatorCase("archivedOptionGenerator", {"options":N, "weighted":True}, lambda N = N: _archivedOptions(N, True), scalarScale = min(1.0, 100.0 / N)))
+    for N in [2, 1700, 1000000]:
+        allCases.append(generatorCase("aliasGenerator", {"options":N}, lambda N = N: aliasGenerator(["Option %d" % k for k in xrange(N)], numpy.arange(1, N + 1))))
+    for aShape, aRegex in [("postcode", "[A-Z]{2}[0-9]{2}[A-Z]{2}"), ("houseNumber", "([1-9]|([1-9][0-9]?[0-9]?)) "),
+                           ("alternation", "(Mr|Mrs|Ms|Dr) [A-Z][a-z]{3,8}"), ("phone", "0[0-9]{3} [0-9]{3} [0-9]{4}"),
+                           ("backreference", "([a-z]{3})-\\1")]:
+        allCases.append(generatorCase("revRegexGenerator", {"shape":aShape}, lambda aRegex = aRegex: revRegexGenerator(aRegex)))
+    allCases.append(generatorCase("uidGenerator", {}, uidGenerator))
+    for N in [1, 8, 32]:
+        allCases.append(generatorCase("seqGenerator", {"length":N}, lambda N = N: seqGenerator("ABCDEFGHIJ0123456789", N)))
+    for aRange, aDelta in [("day", datetime.timedelta(days = 1)), ("year", datetime.timedelta(days = 365)), ("century", datetime.timedelta(days = 36525))]:
+        allCases.append(generatorCase("dateGenerator", {"range":aRange}, lambda aDelta = aDelta: dateGenerator(now - aDelta, now)))
+    for N in [1, 10, 100]:
+        allCases.append(generatorCase("dateTimelineGenerator", {"events":N}, lambda N = N: dateTimelineGenerator(datetime.datetime(1950, 1, 1), now, N),
+                                      scalarScale = 1.0 / N))
+    allCases.append(generatorCase("pooledGenerator", {"pool":10000}, _filledPool))
+    allCases.append(generatorCase("compositeORGenerator", {}, lambda: revRegexGenerator("([1-9]|([1-9][0-9]?[0-9]?)) ") * optionGenerator(StreetNames)))
+    allCases.append(generatorCase("condProbOptionGenerator", {}, lambda: condProbOptionGenerator({"Male":optionGenerator(["John", "Jack"]), "Female":optionGenerator(["Jane", "Jill"])}) | optionGenerator(["Male", "Female"])))
+    allCases.append(generatorCase("varRefGenerator", {"record":"surnames"}, _varRefRecord))
+    allCases.append(generatorCase("recordGenerator", {"record":"Person"}, lambda: Person().record, scalarScale = 0.1))
+
+    for aProb in [0.1, 1.0]:
+        allCases.append(perturbatorCase("missingDataPerturbator", {"prob":aProb}, lambda aProb = aProb: missingDataPerturbator("N/A", aProb)))
+        allCases.append(perturbatorCase("prefixPerturbator", {"prob":aProb}, lambda aProb = aProb: prefixPerturbator(["Mr ", "Dr ", "Sir "], aProb)))
+        allCases.append(perturbatorCase("suffixPerturbator", {"prob":aProb}, lambda aProb = aProb: suffixPerturbator([" Jr", " Sr"], aProb)))
+        allCases.append(perturbatorCase("punctuationPerturbator", {"prob":aProb}, lambda aProb = aProb: punctuationPerturbator(aProb)))
+    for N in [4, 100, 1000, 10000]:
+        allCases.append(perturbatorCase("subsPerturbator", {"substitutions":N}, lambda N = N: subsPerturbator(_substitutions(N), 1.0)))
+        allCases.append(perturbatorCase("subsPerturbator", {"substitutions":N, "sequential":True}, lambda N = N: subsPerturbator(_substitutions(N), 1.0, sequential = True),
+                                        scalarScale = min(1.0, 100.0 / N)))
+    allCases.append(perturbatorCase("sequencePerturbator", {}, lambda: subsPerturbator(_substitutions(4), 0.6) * punctuationPerturbator(0.2) * missingDataPerturbator("N/A", 0.1)))
+    allCases.append(perturbatorCase("optionPerturbator", {}, lambda: punctuationPerturbator(1.0) ^ missingDataPerturbator("N/A", 1.0)))
+    allCases.append(perturbatorCase("atMostPerturbator", {"k":1}, lambda: atMostPerturbator([punctuationPerturbator(0.5), prefixPerturbator(["Mr "], 0.5), missingDataPerturbator("N/A", 0.5)], 1)))
+    return allCases
+
+def run(theFilter = None, quick = False, theStream = None):
+    """Runs the benchmarks
+
+    Args:
+        theFilter: A regular expression, only the cases whose name matches it are run (or None for all cases)
+        quick: A boolean, whether to generate ten times fewer values and time each case once
+        theStream: A file-like object that progress is reported to (defaults to sys.stderr)
+
+    Returns:
+        A list of results (dicts)
+    """
+    theStream = theStream or sys.stderr
+    if memoryMeasure() is None:
+        theStream.write("WARNING: Memory cannot be measured here (neither tracemalloc nor resource and fork are available), bytesPerValue is not recorded\n")
+    scalarN, batchN, repeats = (2000, 20000, 1) if quick else (20000, 200000, 3)
+    results = []
+    for aCase in cases():
+        if theFilter is not None and not re.search(theFilter, aCase.name):
+            continue
+        random.seed(0)
+        numpy.random.seed(0)
+        for aResult in aCase.run(scalarN, batchN, repeats):
+            theStream.write("%-60s %-7s %14.0f values/s\n" % (aResult["name"], aResult["mode"], aResult["valuesPerSecond"] or 0))
+            results.append(aResult)
+    return results
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m benchmarks.micro", description = "Micro benchmarks of DGen's generators and perturbators")
+    commands = parser.add_subparsers(dest = "command")
+    runParser = commands.add_parser("run", help = "Runs the benchmarks")
+    runParser.add_argument("--output", default = "micro.json", help = "The JSON file the results are saved to")
+    runParser.add_argument("--filter", help = "A regular expression, only the benchmarks whose name matches it are run")
+    runParser.add_argument("--quick", action = "store_true", help = "Generates fewer values, for a quick check")
+    compareParser = commands.add_parser("compare", help = "Compares results against a baseline")
+    compareParser.add_argument("baseline", help = "The JSON file of the baseline results")
+    compareParser.add_argument("current", help = "The JSON file of the results to compare")
+    compareParser.add_argument("--threshold", type = float, default = 0.2, help = "The relative change for the worse that counts as a regression")
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        saveResults(run(args.filter, args.quick), args.output)
+        return 0
+    baseline, current = loadResults(args.baseline), loadResults(args.current)
+    metrics = dict(METRICS)
+    measures = (baseline["environment"].get("memoryMeasure"), current["environment"].get("memoryMeasure"))
+    if measures[0] != measures[1]:
+        sys.stderr.write("bytesPerValue is not compared, it was measured by %s in the baseline and by %s now\n" % measures)
+        del metrics["bytesPerValue"]
+    return 1 if printComparison(compareResults(baseline, current, metrics, args.threshold)) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
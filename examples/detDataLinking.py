@@ -5,10 +5,12 @@ Athanasios Anastasiou April 2017
 
 from DGen.datagenerator import *
 from DGen.dataperturbator import *
+from DGen.perturbationplan import perturbationPlan
 from DGen.epi.person import Person
 from DGen.epi.utils import StreetNames
 import bunch
 import sys
+import os
 import pandas
 
 class Participant(Person):
@@ -127,27 +129,31 @@ class CaseParticipant(ControlParticipant):
         participantData.update({'PCD':[self._primaryCareData() for k in xrange(0,self._NprimaryCareData)], 'SCD':[self._secondaryCareData() for k in xrange(0,self._NsecondaryCareData)]})
         return participantData
         
-if __name__ == "__main__":
-    NPersons = 100 #A population of 100 persons
-    NCase = 50 #50 of them should be case persons
-    NPCD = 10 #Each with 10 events in primary care
-    NSCD = 10 #and 10 events in secondary care
-    NControlDead = 20 #5 out of the 50 should be dead
-    NCaseDead = 30 #12 out of the 50 should be dead 
+def generate(NPersons = 100, NCase = 50, NPCD = 10, NSCD = 10, NControlDead = 20, NCaseDead = 30):
+    """Generates a population of control and case participants, in random order
 
+    Args:
+        NPersons: An integer, the size of the population
+        NCase: An integer, how many of them are case participants
+        NPCD, NSCD: Integers, the number of primary and secondary care events of each participant
+        NControlDead, NCaseDead: Integers, how many control and case participants (on average) are dead
 
-    #Generate a dataset
-    sys.stdout.write("Generating dataset. . .");    
+    Returns:
+        A list of participants (Bunches)
+    """
     #Generate the controls
     ZControl = [ControlParticipant(probOfDeath = NControlDead/float((NPersons-NCase)),NPrimaryCareEvents = NPCD, NSecondaryCareEvents = NSCD)() for k in xrange(0,NPersons-NCase)]
     #Generate the cases
     ZCase = [CaseParticipant(NCaseDead/float(NCase), NPCD, NSCD)() for k in xrange(0,NCase)]
     #Put them together in the same list and randomise their index so that they are mixed
-    Z = random.sample(ZControl + ZCase, NPersons)    
-    sys.stdout.write("Done\n")
-    
-    #Split into different tables
-    sys.stdout.write("Denormalising. . .")    
+    return random.sample(ZControl + ZCase, NPersons)
+
+def denormalise(Z):
+    """Splits a population into the GP_DEM, GP_CLIN, HOSPDAT and DEATHREG tables
+
+    Returns:
+        A dict of table name:list of rows (dicts)
+    """
     GP_DEM = []
     GP_CLIN = []
     HOSPDAT = []
@@ -160,19 +166,58 @@ if __name__ == "__main__":
             HOSPDAT.append({'PATID':aPerson.PATID, 'HOSPID':aHospDat.HOSPID, 'EVENT_DATE':aHospDat.EVENT_DATE, 'EVENT_CODE':aHospDat.EVENT_CODE})            
         if aPerson.DC:
             DEATHREG.append({'PATID':aPerson.PATID, 'NAME':aPerson.Name, 'SURNAME':aPerson.Surname, 'DOB':aPerson.DOB, 'GENDER':aPerson.Gender, 'ADDRESS':aPerson.Address, 'POSTCODE':aPerson.Postcode, 'DOD':aPerson.DC.DATE, 'CAUSE':aPerson.DC.CAUSE})
+    return {"GP_DEM":GP_DEM, "GP_CLIN":GP_CLIN, "HOSPDAT":HOSPDAT, "DEATHREG":DEATHREG}
+
+#Perturbing just the death registry here
+deathRegPlan = perturbationPlan({'CAUSE':missingDataPerturbator(prob=0.1),
+                                 'PATID':punctuationPerturbator(prob=0.8),
+                                 'ADDRESS':subsPerturbator([('Street','St.'),('Avenue', 'Avn'), ('Drive','Drv'), ('Road','Rd')],0.6)})
+
+def perturb(theTables):
+    """Converts the tables to DataFrames and perturbs the death registry
+
+    Returns:
+        A dict of table name:pandas DataFrame
+    """
+    tables = dict([(aName, pandas.DataFrame.from_dict(theRows)) for aName, theRows in theTables.items()])
+    tables["DEATHREG"] = deathRegPlan.apply(tables["DEATHREG"]) if theTables["DEATHREG"] else pandas.DataFrame()
+    return tables
+
+def save(theTables, theDirectory = "."):
+    """Saves each table to a CSV file
+
+    Returns:
+        A dict of table name:the file it was saved to
+    """
+    filenames = {}
+    for aName, aTable in theTables.items():
+        filenames[aName] = os.path.join(theDirectory, "%s.csv" % aName)
+        aTable.to_csv(filenames[aName], index = False)
+    return filenames
+
+if __name__ == "__main__":
+    NPersons = 100 #A population of 100 persons
+    NCase = 50 #50 of them should be case persons
+    NPCD = 10 #Each with 10 events in primary care
+    NSCD = 10 #and 10 events in secondary care
+    NControlDead = 20 #5 out of the 50 should be dead
+    NCaseDead = 30 #12 out of the 50 should be dead 
+
+
+    #Generate a dataset
+    sys.stdout.write("Generating dataset. . .");    
+    Z = generate(NPersons, NCase, NPCD, NSCD, NControlDead, NCaseDead)
+    sys.stdout.write("Done\n")
+    
+    #Split into different tables
+    sys.stdout.write("Denormalising. . .")    
+    tables = denormalise(Z)
     #Data pertubation
     sys.stdout.write("Done\n")               
     sys.stdout.write("Perturbing data fields. . .")
-    #Perturbing just the death registry here
-    for aDeadPerson in DEATHREG:
-        aDeadPerson['CAUSE'] = missingDataPerturbator(prob=0.1)(aDeadPerson['CAUSE'])        
-        aDeadPerson['PATID'] = punctuationPerturbator(prob=0.8)(aDeadPerson['PATID'])        
-        aDeadPerson['ADDRESS'] = subsPerturbator([('Street','St.'),('Avenue', 'Avn'), ('Drive','Drv'), ('Road','Rd')],0.6)(aDeadPerson['ADDRESS'])        
+    tables = perturb(tables)
     sys.stdout.write("Done\n")               
     #Save everything to the disk
     sys.stdout.write("Saving to disk. . .")
-    pandas.DataFrame.from_dict(GP_DEM).to_csv("GP_DEM.csv", index = False)
-    pandas.DataFrame.from_dict(GP_CLIN).to_csv("GP_CLIN.csv", index = False)
-    pandas.DataFrame.from_dict(HOSPDAT).to_csv("HOSPDAT.csv", index = False)
-    pandas.DataFrame.from_dict(DEATHREG).to_csv("DEATHREG.csv", index = False)
+    save(tables)
     sys.stdout.write("Done\n")
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Generates the same four datasets as detDataLinking.py via a relational schema
+
+Rather than generating nested participants and then "denormalising" them,
+each table (GP_DEM, GP_CLIN, HOSPDAT, DEATHREG) is generated directly, in
+chunks of participants, and appended to its CSV file.
+"""
+
+from DGen.datagenerator import *
+from DGen.dataperturbator import *
+from DGen.perturbationplan import perturbationPlan
+from DGen.relational import entityTable, dependentTable, relationalSchema
+from DGen.telemetry import telemetry
+from DGen.epi.person import Person
+from DGen.epi.utils import StreetNames
+import sys
+import os
+import numpy
+
+class terminalDateGenerator(randomDataGenerator):
+    '''Generates the last date of the health events of a participant: Today or 4 weeks before their death'''
+    def __init__(self, possibleDateOfDeath):
+        '''Initialises the generator with the (possibly empty) date of death of a participant'''
+        super(terminalDateGenerator, self).__init__()
+        self._possibleDateOfDeath = possibleDateOfDeath
+
+    def __call__(self):
+        dateOfDeath = self._possibleDateOfDeath()
+        if not dateOfDeath:
+            return str(datetime.datetime.now().replace(microsecond=0))
+        return str(datetime.datetime.strptime(dateOfDeath, "%Y-%m-%d %H:%M:%S") - datetime.timedelta(weeks=4))
+
+    def generateBatch(self, N):
+        datesOfDeath = self._possibleDateOfDeath.generateBatch(N)
+        isDead = datesOfDeath != ""
+        terminalDates = numpy.empty(N, dtype="datetime64[s]")
+        terminalDates.fill(numpy.datetime64(datetime.datetime.now().replace(microsecond=0), "s"))
+        terminalDates[isDead] = datesOfDeath[isDead].astype("datetime64[s]") - numpy.timedelta64(4, "W")
+        return numpy.char.replace(terminalDates.astype(str), "T", " ").astype(object)
+
+class dateOffsetGenerator(randomDataGenerator):
+    '''Generates a date at a fixed offset from the date of another generator'''
+    def __init__(self, possibleDate, anOffset):
+        super(dateOffsetGenerator, self).__init__()
+        self._possibleDate = possibleDate
+        self._offset = anOffset
+
+    def __call__(self):
+        return str(datetime.datetime.strptime(self._possibleDate(), "%Y-%m-%d %H:%M:%S") + self._offset)
+
+    def generateBatch(self, N):
+        dates = self._possibleDate.generateBatch(N).astype("datetime64[s]") + numpy.timedelta64(self._offset.days * 86400 + self._offset.seconds, "s")
+        return numpy.char.replace(dates.astype(str), "T", " ").astype(object)
+
+def participantSchema(NPersons, NCase, NPCD, NSCD, NControlDead, NCaseDead):
+    '''Returns the relational schema of the four tables'''
+    isCase = optionGenerator([(NCase / float(NPersons), "1"), (1 - NCase / float(NPersons), "0")]).setVarName("Case")
+    #The probability of death depends on whether a participant is a case or a control
+    isDead = (condProbOptionGenerator({"1":optionGenerator([(NCaseDead / float(NCase), "1"), (1 - NCaseDead / float(NCase), "0")]),
+                                       "0":optionGenerator([(NControlDead / float(NPersons - NCase), "1"), (1 - NControlDead / float(NPersons - NCase), "0")])}) | varRefGenerator("Case")).setVarName("Dead")
+    dateOfDeath = (condProbOptionGenerator({"1":dateGenerator((datetime.datetime.now() - datetime.timedelta(weeks=96)).replace(microsecond=0), datetime.datetime.now()),
+                                            "0":constantGenerator("")}) | varRefGenerator("Dead")).setVarName("DOD")
+    causeOfDeath = (condProbOptionGenerator({"1":optionGenerator(["Natural causes", "Accidental"]),
+                                             "0":constantGenerator("")}) | varRefGenerator("Dead")).setVarName("CAUSE")
+    addressAtDeath = (revRegexGenerator("([1-9]|([1-9][0-9]?[0-9]?)) ") * optionGenerator(StreetNames)).setVarName("DeathAddress")
+    terminalDate = terminalDateGenerator(varRefGenerator("DOD")).setVarName("TerminalDate")
+    participant = Person()
+
+    GP_DEM = entityTable("GP_DEM", recordGenerator(participant.record.fields + [isCase, isDead, dateOfDeath, causeOfDeath, addressAtDeath, terminalDate]), NPersons,
+                         ["PATID", "Name", "Surname", "DOB", "Gender", "Address", "Postcode", "GPID"])
+    GP_CLIN = dependentTable("GP_CLIN", GP_DEM,
+                             [optionGenerator([varRefGenerator("GP_DEM.GPID"), participant._GPID, participant._GPID, participant._GPID, participant._GPID]).setVarName("GPID"),
+                              optionGenerator(["ITX10","QB65", "ABC456"]).setVarName("EVENT_CODE"),
+                              optionGenerator(["10","22","55","3.22"]).setVarName("EVENT_DATA")],
+                             dateTimelineGenerator(varRefGenerator("GP_DEM.DOB"), varRefGenerator("GP_DEM.TerminalDate"), NPCD).setVarName("EVENT_DATE"))
+    HOSPDAT = dependentTable("HOSPDAT", GP_DEM,
+                             [optionGenerator(["SGH2498753","MST9530622"]).setVarName("HOSPID"),
+                              (condProbOptionGenerator({"0":optionGenerator(["V00.131S", "J11.82", "J44.9", "V15.82", "F41.9"]),
+                                                        "1":optionGenerator(["W00.9","W06.XXXA", "W11.XXXA", "W14.XXXA", "W17.2XXA", "W19.XXXA", "F32.9", "G40.909", "C34.00", "C46.51", "D12.8", "I15.9", "I27.0", "F41.9"])}) | varRefGenerator("GP_DEM.Case")).setVarName("EVENT_CODE")],
+                             dateTimelineGenerator(dateOffsetGenerator(varRefGenerator("GP_DEM.DOB"), datetime.timedelta(weeks=336)), varRefGenerator("GP_DEM.TerminalDate"), NSCD).setVarName("EVENT_DATE"))
+    DEATHREG = dependentTable("DEATHREG", GP_DEM,
+                              [varRefGenerator("GP_DEM.Name").setVarName("NAME"),
+                               varRefGenerator("GP_DEM.Surname").setVarName("SURNAME"),
+                               varRefGenerator("GP_DEM.DOB").setVarName("DOB"),
+                               varRefGenerator("GP_DEM.Gender").setVarName("GENDER"),
+                               varRefGenerator("GP_DEM.DeathAddress").setVarName("ADDRESS"),
+                               varRefGenerator("GP_DEM.Postcode").setVarName("POSTCODE"),
+                               varRefGenerator("GP_DEM.DOD").setVarName("DOD"),
+                               varRefGenerator("GP_DEM.CAUSE").setVarName("CAUSE")],
+                              condProbOptionGenerator({"1":constantGenerator(1), "0":constantGenerator(0)}) | varRefGenerator("GP_DEM.Dead"))
+    return relationalSchema([GP_DEM, GP_CLIN, HOSPDAT, DEATHREG])
+
+if __name__ == "__main__":
+    NPersons = 100 #A population of 100 persons
+    NCase = 50 #50 of them should be case persons
+    NPCD = 10 #Each with 10 events in primary care
+    NSCD = 10 #and 10 events in secondary care
+    NControlDead = 20 #20 out of the 50 controls should be dead
+    NCaseDead = 30 #30 out of the 50 cases should be dead
+    chunkSize = 20 #Participants generated at a time
+
+    #The perturbators of the death registry are instantiated once
+    deathRegPlan = perturbationPlan({'CAUSE':missingDataPerturbator(prob=0.1),
+                                     'PATID':punctuationPerturbator(prob=0.8),
+                                     'ADDRESS':subsPerturbator([('Street','St.'),('Avenue', 'Avn'), ('Drive','Drv'), ('Road','Rd')],0.6)})
+
+    sys.stdout.write("Generating dataset. . .\n")
+    written = set()
+    #Reports the rows of each table, the bytes of each file and the ETA on a progress line
+    with telemetry(progress = True, interval = 1.0) as progress:
+        for aTableName, aChunk in participantSchema(NPersons, NCase, NPCD, NSCD, NControlDead, NCaseDead).stream(chunkSize, theTelemetry = progress):
+            if aTableName == "DEATHREG":
+                aChunk = deathRegPlan.apply(aChunk)
+            aChunk.to_csv("%s.csv" % aTableName, index = False, mode = "a" if aTableName in written else "w", header = aTableName not in written)
+            written.add(aTableName)
+            progress.setBytes("%s.csv" % aTableName, os.path.getsize("%s.csv" % aTableName))
+    sys.stdout.write("Done\n")
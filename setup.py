@@ -43,5 +43,9 @@ setup(
     install_requires=[
         "rstr",
         "bunch",
-    ]
+        "numpy",
+    ],
+    entry_points={
+        "console_scripts":["perturb-file=DGen.perturbfile:main", "generate-load=DGen.loadgen:main"],
+    }
 )